@@ -0,0 +1,175 @@
+"""
+画像の利用回数と最終利用日時の記録
+
+ヒット時はプロセス内の辞書に集計するだけとし、DBへの書き込みは行わない。
+集計値はバックグラウンドのスレッドがsettings.IMAGE_ACCESS_STATS_FLUSH_INTERVAL秒毎に、
+まとめてImageのhit_count, last_accessedに反映する。
+プロセスが異常終了した場合に失われるのは、最後の書き込み以降の集計値のみとなる。
+"""
+from __future__ import annotations
+
+import atexit
+import datetime
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Case, DateTimeField, F, IntegerField, Value, When
+from django.db.models.functions import Greatest
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# 1回のUPDATE文で更新する最大件数
+FLUSH_BATCH_SIZE = 500
+
+
+class AccessRecorder:
+    def __init__(self, flush_interval: float, max_pending: int):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # シグニチャ → [利用回数, 最終利用時刻 (UNIX時間)]
+        self._pending: dict[str, list] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._pid = os.getpid()
+
+    def record(self, signiture: str) -> None:
+        """
+        画像の利用を記録する (DBやキャッシュへの通信は行わない)
+        """
+        now = time.time()
+        with self._lock:
+            if self._pid != os.getpid():
+                # フォーク後の子プロセスでは親プロセスの集計値とスレッドを引き継がない
+                self._pid = os.getpid()
+                self._pending = {}
+                self._thread = None
+            stats = self._pending.get(signiture)
+            if stats is None:
+                self._pending[signiture] = [1, now]
+            else:
+                stats[0] += 1
+                stats[1] = now
+            pending_count = len(self._pending)
+            if self._thread is None:
+                self._thread = self._start_thread()
+        if pending_count >= self.max_pending:
+            self._wakeup.set()
+
+    def pending(self) -> dict[str, tuple[int, float]]:
+        with self._lock:
+            return {key: (count, at) for key, (count, at) in self._pending.items()}
+
+    def flush(self) -> int:
+        """
+        集計値をDBに反映し、更新した行数を返す
+        書き込みに失敗した場合は、集計値を次回の書き込みに持ち越す
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            try:
+                return write_access_stats(pending)
+            except Exception:
+                with self._lock:
+                    for signiture, (count, accessed_at) in pending.items():
+                        stats = self._pending.setdefault(signiture, [0, accessed_at])
+                        stats[0] += count
+                        stats[1] = max(stats[1], accessed_at)
+                raise
+
+    def _start_thread(self) -> threading.Thread:
+        thread = threading.Thread(
+            target=self._run, name="impala-access-stats", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush image access stats.")
+            finally:
+                close_old_connections()
+
+
+def write_access_stats(pending: dict[str, list]) -> int:
+    """
+    シグニチャ毎の利用回数をhit_countに加算し、last_accessedを新しい方の日時に更新する
+    FLUSH_BATCH_SIZE件毎に1回のUPDATE文で書き込む
+    """
+    digests = {
+        models.digest_signiture(signiture): stats
+        for signiture, stats in pending.items()
+    }
+    items = list(digests.items())
+    updated = 0
+    for start in range(0, len(items), FLUSH_BATCH_SIZE):
+        batch = items[start : start + FLUSH_BATCH_SIZE]
+        hit_counts = Case(
+            *[
+                When(profile_signiture_digest=digest, then=Value(count))
+                for digest, (count, _) in batch
+            ],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+        accessed_ats = Case(
+            *[
+                When(
+                    profile_signiture_digest=digest,
+                    then=Value(
+                        datetime.datetime.fromtimestamp(
+                            accessed_at, tz=datetime.timezone.utc
+                        )
+                    ),
+                )
+                for digest, (_, accessed_at) in batch
+            ],
+            default=F("last_accessed"),
+            output_field=DateTimeField(),
+        )
+        updated += models.Image.objects.filter(
+            profile_signiture_digest__in=[digest for digest, _ in batch]
+        ).update(
+            hit_count=F("hit_count") + hit_counts,
+            last_accessed=Greatest(F("last_accessed"), accessed_ats),
+        )
+    return updated
+
+
+recorder = AccessRecorder(
+    flush_interval=settings.IMAGE_ACCESS_STATS_FLUSH_INTERVAL or 60,
+    max_pending=settings.IMAGE_ACCESS_STATS_MAX_PENDING,
+)
+
+
+def record_access(signiture: str) -> None:
+    """
+    settings.IMAGE_ACCESS_STATS_FLUSH_INTERVALがNoneでなければ、画像の利用を記録する
+    """
+    if settings.IMAGE_ACCESS_STATS_FLUSH_INTERVAL is not None:
+        recorder.record(signiture)
+
+
+@atexit.register
+def flush_at_exit() -> None:
+    # 正常終了時は集計中の値も書き込む
+    try:
+        recorder.flush()
+    except Exception:
+        logger.exception("Failed to flush image access stats.")
@@ -0,0 +1,249 @@
+"""
+画像生成処理のベンチマーク
+
+プロファイルの解析・シグニチャの生成・画像の生成と、GetViewのキャッシュヒット時・
+キャッシュミス時の処理時間を計測する。
+ビューのベンチマークはsqliteとローカルのファイルストレージを想定しているため、
+`python manage.py benchmark --settings=impala.settings.local` のように実行する。
+"""
+from __future__ import annotations
+
+import itertools
+import statistics
+import timeit
+from tempfile import TemporaryDirectory
+from typing import Any, Callable
+
+import django
+import PIL
+from django.db import connection
+from django.http import QueryDict
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .services import ImageModelService, ImageProcessingService
+
+# Benchmark matrix
+########################################################################################
+
+BENCHMARK_SIZES = [16, 512, 2048]
+BENCHMARK_QUALITIES = [10, 75, 95]
+BENCHMARK_COLOR = "146C94"
+
+# ビューの各経路で発行されるクエリ数 (これと異なる場合はベンチマーク結果をエラーとする)
+# hit_lru: プロセス内のLRUキャッシュにヒット
+# hit_cache: Djangoのキャッシュにヒット
+# hit_db: キャッシュに無く、DBにヒット
+# miss: DBにも無く、画像を生成してアップロード
+EXPECTED_QUERY_COUNTS = {
+    "hit_lru": 0,
+    "hit_cache": 0,
+    "hit_db": 1,
+    "miss": 3,
+}
+
+
+def benchmark_queries(sizes: list[int] | None = None) -> dict[str, str]:
+    """
+    サイズ・形式・クオリティの組み合わせ毎に、ベンチマーク名とクエリ文字列を返す
+    """
+    sizes = BENCHMARK_SIZES if sizes is None else sizes
+    queries = {}
+    for size, quality in itertools.product(sizes, BENCHMARK_QUALITIES):
+        queries[f"jpeg_plain_{size}_q{quality}"] = (
+            f"profile_type=jpeg_plain&width={size}&height={size}"
+            f"&color_rgb={BENCHMARK_COLOR}&quality={quality}"
+        )
+    for size in sizes:
+        queries[f"png_plain_{size}"] = (
+            f"profile_type=png_plain&width={size}&height={size}"
+            f"&color_rgb={BENCHMARK_COLOR}&alpha=255"
+        )
+    return queries
+
+
+# Helper functions
+########################################################################################
+
+
+def time_callable(
+    func: Callable[[], Any],
+    repeat: int = 5,
+    min_duration: float = 0.05,
+    number: int | None = None,
+) -> dict[str, Any]:
+    """
+    funcの1回あたりの実行時間(秒)を計測する
+    numberを省略した場合、1回の計測がmin_duration以上となるように実行回数を決める
+    """
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+        number = max(1, int(number * min_duration / 0.2))
+    timings = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def get_environment() -> dict[str, str]:
+    return {
+        "django": django.get_version(),
+        "pillow": PIL.__version__,
+        "database": connection.vendor,
+    }
+
+
+# Benchmarks
+########################################################################################
+
+
+def run_profile_benchmarks(
+    sizes: list[int] | None = None,
+    repeat: int = 5,
+    min_duration: float = 0.05,
+    number: int | None = None,
+) -> dict[str, dict[str, Any]]:
+    """
+    create_profile, dump_signiture, create_pil_image, create_imageの処理時間を計測する
+    """
+    results = {}
+    with TemporaryDirectory() as temp_dir:
+        for name, query in benchmark_queries(sizes).items():
+            querydict = QueryDict(query)
+            profile = ImageProcessingService.create_profile(querydict)
+            benchmarks = {
+                "create_profile": lambda: ImageProcessingService.create_profile(
+                    querydict
+                ),
+                "dump_signiture": profile.dump_signiture,
+                "create_pil_image": profile.create_pil_image,
+                "create_image": lambda: ImageProcessingService.create_image(
+                    profile, temp_dir
+                ),
+            }
+            for benchmark_name, func in benchmarks.items():
+                results[f"{benchmark_name}:{name}"] = time_callable(
+                    func, repeat, min_duration, number
+                )
+    return results
+
+
+def clear_url_caches() -> None:
+    ImageModelService.url_lru.clear()
+    ImageModelService.get_url_cache().clear()
+
+
+def run_view_benchmarks(
+    repeat: int = 5, min_duration: float = 0.05, number: int | None = None
+) -> dict[str, dict[str, Any]]:
+    """
+    GetViewのキャッシュヒット時・キャッシュミス時の処理時間とクエリ数を計測する
+    DBにデータが書き込まれるため、テスト用のDBに接続した状態で呼び出す
+    """
+    client = Client()
+    url = reverse("api:get")
+    query = benchmark_queries([64])["png_plain_64"]
+    # キャッシュミスの経路では毎回異なる画像となるよう、幅を変えながらリクエストする
+    miss_widths = itertools.count(1)
+
+    def request_hit_lru():
+        return client.get(f"{url}?{query}")
+
+    def request_hit_cache():
+        ImageModelService.url_lru.clear()
+        return client.get(f"{url}?{query}")
+
+    def request_hit_db():
+        clear_url_caches()
+        return client.get(f"{url}?{query}")
+
+    def request_miss():
+        width = next(miss_widths)
+        return client.get(
+            f"{url}?profile_type=png_plain&width={width}&height=1"
+            f"&color_rgb={BENCHMARK_COLOR}&alpha=255"
+        )
+
+    paths = {
+        "hit_lru": request_hit_lru,
+        "hit_cache": request_hit_cache,
+        "hit_db": request_hit_db,
+        "miss": request_miss,
+    }
+
+    results = {}
+    with TemporaryDirectory() as media_root, override_settings(
+        MEDIA_ROOT=media_root, IMAGE_ACCESS_STATS_FLUSH_INTERVAL=None
+    ):
+        clear_url_caches()
+        # キャッシュヒットの経路で使う画像を事前に登録する
+        request_miss()
+        client.get(f"{url}?{query}")
+
+        for path_name, func in paths.items():
+            with CaptureQueriesContext(connection) as context:
+                response = func()
+            # リクエストの開始時にクエリのログは消去されるため、次のリクエストの前に数える
+            query_count = len(context.captured_queries)
+            if response.status_code != 302:
+                raise RuntimeError(
+                    f"Unexpected status code {response.status_code} on {path_name}."
+                )
+            result = time_callable(func, repeat, min_duration, number)
+            result["queries"] = query_count
+            result["expected_queries"] = EXPECTED_QUERY_COUNTS[path_name]
+            results[f"get_view:{path_name}"] = result
+        clear_url_caches()
+    return results
+
+
+# Comparison
+########################################################################################
+
+
+def find_query_count_errors(results: dict[str, dict[str, Any]]) -> list[str]:
+    errors = []
+    for name, result in results.items():
+        if "expected_queries" not in result:
+            continue
+        if result["queries"] != result["expected_queries"]:
+            errors.append(
+                f"{name}: {result['queries']} queries "
+                f"(expected {result['expected_queries']})"
+            )
+    return errors
+
+
+def compare_results(
+    baseline: dict[str, dict[str, Any]],
+    current: dict[str, dict[str, Any]],
+    threshold: float = 0.2,
+) -> list[dict[str, Any]]:
+    """
+    ベースラインと比較して、最小値がthresholdの割合以上遅くなったベンチマークを返す
+    ベースラインに無いベンチマークは比較しない
+    """
+    regressions = []
+    for name, result in current.items():
+        if name not in baseline:
+            continue
+        baseline_time = baseline[name]["min"]
+        current_time = result["min"]
+        if baseline_time <= 0:
+            continue
+        ratio = current_time / baseline_time
+        if ratio > 1 + threshold:
+            regressions.append(
+                {
+                    "name": name,
+                    "baseline": baseline_time,
+                    "current": current_time,
+                    "ratio": ratio,
+                }
+            )
+    return regressions
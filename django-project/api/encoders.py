@@ -0,0 +1,476 @@
+from __future__ import annotations
+
+import math
+import struct
+import zlib
+from typing import Iterable, Iterator
+
+# Helper functions
+########################################################################################
+
+ADLER32_MOD = 65521
+DEFLATE_WINDOW_SIZE = 32768
+
+# 圧縮器に一度に渡すゼロ埋めデータ (画像サイズに関わらずこのサイズ以上のメモリは確保しない)
+_ZERO_BLOCK = memoryview(bytes(4096))
+
+
+def adler32_zeros(adler: int, count: int) -> int:
+    """
+    adler32チェックサムに、count個のゼロバイトを追加した値を計算する
+    ゼロバイトの追加ではaは変化せず、bにa * countが加算されるだけとなる
+    """
+    a = adler & 0xFFFF
+    b = (adler >> 16) & 0xFFFF
+    b = (b + count * a) % ADLER32_MOD
+    return (b << 16) | a
+
+
+def iter_zeros(count: int) -> Iterator[memoryview]:
+    while count > 0:
+        size = min(count, len(_ZERO_BLOCK))
+        yield _ZERO_BLOCK[:size]
+        count -= size
+
+
+# PNG
+########################################################################################
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLOR_TYPE_RGBA = 6
+PNG_FILTER_SUB = 1
+PNG_FILTER_UP = 2
+PNG_IDAT_SIZE = 8192
+
+# デフォルトの圧縮レベルを示すzlibヘッダー (CMF: deflate, 32KBウィンドウ)
+ZLIB_HEADER = b"\x78\x9c"
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(data, zlib.crc32(chunk_type))
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def iter_png_idat_chunks(
+    data_iter: Iterable[bytes], chunk_size: int = PNG_IDAT_SIZE
+) -> Iterator[bytes]:
+    """
+    zlibストリームの断片を受け取り、chunk_size毎のIDATチャンクにまとめて返す
+    """
+    buffer = bytearray()
+    for data in data_iter:
+        buffer += data
+        while len(buffer) >= chunk_size:
+            yield png_chunk(b"IDAT", bytes(buffer[:chunk_size]))
+            del buffer[:chunk_size]
+    if buffer:
+        yield png_chunk(b"IDAT", bytes(buffer))
+
+
+def iter_plain_png_zlib_stream(
+    width: int, height: int, color_rgba: tuple[int, int, int, int], level: int = 6
+) -> Iterator[bytes]:
+    """
+    単色RGBA画像のフィルタ済みスキャンラインをdeflateしたzlibストリームを返す
+
+    1行目はSubフィルタで [先頭ピクセル, 0, 0, ...] となり、
+    2行目以降はUpフィルタで全てゼロのスキャンラインとなる。
+    ゼロのスキャンラインをdeflateウィンドウ(32KB)以上の長さ分まとめて圧縮した断片は、
+    直前のウィンドウの内容が同じである限り何度繰り返しても同じ内容に展開されるため、
+    一度だけ圧縮して繰り返し出力する。
+    """
+    row_size = width * 4
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def compress_row(filter_type: int, head: bytes, zero_count: int) -> Iterator[bytes]:
+        yield compressor.compress(bytes([filter_type]) + head)
+        for zeros in iter_zeros(zero_count):
+            yield compressor.compress(zeros)
+
+    def compress_up_rows(count: int) -> Iterator[bytes]:
+        for _ in range(count):
+            yield from compress_row(PNG_FILTER_UP, b"", row_size)
+
+    yield ZLIB_HEADER
+
+    first_row_head = bytes(color_rgba)
+    adler = zlib.adler32(bytes([PNG_FILTER_SUB]) + first_row_head)
+    adler = adler32_zeros(adler, row_size - len(first_row_head))
+    yield from compress_row(PNG_FILTER_SUB, first_row_head, row_size - 4)
+
+    up_row_count = height - 1
+    for _ in range(up_row_count):
+        adler = zlib.adler32(bytes([PNG_FILTER_UP]), adler)
+        adler = adler32_zeros(adler, row_size)
+
+    # 繰り返し出力する断片1つあたりの行数 (展開後の長さがウィンドウサイズ以上となる行数)
+    segment_rows = -(-DEFLATE_WINDOW_SIZE // (row_size + 1))
+    if up_row_count >= segment_rows * 2:
+        # ウィンドウをゼロのスキャンラインで満たすための断片
+        yield from compress_up_rows(segment_rows)
+        yield compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        segment = b"".join(compress_up_rows(segment_rows))
+        segment += compressor.flush(zlib.Z_SYNC_FLUSH)
+        repeat_count = (up_row_count - segment_rows) // segment_rows
+        for _ in range(repeat_count):
+            yield segment
+        up_row_count -= segment_rows * (repeat_count + 1)
+
+    yield from compress_up_rows(up_row_count)
+    yield compressor.flush(zlib.Z_FINISH)
+    yield struct.pack(">I", adler)
+
+
+def iter_plain_png(
+    width: int,
+    height: int,
+    color_rgba: tuple[int, int, int, int],
+    level: int = 6,
+    chunk_size: int = PNG_IDAT_SIZE,
+) -> Iterator[bytes]:
+    """
+    単色RGBA画像のPNGファイルを、画像全体をメモリ上に展開せずに断片毎に生成する
+    使用するメモリは画像サイズに依存しない
+    """
+    yield PNG_SIGNATURE
+    yield png_chunk(
+        b"IHDR",
+        struct.pack(">IIBBBBB", width, height, 8, PNG_COLOR_TYPE_RGBA, 0, 0, 0),
+    )
+    yield from iter_png_idat_chunks(
+        iter_plain_png_zlib_stream(width, height, color_rgba, level), chunk_size
+    )
+    yield png_chunk(b"IEND", b"")
+
+
+# JPEG
+########################################################################################
+
+JPEG_CHUNK_SIZE = 65536
+
+# ITU-T T.81 Annex K の標準量子化テーブル (自然順)
+JPEG_LUMINANCE_QUANT_TABLE = (
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+)  # fmt: skip
+JPEG_CHROMINANCE_QUANT_TABLE = (
+    17, 18, 24, 47, 99, 99, 99, 99,
+    18, 21, 26, 66, 99, 99, 99, 99,
+    24, 26, 56, 99, 99, 99, 99, 99,
+    47, 66, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+)  # fmt: skip
+
+JPEG_ZIGZAG_ORDER = (
+    0, 1, 8, 16, 9, 2, 3, 10,
+    17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34,
+    27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36,
+    29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46,
+    53, 60, 61, 54, 47, 55, 62, 63,
+)  # fmt: skip
+
+# ITU-T T.81 Annex K の標準ハフマンテーブル (符号長毎の符号数, シンボル)
+JPEG_LUMINANCE_DC_HUFFMAN_TABLE = (
+    (0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0),
+    tuple(range(12)),
+)
+JPEG_CHROMINANCE_DC_HUFFMAN_TABLE = (
+    (0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0),
+    tuple(range(12)),
+)
+JPEG_LUMINANCE_AC_HUFFMAN_TABLE = (
+    (0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7D),
+    (
+        0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12,
+        0x21, 0x31, 0x41, 0x06, 0x13, 0x51, 0x61, 0x07,
+        0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xA1, 0x08,
+        0x23, 0x42, 0xB1, 0xC1, 0x15, 0x52, 0xD1, 0xF0,
+        0x24, 0x33, 0x62, 0x72, 0x82, 0x09, 0x0A, 0x16,
+        0x17, 0x18, 0x19, 0x1A, 0x25, 0x26, 0x27, 0x28,
+        0x29, 0x2A, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39,
+        0x3A, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49,
+        0x4A, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59,
+        0x5A, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69,
+        0x6A, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79,
+        0x7A, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+        0x8A, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98,
+        0x99, 0x9A, 0xA2, 0xA3, 0xA4, 0xA5, 0xA6, 0xA7,
+        0xA8, 0xA9, 0xAA, 0xB2, 0xB3, 0xB4, 0xB5, 0xB6,
+        0xB7, 0xB8, 0xB9, 0xBA, 0xC2, 0xC3, 0xC4, 0xC5,
+        0xC6, 0xC7, 0xC8, 0xC9, 0xCA, 0xD2, 0xD3, 0xD4,
+        0xD5, 0xD6, 0xD7, 0xD8, 0xD9, 0xDA, 0xE1, 0xE2,
+        0xE3, 0xE4, 0xE5, 0xE6, 0xE7, 0xE8, 0xE9, 0xEA,
+        0xF1, 0xF2, 0xF3, 0xF4, 0xF5, 0xF6, 0xF7, 0xF8,
+        0xF9, 0xFA,
+    ),
+)  # fmt: skip
+JPEG_CHROMINANCE_AC_HUFFMAN_TABLE = (
+    (0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77),
+    (
+        0x00, 0x01, 0x02, 0x03, 0x11, 0x04, 0x05, 0x21,
+        0x31, 0x06, 0x12, 0x41, 0x51, 0x07, 0x61, 0x71,
+        0x13, 0x22, 0x32, 0x81, 0x08, 0x14, 0x42, 0x91,
+        0xA1, 0xB1, 0xC1, 0x09, 0x23, 0x33, 0x52, 0xF0,
+        0x15, 0x62, 0x72, 0xD1, 0x0A, 0x16, 0x24, 0x34,
+        0xE1, 0x25, 0xF1, 0x17, 0x18, 0x19, 0x1A, 0x26,
+        0x27, 0x28, 0x29, 0x2A, 0x35, 0x36, 0x37, 0x38,
+        0x39, 0x3A, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48,
+        0x49, 0x4A, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58,
+        0x59, 0x5A, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68,
+        0x69, 0x6A, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78,
+        0x79, 0x7A, 0x82, 0x83, 0x84, 0x85, 0x86, 0x87,
+        0x88, 0x89, 0x8A, 0x92, 0x93, 0x94, 0x95, 0x96,
+        0x97, 0x98, 0x99, 0x9A, 0xA2, 0xA3, 0xA4, 0xA5,
+        0xA6, 0xA7, 0xA8, 0xA9, 0xAA, 0xB2, 0xB3, 0xB4,
+        0xB5, 0xB6, 0xB7, 0xB8, 0xB9, 0xBA, 0xC2, 0xC3,
+        0xC4, 0xC5, 0xC6, 0xC7, 0xC8, 0xC9, 0xCA, 0xD2,
+        0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8, 0xD9, 0xDA,
+        0xE2, 0xE3, 0xE4, 0xE5, 0xE6, 0xE7, 0xE8, 0xE9,
+        0xEA, 0xF2, 0xF3, 0xF4, 0xF5, 0xF6, 0xF7, 0xF8,
+        0xF9, 0xFA,
+    ),
+)  # fmt: skip
+
+# 4:2:0 サブサンプリング (Pillowのデフォルト) で、1MCUあたりの輝度ブロック数
+JPEG_LUMINANCE_BLOCKS_PER_MCU = 4
+JPEG_MCU_SIZE = 16
+
+
+def jpeg_quant_table(base_table: tuple[int, ...], quality: int) -> tuple[int, ...]:
+    """
+    libjpegのjpeg_set_quality()と同じ方法でqualityから量子化テーブルを計算する
+    """
+    quality = clamp_jpeg_quality(quality)
+    if quality < 50:
+        scale = 5000 // quality
+    else:
+        scale = 200 - quality * 2
+    return tuple(min(max((value * scale + 50) // 100, 1), 255) for value in base_table)
+
+
+def clamp_jpeg_quality(quality: int) -> int:
+    return min(max(quality, 1), 100)
+
+
+def jpeg_huffman_codes(table: tuple[tuple[int, ...], tuple[int, ...]]) -> dict:
+    """
+    ハフマンテーブルから、シンボル毎の (符号, 符号長) を求める
+    """
+    counts, symbols = table
+    codes = {}
+    code = 0
+    index = 0
+    for length, count in enumerate(counts, start=1):
+        for _ in range(count):
+            codes[symbols[index]] = (code, length)
+            code += 1
+            index += 1
+        code <<= 1
+    return codes
+
+
+def rgb_to_ycbcr(r: int, g: int, b: int) -> tuple[int, int, int]:
+    """
+    libjpegの固定小数点演算と同じ方法でRGBをYCbCrに変換する
+    """
+
+    def fix(x: float) -> int:
+        return int(x * 65536 + 0.5)
+
+    one_half = 1 << 15
+    cbcr_offset = 128 << 16
+    y = (fix(0.29900) * r + fix(0.58700) * g + fix(0.11400) * b + one_half) >> 16
+    cb = (
+        -fix(0.16874) * r
+        - fix(0.33126) * g
+        + fix(0.50000) * b
+        + cbcr_offset
+        + one_half
+        - 1
+    ) >> 16
+    cr = (
+        fix(0.50000) * r
+        - fix(0.41869) * g
+        - fix(0.08131) * b
+        + cbcr_offset
+        + one_half
+        - 1
+    ) >> 16
+    return y, cb, cr
+
+
+def quantize_dc(sample: int, quant_value: int) -> int:
+    """
+    全画素が同じ値のブロックのDC係数を量子化する
+    libjpegの整数DCTではDC係数は 64 * (sample - 128) となり、8 * quant_valueで除算される
+    """
+    coefficient = 64 * (sample - 128)
+    divisor = 8 * quant_value
+    quantized = (abs(coefficient) + divisor // 2) // divisor
+    return quantized if coefficient >= 0 else -quantized
+
+
+class JPEGBitWriter:
+    """
+    エントロピー符号化データを書き込むビットライター (0xFFのバイトスタッフィングを行う)
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self._bits = 0
+        self._bit_count = 0
+
+    def write(self, code: int, length: int) -> None:
+        self._bits = (self._bits << length) | code
+        self._bit_count += length
+        while self._bit_count >= 8:
+            self._bit_count -= 8
+            byte = (self._bits >> self._bit_count) & 0xFF
+            self.buffer.append(byte)
+            if byte == 0xFF:
+                self.buffer.append(0x00)
+        self._bits &= (1 << self._bit_count) - 1
+
+    def write_dc(self, codes: dict, diff: int) -> None:
+        category = abs(diff).bit_length()
+        self.write(*codes[category])
+        if category > 0:
+            if diff < 0:
+                diff += (1 << category) - 1
+            self.write(diff, category)
+
+    def flush(self) -> None:
+        if self._bit_count > 0:
+            padding = 8 - self._bit_count
+            self.write((1 << padding) - 1, padding)
+
+    def take(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def jpeg_segment(marker: int, data: bytes) -> bytes:
+    return struct.pack(">BBH", 0xFF, marker, len(data) + 2) + data
+
+
+def jpeg_huffman_segment_data(table_class_id: int, table: tuple) -> bytes:
+    counts, symbols = table
+    return bytes([table_class_id]) + bytes(counts) + bytes(symbols)
+
+
+def plain_jpeg_headers(width: int, height: int, quality: int) -> bytes:
+    luminance_quant = jpeg_quant_table(JPEG_LUMINANCE_QUANT_TABLE, quality)
+    chrominance_quant = jpeg_quant_table(JPEG_CHROMINANCE_QUANT_TABLE, quality)
+
+    headers = [
+        b"\xff\xd8",
+        jpeg_segment(0xE0, b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"),
+        jpeg_segment(
+            0xDB,
+            bytes([0])
+            + bytes(luminance_quant[i] for i in JPEG_ZIGZAG_ORDER)
+            + bytes([1])
+            + bytes(chrominance_quant[i] for i in JPEG_ZIGZAG_ORDER),
+        ),
+        jpeg_segment(
+            0xC0,
+            struct.pack(">BHHB", 8, height, width, 3)
+            + bytes([1, 0x22, 0, 2, 0x11, 1, 3, 0x11, 1]),
+        ),
+        jpeg_segment(
+            0xC4,
+            jpeg_huffman_segment_data(0x00, JPEG_LUMINANCE_DC_HUFFMAN_TABLE)
+            + jpeg_huffman_segment_data(0x10, JPEG_LUMINANCE_AC_HUFFMAN_TABLE)
+            + jpeg_huffman_segment_data(0x01, JPEG_CHROMINANCE_DC_HUFFMAN_TABLE)
+            + jpeg_huffman_segment_data(0x11, JPEG_CHROMINANCE_AC_HUFFMAN_TABLE),
+        ),
+        jpeg_segment(0xDA, bytes([3, 1, 0x00, 2, 0x11, 3, 0x11, 0, 63, 0])),
+    ]
+    return b"".join(headers)
+
+
+def iter_plain_jpeg(
+    width: int,
+    height: int,
+    color_rgb: tuple[int, int, int],
+    quality: int,
+    chunk_size: int = JPEG_CHUNK_SIZE,
+) -> Iterator[bytes]:
+    """
+    単色画像のベースラインJPEGファイルを、画像を生成せずに断片毎に生成する
+
+    全てのブロックが同じ色のため、AC係数は全て0となり、
+    DC係数の差分も先頭のMCU以外は0となる。
+    先頭以外のMCUの符号は全て同じビット列となるため、
+    バイト境界に揃う数のMCUの符号を一度だけ計算して繰り返し出力する。
+    """
+    luminance_quant = jpeg_quant_table(JPEG_LUMINANCE_QUANT_TABLE, quality)
+    chrominance_quant = jpeg_quant_table(JPEG_CHROMINANCE_QUANT_TABLE, quality)
+    y, cb, cr = rgb_to_ycbcr(*color_rgb)
+    dc_values = (
+        quantize_dc(y, luminance_quant[0]),
+        quantize_dc(cb, chrominance_quant[0]),
+        quantize_dc(cr, chrominance_quant[0]),
+    )
+
+    luminance_dc = jpeg_huffman_codes(JPEG_LUMINANCE_DC_HUFFMAN_TABLE)
+    chrominance_dc = jpeg_huffman_codes(JPEG_CHROMINANCE_DC_HUFFMAN_TABLE)
+    luminance_eob = jpeg_huffman_codes(JPEG_LUMINANCE_AC_HUFFMAN_TABLE)[0x00]
+    chrominance_eob = jpeg_huffman_codes(JPEG_CHROMINANCE_AC_HUFFMAN_TABLE)[0x00]
+
+    writer = JPEGBitWriter()
+
+    def write_mcu(dc_diffs: tuple[int, int, int]) -> None:
+        for i in range(JPEG_LUMINANCE_BLOCKS_PER_MCU):
+            writer.write_dc(luminance_dc, dc_diffs[0] if i == 0 else 0)
+            writer.write(*luminance_eob)
+        for dc_diff in dc_diffs[1:]:
+            writer.write_dc(chrominance_dc, dc_diff)
+            writer.write(*chrominance_eob)
+
+    yield plain_jpeg_headers(width, height, quality)
+
+    mcu_count = -(-width // JPEG_MCU_SIZE) * -(-height // JPEG_MCU_SIZE)
+    write_mcu(dc_values)
+    mcu_count -= 1
+
+    # 差分0のMCUを何個並べるとバイト境界に揃うかを求める
+    zero_mcu_bits = JPEG_LUMINANCE_BLOCKS_PER_MCU * (
+        luminance_dc[0][1] + luminance_eob[1]
+    ) + 2 * (chrominance_dc[0][1] + chrominance_eob[1])
+    pattern_mcu_count = 8 // math.gcd(zero_mcu_bits, 8)
+
+    if mcu_count >= pattern_mcu_count * 2:
+        # 書き込み途中のビット列を差分0のMCUのビット列で満たす
+        for _ in range(pattern_mcu_count):
+            write_mcu((0, 0, 0))
+        yield writer.take()
+
+        for _ in range(pattern_mcu_count):
+            write_mcu((0, 0, 0))
+        pattern = writer.take()
+        repeat_count = mcu_count // pattern_mcu_count - 1
+        batch_count = max(chunk_size // len(pattern), 1)
+        for start in range(0, repeat_count, batch_count):
+            yield pattern * min(batch_count, repeat_count - start)
+        mcu_count -= pattern_mcu_count * (repeat_count + 1)
+
+    for _ in range(mcu_count):
+        write_mcu((0, 0, 0))
+    writer.flush()
+    yield writer.take()
+    yield b"\xff\xd9"
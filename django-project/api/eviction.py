@@ -0,0 +1,307 @@
+"""
+保存済みの画像の削除 (eviction)
+
+最終利用日時の古い順に削除対象の画像を選び、ストレージのファイルとDBの行をまとめて削除する。
+S3の場合は1回のDeleteObjectsで最大1000件ずつ削除し、複数のバッチを並行して処理する。
+DBの行はpre_deleteシグナル (1件ずつのファイル削除) を発生させずに一括で削除する。
+
+ストレージ → DB → URLキャッシュの順に削除するため、途中で中断した場合も再実行すれば
+残りの画像から処理を続けられる (削除済みのファイルの削除はエラーとならない)。
+
+byte_sizeの無い画像 (byte_sizeの追加前に保存した画像) は合計サイズに含まれないため、
+backfill_byte_sizes()でストレージからサイズを取得して書き込んでおく。
+
+/api/get/ のリダイレクトはブラウザやCDNにsettings.API_REDIRECT_MAX_AGE秒キャッシュされ、
+その間の利用はlast_accessedに反映されない。そのため、最終利用日時がそれより新しい画像を
+削除すると、キャッシュされたリダイレクト先の画像が存在しない状態となる。
+"""
+from __future__ import annotations
+
+import datetime
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Iterator, NamedTuple
+
+from django.conf import settings
+from django.core.files.storage import Storage
+from django.db import connections, router
+from django.db.models import BigIntegerField, Case, Q, Sum, Value, When
+from django.utils import timezone
+from storages.backends.s3boto3 import S3Boto3Storage
+from storages.utils import clean_name
+
+from . import models
+from .services import ImageModelService
+
+# S3のDeleteObjectsで1回に削除できる最大件数
+S3_DELETE_BATCH_SIZE = 1000
+
+
+class Victim(NamedTuple):
+    id: int
+    upload: str
+    profile_signiture: str
+    byte_size: int | None
+    last_accessed: datetime.datetime
+
+
+# Storage
+########################################################################################
+
+
+def delete_s3_objects(storage: S3Boto3Storage, names: list[str]) -> list[str]:
+    """
+    1回のDeleteObjectsで削除し、削除に失敗したファイル名を返す
+    """
+    keys = {storage._normalize_name(clean_name(name)): name for name in names}
+    response = storage.bucket.meta.client.delete_objects(
+        Bucket=storage.bucket_name,
+        Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+    )
+    return [keys[error["Key"]] for error in response.get("Errors", [])]
+
+
+def delete_storage_files(storage: Storage, names: list[str]) -> list[str]:
+    """
+    ストレージのファイルを削除し、削除に失敗したファイル名を返す
+    """
+    names = [name for name in names if name]
+    if isinstance(storage, S3Boto3Storage):
+        failed = []
+        for start in range(0, len(names), S3_DELETE_BATCH_SIZE):
+            failed += delete_s3_objects(
+                storage, names[start : start + S3_DELETE_BATCH_SIZE]
+            )
+        return failed
+
+    failed = []
+    for name in names:
+        try:
+            storage.delete(name)
+        except OSError:
+            failed.append(name)
+    return failed
+
+
+# Byte sizes
+########################################################################################
+
+
+def get_total_bytes() -> int:
+    return models.Image.objects.aggregate(total=Sum("byte_size"))["total"] or 0
+
+
+def count_unknown_sizes() -> int:
+    return models.Image.objects.filter(byte_size__isnull=True).count()
+
+
+def write_byte_sizes(sizes: dict[str, int]) -> int:
+    """
+    ファイル名毎のサイズを、byte_sizeの無い画像に1回のUPDATE文で書き込む
+    """
+    if not sizes:
+        return 0
+    return models.Image.objects.filter(
+        upload__in=list(sizes), byte_size__isnull=True
+    ).update(
+        byte_size=Case(
+            *[When(upload=name, then=Value(size)) for name, size in sizes.items()],
+            output_field=BigIntegerField(),
+        )
+    )
+
+
+def iter_s3_object_sizes(
+    storage: S3Boto3Storage, prefix: str
+) -> Iterator[dict[str, int]]:
+    """
+    ListObjectsV2でprefix以下のファイルを走査し、1ページ (最大1000件) 毎に
+    ファイル名とサイズの辞書を返す
+    """
+    # ストレージのlocationを除いたファイル名に戻すため、キーの先頭の長さを求める
+    root_length = len(storage._normalize_name(clean_name(prefix))) - len(prefix)
+    paginator = storage.bucket.meta.client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=storage.bucket_name,
+        Prefix=storage._normalize_name(clean_name(prefix)),
+    ):
+        yield {
+            content["Key"][root_length:]: content["Size"]
+            for content in page.get("Contents", [])
+        }
+
+
+def iter_storage_sizes(storage: Storage, batch_size: int) -> Iterator[dict[str, int]]:
+    """
+    byte_sizeの無い画像のファイルのサイズを1件ずつ取得し、batch_size件毎に返す
+    ファイルが無い画像は読み飛ばす
+    """
+    last_id = 0
+    while True:
+        rows = list(
+            models.Image.objects.filter(byte_size__isnull=True, id__gt=last_id)
+            .order_by("id")
+            .values_list("id", "upload")[:batch_size]
+        )
+        if not rows:
+            return
+        sizes = {}
+        for _, name in rows:
+            try:
+                sizes[name] = storage.size(name)
+            except OSError:
+                pass
+        yield sizes
+        last_id = rows[-1][0]
+
+
+def backfill_byte_sizes(batch_size: int = S3_DELETE_BATCH_SIZE) -> int:
+    """
+    byte_sizeの無い画像のサイズをストレージから取得して書き込み、書き込んだ件数を返す
+    S3の場合は1件ずつ問い合わせず、ListObjectsV2で画像の保存先を走査する
+    """
+    if not models.Image.objects.filter(byte_size__isnull=True).exists():
+        return 0
+    storage = models.Image._meta.get_field("upload").storage
+    if isinstance(storage, S3Boto3Storage):
+        pages = iter_s3_object_sizes(storage, "images/")
+    else:
+        pages = iter_storage_sizes(storage, batch_size)
+    return sum(write_byte_sizes(sizes) for sizes in pages)
+
+
+# Victims
+########################################################################################
+
+
+def iter_victims(
+    accessed_before: datetime.datetime | None,
+    bytes_to_free: int,
+    batch_size: int,
+) -> Iterator[list[Victim]]:
+    """
+    最終利用日時の古い順に、削除対象の画像をbatch_size件ずつ返す
+    accessed_beforeより前に利用された画像と、合計でbytes_to_free以上となるまでの画像が対象
+    (last_accessed, id) の範囲で問い合わせるため、削除に失敗した画像は読み飛ばす
+    """
+    freed = 0
+    cursor: tuple[datetime.datetime, int] | None = None
+    while True:
+        queryset = models.Image.objects.order_by("last_accessed", "id")
+        if cursor is not None:
+            queryset = queryset.filter(
+                Q(last_accessed__gt=cursor[0])
+                | Q(last_accessed=cursor[0], id__gt=cursor[1])
+            )
+        rows = [
+            Victim(*row) for row in queryset.values_list(*Victim._fields)[:batch_size]
+        ]
+
+        victims = []
+        for victim in rows:
+            expired = accessed_before is not None and (
+                victim.last_accessed < accessed_before
+            )
+            if not expired and freed >= bytes_to_free:
+                break
+            victims.append(victim)
+            freed += victim.byte_size or 0
+
+        if victims:
+            yield victims
+        if len(victims) < batch_size:
+            return
+        cursor = (victims[-1].last_accessed, victims[-1].id)
+
+
+# Eviction
+########################################################################################
+
+
+def delete_images(victims: list[Victim], failed_names: list[str]) -> list[Victim]:
+    """
+    ストレージから削除できた画像の行とURLキャッシュを削除し、削除した画像を返す
+    """
+    failed = set(failed_names)
+    deleted = [victim for victim in victims if victim.upload not in failed]
+    if not deleted:
+        return []
+    # QuerySet.delete()は行を読み込んでpre_deleteシグナル (URLキャッシュの削除) を
+    # 1件ずつ発生させるため、SQLで直接削除し、URLキャッシュは下でまとめて削除する
+    # (Imageを参照するモデルは無いため、関連する行の削除は不要)
+    ids = [victim.id for victim in deleted]
+    connection = connections[router.db_for_write(models.Image)]
+    table = connection.ops.quote_name(models.Image._meta.db_table)
+    placeholders = ", ".join(["%s"] * len(ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", ids)
+    ImageModelService.evict_cache_image_urls(
+        [victim.profile_signiture for victim in deleted]
+    )
+    return deleted
+
+
+def evict_images(
+    accessed_before: datetime.datetime | None = None,
+    max_bytes: int | None = None,
+    batch_size: int = S3_DELETE_BATCH_SIZE,
+    concurrency: int = 4,
+    dry_run: bool = False,
+) -> dict[str, Any]:
+    """
+    accessed_beforeより前に利用された画像と、合計サイズがmax_bytesを超える分の画像を
+    最終利用日時の古い順に削除し、件数とサイズの集計を返す
+    ストレージの削除は最大concurrency個のバッチを並行して行い、DBの削除は呼び出し元の
+    スレッドで行う
+    """
+    total_bytes = get_total_bytes()
+    bytes_to_free = 0 if max_bytes is None else max(0, total_bytes - max_bytes)
+    result = {
+        "images": 0,
+        "bytes": 0,
+        "failed": 0,
+        "total_bytes": total_bytes,
+        # サイズが不明 (合計サイズに含まれない) の画像の件数
+        "unknown_sizes": count_unknown_sizes() if max_bytes is not None else 0,
+        # リダイレクトがまだキャッシュされている可能性のある画像の件数
+        "redirect_cached": 0,
+    }
+    if accessed_before is None and bytes_to_free == 0:
+        return result
+
+    redirect_cached_after = timezone.now() - datetime.timedelta(
+        seconds=settings.API_REDIRECT_MAX_AGE
+    )
+
+    def count(victims: list[Victim]) -> None:
+        result["images"] += len(victims)
+        result["bytes"] += sum(victim.byte_size or 0 for victim in victims)
+        result["redirect_cached"] += sum(
+            1 for victim in victims if victim.last_accessed > redirect_cached_after
+        )
+
+    def finish(victims: list[Victim], future: Future) -> None:
+        failed_names = future.result()
+        deleted = delete_images(victims, failed_names)
+        count(deleted)
+        result["failed"] += len(victims) - len(deleted)
+
+    storage = models.Image._meta.get_field("upload").storage
+    victim_batches = iter_victims(accessed_before, bytes_to_free, batch_size)
+    if dry_run:
+        for victims in victim_batches:
+            count(victims)
+        return result
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending: deque[tuple[list[Victim], Future]] = deque()
+        for victims in victim_batches:
+            future = executor.submit(
+                delete_storage_files, storage, [victim.upload for victim in victims]
+            )
+            pending.append((victims, future))
+            if len(pending) >= concurrency:
+                finish(*pending.popleft())
+        while pending:
+            finish(*pending.popleft())
+    return result
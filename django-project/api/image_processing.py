@@ -1,14 +1,22 @@
 from __future__ import annotations
 
+import copy
 import json
 import re
 from abc import ABC, abstractmethod
 from collections import OrderedDict
 from dataclasses import dataclass
+from functools import lru_cache
+from typing import IO, Any, Callable, Type
 
 import PIL.Image
 from django import forms
 from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.http import QueryDict
+
+from . import timing
+from .encoders import iter_plain_jpeg, iter_plain_png
 
 # Helper functions
 ########################################################################################
@@ -67,6 +75,9 @@ class ColorRGB:
     def to_ordered_dict(self) -> OrderedDict:
         return OrderedDict(r=self.r, g=self.g, b=self.b)
 
+    def to_hex(self) -> str:
+        return f"{self.r:02X}{self.g:02X}{self.b:02X}"
+
 
 # Image Profiles
 ########################################################################################
@@ -96,6 +107,26 @@ class ImageProfileAbstract(ABC):
     def dump_signiture(self) -> str:
         raise NotImplementedError()
 
+    @property
+    def pixel_count(self) -> int:
+        """
+        生成する画像の画素数 (不明な場合は0)
+        """
+        return 0
+
+    def save_image(self, fp: IO[bytes]) -> None:
+        """
+        画像をエンコードしてファイルオブジェクトに書き込む
+        画像全体を生成せずにエンコードできるプロファイルはこのメソッドをオーバーライドする
+        """
+        with timing.Stage("draw"):
+            pil_image = self.create_pil_image()
+        with timing.Stage("encode"):
+            if self.quality is None:
+                pil_image.save(fp, format=self.get_extension())
+            else:
+                pil_image.save(fp, format=self.get_extension(), quality=self.quality)
+
 
 class JPEGPlainProfile(ImageProfileAbstract):
     max_size: int = 15360
@@ -121,10 +152,24 @@ class JPEGPlainProfile(ImageProfileAbstract):
         )
         return pil_image
 
+    def save_image(self, fp: IO[bytes]) -> None:
+        """
+        全てのブロックが同じ内容となるため、画像を生成せずにJPEGを書き出す
+        """
+        with timing.Stage("encode"):
+            for chunk in iter_plain_jpeg(
+                self.width, self.height, self.color_rgb.to_tuple(), self._quality
+            ):
+                fp.write(chunk)
+
     @property
     def quality(self) -> int | None:
         return self._quality
 
+    @property
+    def pixel_count(self) -> int:
+        return self.width * self.height
+
     @property
     def upload_file_name(self) -> str:
         return f"jpeg_plain_width_{self.width}_height_{self.height}_color_r_{self.color_rgb.r}_g_{self.color_rgb.g}_b_{self.color_rgb.b}_quality_{self.quality}.{self.get_extension()}"
@@ -172,10 +217,23 @@ class PNGPlainProfile(ImageProfileAbstract):
         pil_image.putalpha(self.alpha)
         return pil_image
 
+    def save_image(self, fp: IO[bytes]) -> None:
+        """
+        全ての行が同じ内容となるため、画像を生成せずに一定のメモリ量でPNGを書き出す
+        """
+        color_rgba = self.color_rgb.to_tuple() + (self.alpha,)
+        with timing.Stage("encode"):
+            for chunk in iter_plain_png(self.width, self.height, color_rgba):
+                fp.write(chunk)
+
     @property
     def quality(self) -> int | None:
         return None
 
+    @property
+    def pixel_count(self) -> int:
+        return self.width * self.height
+
     @property
     def upload_file_name(self) -> str:
         return f"png_plain_width_{self.width}_height_{self.height}_color_r_{self.color_rgb.r}_g_{self.color_rgb.g}_b_{self.color_rgb.b}_alpha_{self.alpha}.{self.get_extension()}"
@@ -223,20 +281,44 @@ def parse_hex_RGB_color_code(color_code_string):
     return tuple(numeric_values)
 
 
+@lru_cache(maxsize=4096)
+def get_color_rgb(color_code_string: str) -> ColorRGB:
+    """
+    検証済みのカラーコード文字列に対応するColorRGBを返す
+    同じカラーコードに対しては同じインスタンスを使い回す
+    """
+    rgb_tuple = parse_hex_RGB_color_code(color_code_string)
+    return ColorRGB(r=rgb_tuple[0], g=rgb_tuple[1], b=rgb_tuple[2])
+
+
 class HexRGBColorCodeField(forms.CharField):
     default_validators = [validate_hex_RGB_color_code]
 
     def clean(self, value):
-        cleaned_data = super().clean(value)
-        self.original_cleaned_data = cleaned_data
-        rgb_tuple = parse_hex_RGB_color_code(cleaned_data)
-        return ColorRGB(r=rgb_tuple[0], g=rgb_tuple[1], b=rgb_tuple[2])
+        return get_color_rgb(super().clean(value))
 
 
 # Image Profile Forms
 ########################################################################################
 
 
+def format_query_value(value: Any) -> str:
+    if isinstance(value, ColorRGB):
+        return value.to_hex()
+    return str(value)
+
+
+def build_query_string(profile_type: str, cleaned_data: dict[str, Any]) -> str:
+    """
+    検証済みの値から、フォームのフィールド順で正規化したクエリ文字列を生成する
+    カラーコードは大文字6桁、数値は10進数で表すため、同じ画像のクエリは1通りになる
+    """
+    parameters = [f"profile_type={profile_type}"] + [
+        f"{key}={format_query_value(value)}" for key, value in cleaned_data.items()
+    ]
+    return "&".join(parameters)
+
+
 class ImageProfileForm(forms.Form):
     def get_profile(self) -> ImageProfileAbstract:
         raise NotImplementedError()
@@ -246,7 +328,13 @@ class ImageProfileForm(forms.Form):
         raise NotImplementedError()
 
     def get_query_string(self) -> str:
-        raise NotImplementedError()
+        """
+        入力値を正規化したクエリ文字列 (APIの正規のURLのクエリ) を返す
+        """
+        if self.is_valid():
+            return build_query_string(self.get_profile_type(), self.cleaned_data)
+        else:
+            raise QueryError(dict(self.errors))
 
     @classmethod
     def get_description(cls) -> str:
@@ -291,19 +379,6 @@ class JPEGPlainProfileForm(ImageProfileForm):
     def get_profile_type(cls) -> str:
         return "jpeg_plain"
 
-    def get_query_string(self) -> str:
-        if self.is_valid():
-            cleaned_data = self.cleaned_data.copy()
-            cleaned_data["color_rgb"] = self.fields["color_rgb"].original_cleaned_data
-
-            parameters = [f"profile_type={self.get_profile_type()}"] + [
-                f"{key}={value}" for key, value in cleaned_data.items()
-            ]
-            query_string = "&".join(parameters)
-            return query_string
-        else:
-            raise QueryError(dict(self.errors))
-
     @classmethod
     def get_description(cls) -> str:
         return "JPEG形式の無地カラー画像"
@@ -347,19 +422,97 @@ class PNGPlainProfileForm(ImageProfileForm):
     def get_profile_type(cls) -> str:
         return "png_plain"
 
-    def get_query_string(self) -> str:
-        if self.is_valid():
-            cleaned_data = self.cleaned_data.copy()
-            cleaned_data["color_rgb"] = self.fields["color_rgb"].original_cleaned_data
-
-            parameters = [f"profile_type={self.get_profile_type()}"] + [
-                f"{key}={value}" for key, value in cleaned_data.items()
-            ]
-            query_string = "&".join(parameters)
-            return query_string
-        else:
-            raise QueryError(dict(self.errors))
-
     @classmethod
     def get_description(cls) -> str:
         return "PNG形式の無地カラー画像"
+
+
+# Query parsers
+########################################################################################
+
+
+def compile_field_parser(field: forms.Field) -> Callable[[Any], Any]:
+    """
+    フォームのフィールドから、クエリの値を解析する関数を生成する
+    正しい値は高速な経路で解析し、正しくない値の場合のみfield.clean()を呼び出して
+    フォームと同じエラーメッセージのValidationErrorを発生させる
+    """
+    if type(field) is forms.IntegerField and all(
+        isinstance(validator, (MinValueValidator, MaxValueValidator))
+        for validator in field.validators
+    ):
+        min_value = field.min_value
+        max_value = field.max_value
+
+        def parse_integer(value):
+            try:
+                # 小数点を含む値 (例: "12.0") はfield.clean()で解析する
+                result = int(value)
+            except (ValueError, TypeError):
+                return field.clean(value)
+            if (min_value is not None and result < min_value) or (
+                max_value is not None and result > max_value
+            ):
+                return field.clean(value)
+            return result
+
+        return parse_integer
+
+    if type(field) is HexRGBColorCodeField:
+
+        def parse_color_rgb(value):
+            if isinstance(value, str):
+                stripped = value.strip()
+                if hex_RGB_color_code_pattern.fullmatch(stripped) is not None:
+                    return get_color_rgb(stripped)
+            # 共有しているフィールドの状態を変更しないよう、複製してから検証する
+            return copy.copy(field).clean(value)
+
+        return parse_color_rgb
+
+    return field.clean
+
+
+class ProfileQueryParser:
+    """
+    ImageProfileFormと同じ条件でクエリを検証し、プロファイルを生成する
+    フォームのインスタンスを生成しないため、APIのリクエスト毎の解析を高速に行える
+    フォームは引き続きフロントエンドでの入力や検証条件の定義に用いる
+    """
+
+    def __init__(self, form_class: Type[ImageProfileForm]):
+        self.profile_type = form_class.get_profile_type()
+        self.profile_class = form_class.profile_class
+        self.field_parsers = [
+            (name, compile_field_parser(field))
+            for name, field in form_class.base_fields.items()
+        ]
+
+    def clean(self, querydict: QueryDict) -> dict[str, Any]:
+        """
+        引数querydictを解析できない場合、フォームと同じ形式のQueryError例外が発生する
+        """
+        cleaned_data = {}
+        errors = {}
+        for name, parse_field in self.field_parsers:
+            try:
+                cleaned_data[name] = parse_field(querydict.get(name))
+            except ValidationError as error:
+                errors[name] = error.messages
+
+        if errors:
+            raise QueryError(errors)
+        return cleaned_data
+
+    def parse(self, querydict: QueryDict) -> ImageProfileAbstract:
+        return self.profile_class(**self.clean(querydict))
+
+    def parse_canonical(self, querydict: QueryDict) -> tuple[ImageProfileAbstract, str]:
+        """
+        プロファイルと、ImageProfileForm.get_query_string()と同じ正規のクエリ文字列を返す
+        """
+        cleaned_data = self.clean(querydict)
+        return (
+            self.profile_class(**cleaned_data),
+            build_query_string(self.profile_type, cleaned_data),
+        )
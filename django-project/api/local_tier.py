@@ -0,0 +1,209 @@
+"""
+生成した画像のローカルディスク上の保存領域
+
+シグニチャのダイジェストをファイル名とした配置 (ab/cd/<ダイジェスト>.<拡張子>) で画像を保存し、
+ヒット時はS3等のストレージへのリダイレクト無しで、GetViewから直接画像を返す。
+合計サイズがmax_bytesを超えた場合は、最後に利用されてから最も時間の経った画像から削除する。
+各プロセスは初回の保存時とrescan_interval秒毎にディレクトリを走査して索引を作り直すため、
+複数のプロセスで同じディレクトリを共有しても、合計サイズは概ね上限内に収まる。
+走査はバックグラウンドのスレッドでロックを持たずに行い、完成した索引と入れ替えるため、
+走査中もヒット時の処理は待たされない。
+"""
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import IO
+
+from django.conf import settings
+
+from . import models, timing
+from .image_processing import ImageProfileAbstract
+
+TEMP_SUFFIX = ".tmp"
+
+
+class LocalDiskTier:
+    def __init__(self, root: str, max_bytes: int, rescan_interval: float = 300):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.rescan_interval = rescan_interval
+        # 相対パス → ファイルサイズ (古いものが先頭)
+        self._index: OrderedDict[str, int] = OrderedDict()
+        self._total_bytes = 0
+        self._scanned_at: float | None = None
+        self._rescan_thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def get_relative_path(self, profile: ImageProfileAbstract) -> str:
+        digest = models.digest_signiture(profile.dump_signiture())
+        return models.get_sharded_path(digest, profile.get_extension())
+
+    def get_path(self, relative_path: str) -> str:
+        return os.path.join(self.root, relative_path)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def get(self, profile: ImageProfileAbstract) -> str | None:
+        """
+        プロファイルの画像が保存されていれば、その相対パスを返す
+        """
+        relative_path = self.get_relative_path(profile)
+        try:
+            size = os.stat(self.get_path(relative_path)).st_size
+        except FileNotFoundError:
+            # 他のプロセスが削除した場合は索引からも除く
+            with self._lock:
+                self._discard(relative_path)
+            return None
+
+        # ヒット時はstat()1回のみとし、ディレクトリの走査は保存時に行う
+        with self._lock:
+            self._discard(relative_path)
+            self._index[relative_path] = size
+            self._total_bytes += size
+        return relative_path
+
+    def put(self, profile: ImageProfileAbstract, image_file: IO[bytes]) -> str:
+        """
+        画像を一時ファイルに書き込んでからリネームして保存し、相対パスを返す
+        image_fileは先頭から読み込む
+        """
+        relative_path = self.get_relative_path(profile)
+        path = self.get_path(relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with timing.Stage("local_write"):
+            image_file.seek(0)
+            fd, temp_path = tempfile.mkstemp(dir=self.root, suffix=TEMP_SUFFIX)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    shutil.copyfileobj(image_file, f)
+                    size = f.tell()
+                os.replace(temp_path, path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+
+        with self._lock:
+            self._discard(relative_path)
+            self._index[relative_path] = size
+            self._total_bytes += size
+            self._evict()
+            rescan_due = self._is_rescan_due()
+        if rescan_due:
+            self._rescan_thread = self._start_rescan()
+        return relative_path
+
+    def clear(self) -> None:
+        with self._lock:
+            for relative_path in list(self._index):
+                self._remove(relative_path)
+            self._scanned_at = None
+
+    def _discard(self, relative_path: str) -> None:
+        size = self._index.pop(relative_path, None)
+        if size is not None:
+            self._total_bytes -= size
+
+    def _remove(self, relative_path: str) -> None:
+        self._discard(relative_path)
+        try:
+            os.remove(self.get_path(relative_path))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and self._index:
+            relative_path = next(iter(self._index))
+            self._remove(relative_path)
+
+    def _is_rescan_due(self) -> bool:
+        now = time.monotonic()
+        if self._scanned_at is not None and (
+            now - self._scanned_at < self.rescan_interval
+        ):
+            return False
+        self._scanned_at = now
+        return True
+
+    def _start_rescan(self) -> threading.Thread:
+        thread = threading.Thread(
+            target=self.rescan, name="impala-local-tier-rescan", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def rescan(self) -> None:
+        """
+        他のプロセスが保存・削除したファイルを索引に反映する
+        ディレクトリの走査はロックを持たずに行い、索引の入れ替えのみロック内で行う
+        """
+        entries = []
+        for directory, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                if file_name.endswith(TEMP_SUFFIX):
+                    continue
+                path = os.path.join(directory, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append(
+                    (stat.st_mtime, os.path.relpath(path, self.root), stat.st_size)
+                )
+
+        # 更新日時の古い順に並べる
+        index: OrderedDict[str, int] = OrderedDict()
+        for _, relative_path, size in sorted(entries):
+            index[relative_path] = size
+
+        # 走査結果に無い索引の画像のうち、他のプロセスが削除したものを確認しておく
+        with self._lock:
+            unscanned = [path for path in self._index if path not in index]
+        removed = {
+            relative_path
+            for relative_path in unscanned
+            if not os.path.exists(os.path.join(self.root, relative_path))
+        }
+
+        with self._lock:
+            # このプロセスで利用・保存した画像は、走査結果よりも新しいものとして扱う
+            # (走査中に保存された画像は走査結果に含まれない場合がある)
+            for relative_path, size in self._index.items():
+                if relative_path in removed:
+                    continue
+                index.pop(relative_path, None)
+                index[relative_path] = size
+            self._index = index
+            self._total_bytes = sum(index.values())
+            self._evict()
+
+
+_local_tiers: dict[tuple, LocalDiskTier] = {}
+
+
+def get_local_tier() -> LocalDiskTier | None:
+    """
+    settings.IMAGE_LOCAL_TIERの設定でLocalDiskTierを返す (無効な場合はNone)
+    """
+    config = settings.IMAGE_LOCAL_TIER
+    if not config:
+        return None
+    cache_key = (
+        config["ROOT"],
+        config["MAX_BYTES"],
+        config.get("RESCAN_INTERVAL", 300),
+    )
+    local_tier = _local_tiers.get(cache_key)
+    if local_tier is None:
+        os.makedirs(config["ROOT"], exist_ok=True)
+        local_tier = LocalDiskTier(*cache_key)
+        _local_tiers[cache_key] = local_tier
+    return local_tier
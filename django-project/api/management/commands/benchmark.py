@@ -0,0 +1,75 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from api import benchmarks
+
+
+class Command(BaseCommand):
+    help = "画像生成処理のベンチマークを実行し、結果をJSONで出力する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", help="結果を書き込むJSONファイル (省略時は標準出力)")
+        parser.add_argument("--baseline", help="比較するベースラインのJSONファイル")
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=0.2,
+            help="ベースラインからの低下をリグレッションとみなす割合 (既定値: 0.2)",
+        )
+        parser.add_argument("--repeat", type=int, default=5, help="計測の繰り返し回数")
+        parser.add_argument(
+            "--sizes",
+            type=int,
+            nargs="+",
+            default=None,
+            help=f"計測する画像のサイズ (既定値: {benchmarks.BENCHMARK_SIZES})",
+        )
+        parser.add_argument(
+            "--skip-views", action="store_true", help="GetViewのベンチマークを省略する"
+        )
+
+    def handle(self, *args, **options):
+        results = benchmarks.run_profile_benchmarks(
+            sizes=options["sizes"], repeat=options["repeat"]
+        )
+        if not options["skip_views"]:
+            results.update(self.run_view_benchmarks(options["repeat"]))
+
+        report = {"environment": benchmarks.get_environment(), "results": results}
+        report_json = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(report_json)
+        else:
+            self.stdout.write(report_json)
+
+        errors = benchmarks.find_query_count_errors(results)
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)["results"]
+            for regression in benchmarks.compare_results(
+                baseline, results, options["threshold"]
+            ):
+                errors.append(
+                    f"{regression['name']}: {regression['baseline'] * 1000:.3f}ms -> "
+                    f"{regression['current'] * 1000:.3f}ms "
+                    f"(x{regression['ratio']:.2f})"
+                )
+
+        if errors:
+            raise CommandError("Benchmark regressions:\n" + "\n".join(errors))
+
+    def run_view_benchmarks(self, repeat: int) -> dict:
+        """
+        既存のDBを変更しないよう、テスト用のDBを作成してビューのベンチマークを実行する
+        """
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            return benchmarks.run_view_benchmarks(repeat=repeat)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
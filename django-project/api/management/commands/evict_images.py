@@ -0,0 +1,101 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api import eviction
+
+
+class Command(BaseCommand):
+    help = "最終利用日時の古い順に、保存済みの画像をストレージとDBから削除する"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            type=float,
+            default=None,
+            help="この日数より前に最後に利用された画像を削除する",
+        )
+        parser.add_argument(
+            "--max-bytes",
+            type=int,
+            default=None,
+            help="画像の合計サイズがこのバイト数以下となるまで削除する",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=eviction.S3_DELETE_BATCH_SIZE,
+            help=f"1回に削除する件数 (既定値: {eviction.S3_DELETE_BATCH_SIZE})",
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=4, help="並行して削除するバッチ数 (既定値: 4)"
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="削除せずに対象の件数とサイズを表示する"
+        )
+        parser.add_argument(
+            "--backfill-sizes",
+            action="store_true",
+            help="削除の前に、サイズの無い画像のサイズをストレージから取得して書き込む",
+        )
+        parser.add_argument(
+            "--allow-cached-redirects",
+            action="store_true",
+            help="--older-thanがリダイレクトのキャッシュ期間 (API_REDIRECT_MAX_AGE) より短くても削除する",
+        )
+
+    def handle(self, *args, **options):
+        if options["older_than"] is None and options["max_bytes"] is None:
+            raise CommandError("Specify --older-than and/or --max-bytes.")
+        if options["batch_size"] < 1 or options["concurrency"] < 1:
+            raise CommandError("--batch-size and --concurrency must be positive.")
+
+        accessed_before = None
+        if options["older_than"] is not None:
+            older_than = datetime.timedelta(days=options["older_than"])
+            redirect_max_age = datetime.timedelta(seconds=settings.API_REDIRECT_MAX_AGE)
+            # キャッシュされたリダイレクトからの利用はlast_accessedに記録されないため、
+            # それより短い期間では利用中の画像を削除してしまう
+            if older_than < redirect_max_age and not options["allow_cached_redirects"]:
+                raise CommandError(
+                    f"--older-than is shorter than API_REDIRECT_MAX_AGE "
+                    f"({redirect_max_age.days} days). Cached redirects to deleted "
+                    "images would point to missing files. "
+                    "Pass --allow-cached-redirects to delete them anyway."
+                )
+            accessed_before = timezone.now() - older_than
+
+        if options["backfill_sizes"] and not options["dry_run"]:
+            filled = eviction.backfill_byte_sizes(batch_size=options["batch_size"])
+            self.stdout.write(f"Filled in the sizes of {filled} images.")
+
+        result = eviction.evict_images(
+            accessed_before=accessed_before,
+            max_bytes=options["max_bytes"],
+            batch_size=options["batch_size"],
+            concurrency=options["concurrency"],
+            dry_run=options["dry_run"],
+        )
+        action = "Would delete" if options["dry_run"] else "Deleted"
+        self.stdout.write(
+            f"{action} {result['images']} images ({result['bytes']} bytes) "
+            f"of {result['total_bytes']} bytes."
+        )
+        if result["unknown_sizes"]:
+            self.stderr.write(
+                f"Warning: {result['unknown_sizes']} images have unknown sizes and "
+                "are not counted toward --max-bytes. Run with --backfill-sizes."
+            )
+        if result["redirect_cached"]:
+            self.stderr.write(
+                f"Warning: {result['redirect_cached']} of the images were accessed "
+                "within API_REDIRECT_MAX_AGE. Cached redirects to them may point to "
+                "missing files."
+            )
+        if result["failed"]:
+            raise CommandError(
+                f"Failed to delete {result['failed']} images from the storage. "
+                "Run the command again to retry."
+            )
@@ -0,0 +1,416 @@
+"""
+キャパシティプランニング用のメトリクス
+
+プロセス内でカウンターとヒストグラムを集計し、Prometheusのテキスト形式で出力する。
+settings.API_METRICS_DIRを指定した場合、各プロセスは集計値をそのディレクトリに
+一定間隔で書き出し、出力時に全プロセスのファイルを合算する (gunicornの複数ワーカー用)。
+終了したプロセスのファイルは、カウンターとヒストグラムのみを合算し、ゲージ (現在値) は
+合算しない (再起動の度に値が増え続けたり、処理中に終了した分が残り続けたりしないように)。
+ディレクトリはワーカーの起動前に空にしておくこと。
+"""
+from __future__ import annotations
+
+import bisect
+import glob
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Callable
+
+from django.conf import settings
+
+from .timing import RequestTimer
+
+METRICS_FILE_PATTERN = re.compile(r"^metrics_(\d+)_(\w+)\.json$")
+
+# Metric types
+########################################################################################
+
+
+class Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: dict[tuple, Any] = {}
+        self.lock = threading.Lock()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.values = {}
+
+    def dump_values(self) -> dict[str, Any]:
+        """
+        ラベルの値をJSON文字列のキーとした、集計値のコピーを返す
+        """
+        with self.lock:
+            return {
+                json.dumps(labelvalues): self.copy_value(value)
+                for labelvalues, value in self.values.items()
+            }
+
+    def copy_value(self, value: Any) -> Any:
+        return value
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    現在値を表すメトリクス (複数プロセスの値は合算して出力する)
+    """
+
+    type_name = "gauge"
+
+    def set(self, value: float, *labelvalues: str) -> None:
+        with self.lock:
+            self.values[labelvalues] = value
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues: str, amount: float = 1) -> None:
+        self.inc(*labelvalues, amount=-amount)
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: list[float],
+        labelnames: tuple = (),
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labelvalues)
+            if state is None:
+                # 各バケットの件数 (累積ではない) と、+Infの件数・合計値
+                state = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+                self.values[labelvalues] = state
+            state["counts"][index] += 1
+            state["sum"] += value
+
+    def copy_value(self, value: Any) -> Any:
+        return {"counts": list(value["counts"]), "sum": value["sum"]}
+
+
+# Registry
+########################################################################################
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.collectors: list[Callable[[], None]] = []
+        self.pid = os.getpid()
+        self.file_id = uuid.uuid4().hex
+        self.last_flush = 0.0
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """
+        集計値の出力・書き出しの直前に呼び出し、現在値をメトリクスに反映する関数を登録する
+        """
+        self.collectors.append(collector)
+
+    def check_fork(self) -> None:
+        """
+        フォーク後の子プロセスでは、親プロセスの集計値を引き継がず別のファイルに書き出す
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.file_id = uuid.uuid4().hex
+            self.last_flush = 0.0
+            for metric in self.metrics.values():
+                metric.reset()
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        self.check_fork()
+        for collector in self.collectors:
+            collector()
+        return {name: metric.dump_values() for name, metric in self.metrics.items()}
+
+    def get_file_path(self, directory: str) -> str:
+        return os.path.join(directory, f"metrics_{self.pid}_{self.file_id}.json")
+
+    def flush(self) -> None:
+        """
+        集計値をsettings.API_METRICS_DIRにアトミックに書き出す
+        """
+        directory = settings.API_METRICS_DIR
+        if directory is None:
+            return
+        snapshot = self.snapshot()
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(temp_path, self.get_file_path(directory))
+        self.last_flush = time.monotonic()
+
+    def maybe_flush(self) -> None:
+        if settings.API_METRICS_DIR is None:
+            return
+        if time.monotonic() - self.last_flush >= settings.API_METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def collect(self) -> dict[str, dict[str, Any]]:
+        """
+        全プロセスの集計値を合算して返す (ディレクトリ未指定の場合は自プロセスのみ)
+        """
+        directory = settings.API_METRICS_DIR
+        if directory is None:
+            return self.snapshot()
+
+        self.flush()
+        own_path = self.get_file_path(directory)
+        merged: dict[str, dict[str, Any]] = {name: {} for name in self.metrics}
+        for path in glob.glob(os.path.join(directory, "metrics_*.json")):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                # 書き出し中に削除されたファイル等は無視する
+                continue
+            alive = path == own_path or is_process_alive(get_file_pid(path))
+            for name, values in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                if isinstance(metric, Gauge) and not alive:
+                    # 終了したプロセスの現在値は合算しない
+                    continue
+                merge_values(merged[name], values)
+        return merged
+
+    def render(self) -> str:
+        """
+        Prometheusのテキスト形式 (version 0.0.4) で全メトリクスを出力する
+        """
+        collected = self.collect()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type_name}")
+            for labels_json, value in sorted(collected.get(name, {}).items()):
+                labels = dict(zip(metric.labelnames, json.loads(labels_json)))
+                if isinstance(metric, Histogram):
+                    lines.extend(render_histogram(name, metric.buckets, labels, value))
+                else:
+                    lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def get_file_pid(path: str) -> int | None:
+    match = METRICS_FILE_PATTERN.match(os.path.basename(path))
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def is_process_alive(pid: int | None) -> bool:
+    """
+    自プロセス以外でpidのプロセスが実行中かどうか
+    (自プロセスのpidは、同じpidで以前に実行していたプロセスのファイルのため終了扱いとする)
+    """
+    if pid is None or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # 他のユーザーのプロセスとして実行中
+        return True
+    return True
+
+
+def merge_values(merged: dict[str, Any], values: dict[str, Any]) -> None:
+    for labels_json, value in values.items():
+        current = merged.get(labels_json)
+        if current is None:
+            merged[labels_json] = value
+        elif isinstance(value, dict):
+            current["counts"] = [
+                a + b for a, b in zip(current["counts"], value["counts"])
+            ]
+            current["sum"] += value["sum"]
+        else:
+            merged[labels_json] = current + value
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels.items():
+        escaped = (
+            str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        )
+        pairs.append(f'{key}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def render_histogram(
+    name: str, buckets: list[float], labels: dict[str, str], value: dict[str, Any]
+) -> list[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(buckets, value["counts"]):
+        cumulative += count
+        bucket_labels = format_labels({**labels, "le": format_value(float(bound))})
+        lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+    cumulative += value["counts"][-1]
+    lines.append(f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {cumulative}")
+    lines.append(f"{name}_sum{format_labels(labels)} {format_value(value['sum'])}")
+    lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    return lines
+
+
+registry = MetricsRegistry()
+
+# Metrics
+########################################################################################
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+SIZE_BUCKETS = [1024, 10 * 1024, 100 * 1024, 1024**2, 10 * 1024**2, 100 * 1024**2]
+# 画素数の区分 (64px四方, 1024px四方, 4096px四方, それ以上)
+PIXEL_BUCKETS = [64 * 64, 1024 * 1024, 4096 * 4096]
+
+request_duration = registry.register(
+    Histogram(
+        "impala_request_duration_seconds",
+        "Latency of /api/get/ requests.",
+        LATENCY_BUCKETS,
+        labelnames=("outcome", "profile_type"),
+    )
+)
+render_duration = registry.register(
+    Histogram(
+        "impala_render_duration_seconds",
+        "Time spent rendering and encoding images.",
+        LATENCY_BUCKETS,
+        labelnames=("pixels",),
+    )
+)
+encoded_size = registry.register(
+    Histogram(
+        "impala_encoded_size_bytes",
+        "Size of encoded images.",
+        SIZE_BUCKETS,
+        labelnames=("profile_type",),
+    )
+)
+ratelimited_requests = registry.register(
+    Counter(
+        "impala_ratelimited_requests_total",
+        "Requests rejected by the rate limiter.",
+    )
+)
+image_url_lookups = registry.register(
+    Counter(
+        "impala_image_url_lookups_total",
+        "Image URL lookups by the tier that answered them.",
+        labelnames=("source",),
+    )
+)
+
+s3_pool_size = registry.register(
+    Gauge(
+        "impala_s3_pool_connections",
+        "Maximum number of pooled connections to S3.",
+    )
+)
+s3_pool_in_use = registry.register(
+    Gauge(
+        "impala_s3_pool_in_use",
+        "S3 API calls currently holding a pooled connection.",
+    )
+)
+s3_pool_saturated = registry.register(
+    Counter(
+        "impala_s3_pool_saturated_total",
+        "S3 API calls started while every pooled connection was in use.",
+    )
+)
+
+render_budget_capacity = registry.register(
+    Gauge(
+        "impala_render_budget_capacity_pixels",
+        "Total pixels that may be rendered at the same time.",
+    )
+)
+render_budget_in_use = registry.register(
+    Gauge(
+        "impala_render_budget_in_use_pixels",
+        "Pixels of the images being rendered.",
+    )
+)
+render_budget_waiting = registry.register(
+    Gauge(
+        "impala_render_budget_waiting",
+        "Renders waiting for the render budget.",
+    )
+)
+render_budget_rejected = registry.register(
+    Counter(
+        "impala_render_budget_rejected_total",
+        "Renders rejected because the render budget stayed full.",
+    )
+)
+
+
+def get_pixel_bucket(pixel_count: int) -> str:
+    for bound in PIXEL_BUCKETS:
+        if pixel_count <= bound:
+            return f"le_{bound}"
+    return f"gt_{PIXEL_BUCKETS[-1]}"
+
+
+def observe_request(timer: RequestTimer) -> None:
+    """
+    GetViewのリクエスト1件分の計測結果をメトリクスに反映する
+    """
+    attributes = timer.attributes
+    outcome = attributes.get("outcome", "error")
+    profile_type = attributes.get("profile_type", "")
+    request_duration.observe(timer.stop(), outcome, profile_type)
+
+    if "url_source" in attributes:
+        image_url_lookups.inc(attributes["url_source"])
+    if "render" in timer.stages:
+        render_duration.observe(
+            timer.stages["render"], get_pixel_bucket(attributes.get("pixel_count", 0))
+        )
+    if "byte_size" in attributes:
+        encoded_size.observe(attributes["byte_size"], profile_type)
+
+    registry.maybe_flush()
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="profile_signiture_digest",
+            field=models.CharField(editable=False, max_length=32, null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+import hashlib
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def backfill_profile_signiture_digest(apps, schema_editor):
+    """
+    既存の行のダイジェストをBATCH_SIZE件ずつ計算して書き込む
+    バッチ毎にコミットされるため、中断しても未処理の行から再開できる
+    """
+    Image = apps.get_model("api", "Image")
+    queryset = Image.objects.filter(profile_signiture_digest__isnull=True).order_by(
+        "pk"
+    )
+    last_pk = 0
+    while True:
+        images = list(
+            queryset.filter(pk__gt=last_pk).only("pk", "profile_signiture")[:BATCH_SIZE]
+        )
+        if not images:
+            break
+        for image in images:
+            image.profile_signiture_digest = hashlib.blake2b(
+                image.profile_signiture.encode("utf-8"), digest_size=16
+            ).hexdigest()
+        Image.objects.bulk_update(images, ["profile_signiture_digest"])
+        last_pk = images[-1].pk
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ("api", "0002_image_profile_signiture_digest"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            backfill_profile_signiture_digest, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0003_backfill_profile_signiture_digest"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="image",
+            name="profile_signiture_digest",
+            field=models.CharField(editable=False, max_length=32, unique=True),
+        ),
+        migrations.AlterField(
+            model_name="image",
+            name="profile_signiture",
+            field=models.TextField(),
+        ),
+    ]
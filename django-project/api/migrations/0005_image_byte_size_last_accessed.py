@@ -0,0 +1,27 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0004_alter_image_profile_signiture"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="byte_size",
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="image",
+            name="last_accessed",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name="image",
+            index=models.Index(
+                fields=["last_accessed", "id"], name="api_image_last_ac_f201e3_idx"
+            ),
+        ),
+    ]
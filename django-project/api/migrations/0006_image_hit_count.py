@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0005_image_byte_size_last_accessed"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="hit_count",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
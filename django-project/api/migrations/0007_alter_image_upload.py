@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+import api.models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0006_image_hit_count"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="image",
+            name="upload",
+            field=models.ImageField(
+                max_length=1024, upload_to=api.models.get_upload_to
+            ),
+        ),
+    ]
@@ -1,12 +1,60 @@
+import hashlib
+import os
+
 from django.db import models
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
+from django.utils import timezone
+
+
+def digest_signiture(signiture: str) -> str:
+    """
+    プロファイルのシグニチャから固定長 (16バイト, 16進数で32文字) のダイジェストを計算する
+    """
+    return hashlib.blake2b(signiture.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def get_sharded_path(digest: str, extension: str) -> str:
+    """
+    ダイジェストの先頭2文字ずつで2階層に分けたパス (ab/cd/<ダイジェスト>.<拡張子>)
+    """
+    return f"{digest[:2]}/{digest[2:4]}/{digest}.{extension}"
+
+
+def get_upload_name(signiture: str, extension: str) -> str:
+    """
+    シグニチャから決まるストレージ上のファイル名 (images/ab/cd/<ダイジェスト>.<拡張子>)
+    同じシグニチャの画像は常に同じ名前となるため、保存時に既存のファイルの確認は不要で、
+    S3では先頭のハッシュ値によって書き込みが複数のプレフィックスに分散する
+    """
+    return "images/" + get_sharded_path(digest_signiture(signiture), extension)
+
+
+def get_upload_to(instance: "Image", filename: str) -> str:
+    extension = os.path.splitext(filename)[1].lstrip(".")
+    return get_upload_name(instance.profile_signiture, extension)
 
 
 # Create your models here.
 class Image(models.Model):
-    upload = models.ImageField(upload_to="images/", max_length=1024)
-    profile_signiture = models.CharField(max_length=255, unique=True)
+    upload = models.ImageField(upload_to=get_upload_to, max_length=1024)
+    # デバッグ用に元のシグニチャ (JSON) も保持し、検索にはダイジェストを用いる
+    profile_signiture = models.TextField()
+    profile_signiture_digest = models.CharField(
+        max_length=32, unique=True, editable=False
+    )
+    # 削除対象の選択に用いる、ファイルサイズ (バイト) と最終利用日時
+    byte_size = models.PositiveBigIntegerField(null=True, blank=True)
+    last_accessed = models.DateTimeField(default=timezone.now)
+    # ヒット数 (利用回数と最終利用日時はapi.access_statsが一定間隔でまとめて更新する)
+    hit_count = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=["last_accessed", "id"])]
+
+    def save(self, *args, **kwargs):
+        self.profile_signiture_digest = digest_signiture(self.profile_signiture)
+        super().save(*args, **kwargs)
 
 
 @receiver(pre_delete, sender=Image)
@@ -0,0 +1,266 @@
+"""
+APIのレート制限
+
+ルート毎に設定した全ての期間 (例: 50/s, 500/m) のカウンターを1回のget_many()で読み込み、
+上限に達した時間枠があればそのまま拒否する。受け付ける場合は時間枠毎にアトミックに
+カウントアップし、他のワーカーと競合して加算後の値が上限を超えた場合は加算を取り消して拒否する。
+キャッシュに無い画像の生成は、リクエスト数とは別に生成コスト (画素数) の上限で制限する。
+キャッシュに問い合わせる前に、プロセス内のトークンバケットで明らかに過剰なリクエストを拒否する。
+"""
+from __future__ import annotations
+
+import math
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import PermissionDenied
+from django.http import HttpRequest
+
+from .image_processing import ImageProfileAbstract
+
+rate_pattern = re.compile(r"(\d+)/(\d*)([smhd])")
+rate_units = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+
+class Ratelimited(PermissionDenied):
+    pass
+
+
+def parse_rate(rate: str) -> tuple[int, int]:
+    """
+    "50/s" や "100/5m" のようなレートを (回数, 期間の秒数) に変換する
+    """
+    match = rate_pattern.fullmatch(rate)
+    if match is None:
+        raise ValueError(f"Invalid rate: {rate}")
+    count, multiplier, unit = match.groups()
+    return int(count), int(multiplier or 1) * rate_units[unit]
+
+
+def get_client_ip(request: HttpRequest) -> str:
+    return request.META.get(settings.API_RATELIMIT_IP_META_KEY) or "unknown"
+
+
+# Prefilter
+########################################################################################
+
+
+class TokenBucketPrefilter:
+    """
+    キー毎のトークンバケットによるプロセス内のレート制限
+    キャッシュの制限よりも緩い値を設定し、明らかに過剰なリクエストだけを通信無しで拒否する
+    保持するキーの数はmax_keysまでとし、古いものから削除する
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+
+prefilter = TokenBucketPrefilter(
+    rate=settings.API_RATELIMIT_PREFILTER["RATE"],
+    burst=settings.API_RATELIMIT_PREFILTER["BURST"],
+)
+
+
+# Rate limiter
+########################################################################################
+
+
+def increment(cache, key: str, delta: int, timeout: int, exists: bool) -> int:
+    """
+    カウンターをdeltaだけカウントアップし、加算後の値を返す
+    存在しないカウンターはadd()で作成するため、他のワーカーの加算を上書きしない
+    """
+    if not exists and cache.add(key, delta, timeout):
+        return delta
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # 読み込んだ後にカウンターが失効した
+        if cache.add(key, delta, timeout):
+            return delta
+        return cache.incr(key, delta)
+
+
+def decrement(cache, key: str, delta: int) -> None:
+    try:
+        cache.decr(key, delta)
+    except ValueError:
+        # 加算後にカウンターが失効した場合は戻す必要が無い
+        pass
+
+
+def is_exceeded(count: int, cost: int, limit: int) -> bool:
+    """
+    カウンターの値がcountの時間枠にcostを加算すると上限を超えるかどうか
+    時間枠のカウンターが0の場合は、上限を超えるコストでも1回だけ受け付ける
+    """
+    return count + cost > limit and count > 0
+
+
+def consume(cache, windows: dict[str, int], cost: int, timeout: int) -> set[str]:
+    """
+    全ての時間枠のカウンターにcostを加算し、上限を超えた時間枠のキーを返す
+    キャッシュへの通信は、get_many()で全ての時間枠を読み込む1回と、
+    受け付ける場合の時間枠毎の加算 (incr()、カウンターが無い場合はadd()) の1回ずつ
+    読み込んだ値で既に上限を超える場合は、加算せずに拒否する
+    他のワーカーの加算と競合して加算後の値が上限を超えた場合は、全ての加算を取り消す
+    (時間枠毎にdecr()を1回ずつ)
+    """
+    counts = cache.get_many(list(windows))
+    exceeded = {
+        key
+        for key, limit in windows.items()
+        if is_exceeded(counts.get(key, 0), cost, limit)
+    }
+    if exceeded:
+        return exceeded
+
+    # 時間枠毎にキーが変わるため、有効期限は最長の期間に揃える
+    totals = {
+        key: increment(cache, key, cost, timeout, key in counts) for key in windows
+    }
+    exceeded = {
+        key
+        for key, limit in windows.items()
+        if is_exceeded(totals[key] - cost, cost, limit)
+    }
+    if exceeded:
+        for key in windows:
+            decrement(cache, key, cost)
+    return exceeded
+
+
+def get_cache():
+    return caches[settings.API_RATELIMIT_CACHE_ALIAS]
+
+
+class RateLimiter:
+    def __init__(self, route: str, rates: list[str]):
+        self.route = route
+        self.limits = [parse_rate(rate) for rate in rates]
+        self.max_period = max([period for _, period in self.limits], default=0)
+
+    def get_windows(self, client_key: str, now: float) -> dict[str, int]:
+        """
+        各期間の現在の時間枠のカウンターのキーと、その上限を返す
+        """
+        return {
+            f"api:ratelimit:{self.route}:{client_key}:{period}:{int(now // period)}": (
+                limit
+            )
+            for limit, period in self.limits
+        }
+
+    def is_limited(self, request: HttpRequest) -> bool:
+        """
+        リクエストが制限を超えていればTrueを返し、超えていなければカウントアップする
+        """
+        if not settings.API_RATELIMIT_ENABLE or not self.limits:
+            return False
+
+        client_key = get_client_ip(request)
+        if not prefilter.allow(client_key):
+            return True
+
+        windows = self.get_windows(client_key, time.time())
+        return bool(consume(get_cache(), windows, 1, self.max_period))
+
+
+class RenderCostLimiter:
+    """
+    画像の生成コスト (画素数 × 形式毎の係数) によるレート制限
+    クライアント毎の上限と、ノード (ホスト) 全体の上限をまとめて確認する
+    """
+
+    def __init__(self, route: str, client_rates: list[str], node_rates: list[str]):
+        self.client_limiter = RateLimiter(f"{route}:render", client_rates)
+        self.node_limiter = RateLimiter(f"{route}:render", node_rates)
+        self.node_key = f"node:{socket.gethostname()}"
+
+    def charge(self, request: HttpRequest, profile: ImageProfileAbstract) -> str | None:
+        """
+        プロファイルの生成コストを加算できた場合はNoneを返す
+        上限を超える場合は、超えた上限に応じて"client"または"node"を返す
+        """
+        if not settings.API_RATELIMIT_ENABLE:
+            return None
+
+        now = time.time()
+        client_windows = self.client_limiter.get_windows(get_client_ip(request), now)
+        node_windows = self.node_limiter.get_windows(self.node_key, now)
+        if not client_windows and not node_windows:
+            return None
+
+        timeout = max(self.client_limiter.max_period, self.node_limiter.max_period)
+        exceeded = consume(
+            get_cache(),
+            {**client_windows, **node_windows},
+            get_render_cost(profile),
+            timeout,
+        )
+        if not exceeded:
+            return None
+        return "client" if exceeded & client_windows.keys() else "node"
+
+
+def get_render_cost(profile: ImageProfileAbstract) -> int:
+    factor = settings.API_RENDER_COST_FORMAT_FACTORS.get(profile.get_extension(), 1)
+    return max(1, math.ceil(profile.pixel_count * factor))
+
+
+_rate_limiters: dict[tuple[str, tuple[str, ...]], RateLimiter] = {}
+_render_cost_limiters: dict[tuple, RenderCostLimiter] = {}
+
+
+def get_rate_limiter(route: str) -> RateLimiter:
+    """
+    settings.API_RATELIMITSに設定されたルートのレートでRateLimiterを返す
+    """
+    rates = tuple(settings.API_RATELIMITS.get(route, ()))
+    limiter = _rate_limiters.get((route, rates))
+    if limiter is None:
+        limiter = RateLimiter(route, list(rates))
+        _rate_limiters[(route, rates)] = limiter
+    return limiter
+
+
+def get_render_cost_limiter(route: str) -> RenderCostLimiter:
+    """
+    settings.API_RENDER_QUOTAS, API_NODE_RENDER_QUOTASに設定されたルートの上限で
+    RenderCostLimiterを返す
+    """
+    client_rates = tuple(settings.API_RENDER_QUOTAS.get(route, ()))
+    node_rates = tuple(settings.API_NODE_RENDER_QUOTAS.get(route, ()))
+    cache_key = (route, client_rates, node_rates)
+    limiter = _render_cost_limiters.get(cache_key)
+    if limiter is None:
+        limiter = RenderCostLimiter(route, list(client_rates), list(node_rates))
+        _render_cost_limiters[cache_key] = limiter
+    return limiter
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import io
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from tempfile import SpooledTemporaryFile
+from typing import IO
+
+import django
+from django.conf import settings
+
+from .image_processing import ImageProfileAbstract
+
+logger = logging.getLogger(__name__)
+
+# Helper functions
+########################################################################################
+
+
+def get_shared_memory_dir() -> str | None:
+    """
+    tmpfs上の共有メモリ領域があればそのディレクトリを返す (無ければ通常の一時ディレクトリ)
+    """
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return None
+
+
+def render_image_to_file(profile: ImageProfileAbstract, temp_dir: str | None) -> str:
+    """
+    ワーカープロセスで画像をエンコードして一時ファイルに書き込み、そのパスを返す
+    エンコード済みのデータはpickleせず、ファイル (共有メモリ) 経由で親プロセスに渡す
+    """
+    with tempfile.NamedTemporaryFile(
+        dir=temp_dir,
+        prefix="impala-render-",
+        suffix=f".{profile.get_extension()}",
+        delete=False,
+    ) as f:
+        try:
+            profile.save_image(f)
+        except Exception:
+            os.unlink(f.name)
+            raise
+        return f.name
+
+
+def noop() -> None:
+    pass
+
+
+# Spooled file
+########################################################################################
+
+
+class SpooledImageFile(SpooledTemporaryFile):
+    """
+    メモリ上に書き込み、max_sizeを超えた場合にのみディスクへ書き出す一時ファイル。
+    Pillowは保存先のfileno()が使える場合にファイルディスクリプタへ直接書き込むため、
+    メモリ上にある間はfileno()を使えないようにしてディスクへの書き出しを防ぐ。
+    """
+
+    def fileno(self) -> int:
+        if not self._rolled:
+            raise io.UnsupportedOperation("fileno")
+        return super().fileno()
+
+
+# Render backends
+########################################################################################
+
+
+class RenderBackendAbstract(ABC):
+    @abstractmethod
+    def create_image_file(self, profile: ImageProfileAbstract) -> IO[bytes]:
+        """
+        画像をエンコードし、先頭にシーク済みのファイルオブジェクトを返す
+        返されたファイルオブジェクトは呼び出し側でcloseする必要がある
+        """
+        raise NotImplementedError()
+
+    def warm_up_in_background(self) -> None:
+        """
+        ワーカープロセスの起動時に呼び出され、リクエストの受付前の準備をバックグラウンドで始める
+        """
+        pass
+
+    def write_image(self, profile: ImageProfileAbstract, fp: IO[bytes]) -> None:
+        """
+        画像をエンコードしてfpに書き込む
+        既定ではcreate_image_file()で生成したファイルをfpにコピーする
+        """
+        with self.create_image_file(profile) as image_file:
+            shutil.copyfileobj(image_file, fp)
+
+
+class InProcessRenderBackend(RenderBackendAbstract):
+    """
+    リクエストを処理しているスレッドで画像をエンコードするバックエンド
+    エンコード後のサイズがsettings.IMAGE_SPOOL_MAX_SIZEを超えた場合のみディスクに書き出す
+    """
+
+    def create_image_file(self, profile: ImageProfileAbstract) -> IO[bytes]:
+        image_file = SpooledImageFile(max_size=settings.IMAGE_SPOOL_MAX_SIZE)
+        try:
+            profile.save_image(image_file)
+        except Exception:
+            image_file.close()
+            raise
+
+        image_file.seek(0)
+        return image_file
+
+    def write_image(self, profile: ImageProfileAbstract, fp: IO[bytes]) -> None:
+        """
+        エンコードしながらfpに書き込む (一時ファイルを経由しない)
+        """
+        profile.save_image(fp)
+
+
+class ProcessPoolRenderBackend(RenderBackendAbstract):
+    """
+    画素数がpixel_threshold以上の画像を、事前に起動したプロセスプールでエンコードするバックエンド
+    大きな画像のエンコードによるメモリ使用量の急増をワーカープロセスに隔離し、
+    全てのCPUコアを利用する。それより小さな画像はプロセス内でエンコードする。
+    ワーカープロセスが異常終了 (メモリ不足による強制終了等) した場合は、プールを作り直す。
+    """
+
+    def __init__(
+        self,
+        pixel_threshold: int = 4096 * 4096,
+        max_workers: int | None = None,
+        temp_dir: str | None = None,
+        prefork: bool = True,
+    ):
+        self.pixel_threshold = pixel_threshold
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.temp_dir = temp_dir if temp_dir is not None else get_shared_memory_dir()
+        self.in_process_backend = InProcessRenderBackend()
+        self._executor: ProcessPoolExecutor | None = None
+        self._pid = os.getpid()
+        self.prefork = prefork
+        self._lock = threading.Lock()
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pid != os.getpid():
+                # フォーク後の子プロセスでは、親プロセスのプールを使わない
+                self._pid = os.getpid()
+                self._executor = None
+            if self._executor is None:
+                # スレッドを持つWebワーカーからforkしないよう、forkserverで起動する
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("forkserver"),
+                    initializer=django.setup,
+                )
+            return self._executor
+
+    def discard_executor(self, executor: ProcessPoolExecutor) -> None:
+        """
+        壊れたプールを破棄し、次回のget_executor()で作り直す
+        他のスレッドが既に作り直している場合は何もしない
+        """
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def warm_up(self) -> None:
+        """
+        ワーカープロセスを起動し、Djangoの初期化を済ませておく
+        """
+        executor = self.get_executor()
+        futures = [executor.submit(noop) for _ in range(self.max_workers)]
+        for future in futures:
+            future.result()
+
+    def warm_up_in_background(self) -> None:
+        """
+        prefork=Trueの場合、このプロセスのプールを起動しておく
+        ワーカープロセスの起動とDjangoの初期化は時間がかかるため、待たずに返す
+        """
+        if not self.prefork:
+            return
+        threading.Thread(
+            target=self._warm_up_or_log,
+            name="impala-render-warm-up",
+            daemon=True,
+        ).start()
+
+    def _warm_up_or_log(self) -> None:
+        try:
+            self.warm_up()
+        except Exception:
+            logger.warning("Failed to warm up the render process pool.", exc_info=True)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def render_in_pool(self, profile: ImageProfileAbstract) -> str:
+        """
+        プロセスプールで画像をエンコードし、一時ファイルのパスを返す
+        プールが壊れていた場合は作り直して1回だけ再試行し、再度壊れた場合は
+        BrokenProcessPool例外が発生する
+        """
+        executor = self.get_executor()
+        try:
+            return executor.submit(
+                render_image_to_file, profile, self.temp_dir
+            ).result()
+        except BrokenProcessPool:
+            logger.warning("Render process pool is broken. Recreating it.")
+            self.discard_executor(executor)
+
+        executor = self.get_executor()
+        try:
+            return executor.submit(
+                render_image_to_file, profile, self.temp_dir
+            ).result()
+        except BrokenProcessPool:
+            self.discard_executor(executor)
+            raise
+
+    def create_image_file(self, profile: ImageProfileAbstract) -> IO[bytes]:
+        if profile.pixel_count < self.pixel_threshold:
+            return self.in_process_backend.create_image_file(profile)
+
+        image_path = self.render_in_pool(profile)
+        image_file = open(image_path, "rb")
+        # 開いたファイルは削除後も読み込めるため、ここで削除して後始末を不要にする
+        os.unlink(image_path)
+        return image_file
+
+    def write_image(self, profile: ImageProfileAbstract, fp: IO[bytes]) -> None:
+        """
+        小さな画像はエンコードしながらfpに書き込み、大きな画像はプロセスプールで
+        エンコードした一時ファイルをfpにコピーする
+        """
+        if profile.pixel_count < self.pixel_threshold:
+            self.in_process_backend.write_image(profile, fp)
+        else:
+            super().write_image(profile, fp)
@@ -1,20 +1,308 @@
 from __future__ import annotations
 
 import os
+import threading
+import time
+import uuid
 from abc import ABC, abstractmethod
-from typing import Type
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import IO, Any, Callable, Iterator, Type
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.memcached import PyLibMCCache
 from django.core.files import File
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
 from django.http import QueryDict
+from django.utils.module_loading import import_string
+from storages.backends.s3boto3 import S3Boto3Storage
+from storages.utils import clean_name
 
-from . import models
+from . import metrics, models, storage_backends, timing
 from .image_processing import (
     ImageProfileAbstract,
     ImageProfileForm,
     JPEGPlainProfileForm,
     PNGPlainProfileForm,
+    ProfileQueryParser,
     QueryError,
 )
+from .render_backends import RenderBackendAbstract, SpooledImageFile
+from .uploads import MultipartUploadWriter
+
+
+class RenderBudgetExceeded(Exception):
+    def __init__(self, retry_after: int):
+        self.retry_after = retry_after
+
+
+def get_image_url_cache_key(signiture: str) -> str:
+    """
+    プロファイルのシグニチャから画像URLキャッシュのキーを生成する
+    シグニチャはmemcachedのキー長制限を超え得るため、ダイジェストをキーに用いる
+    """
+    return f"api:image_url:{models.digest_signiture(signiture)}"
+
+
+class LRUCache:
+    """
+    プロセス内で利用する、スレッドセーフな件数上限・有効期限付きのLRUキャッシュ
+    ヒット数・ミス数を記録する
+    """
+
+    def __init__(self, max_size: int, timeout: float):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+
+            expires_at, value = item
+            if expires_at <= now:
+                del self._data[key]
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        if self.max_size <= 0:
+            return
+        expires_at = time.monotonic() + self.timeout
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class SingleFlight:
+    """
+    同じキーの処理が複数のスレッドから同時に要求された場合に、
+    最初のスレッドだけが処理を実行し、他のスレッドはその結果 (または例外) を共有する
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result: Any = None
+            self.error: BaseException | None = None
+
+    def __init__(self):
+        self._calls: dict[str, SingleFlight.Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if call is None:
+                call = self.Call()
+                self._calls[key] = call
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+
+def delete_if_equal(cache, key: str, value: Any, timeout: float) -> bool:
+    """
+    keyの値がvalueの場合のみ削除し、削除したかどうかを返す
+    pylibmc (casの動作を有効にした場合) では、gets()/cas()で値を他のワーカーが取得できない
+    値に置き換えてから削除するため、確認から削除までの間に失効して他のワーカーが
+    取得した値を削除しない (置き換えた値は、削除に失敗した場合もtimeout秒で失効する)
+    それ以外のキャッシュでは確認と削除がアトミックではないため、この間の失効に注意すること
+    """
+    if isinstance(cache, PyLibMCCache) and cache._cache.behaviors.get("cas"):
+        client = cache._cache
+        key = cache.make_and_validate_key(key)
+        current, cas_id = client.gets(key)
+        if current != value or not client.cas(key, "", cas_id, int(timeout)):
+            return False
+        client.delete(key)
+        return True
+
+    if cache.get(key) != value:
+        return False
+    cache.delete(key)
+    return True
+
+
+class RenderLease:
+    """
+    キャッシュのadd()を利用した、プロセスやホストを跨いで共有される画像生成のリース
+    同じシグニチャの画像はリースを取得したワーカーだけが生成・アップロードする
+    リースは有効期限付きのため、保持しているワーカーが異常終了しても他のワーカーが引き継げる
+    """
+
+    def __init__(self, signiture: str):
+        self.key = f"api:render_lease:{models.digest_signiture(signiture)}"
+        self.token = uuid.uuid4().hex
+        self.acquired = False
+
+    @classmethod
+    def get_cache(cls):
+        return caches[settings.IMAGE_URL_CACHE_ALIAS]
+
+    def acquire(self) -> bool:
+        self.acquired = self.get_cache().add(
+            self.key, self.token, settings.IMAGE_RENDER_LEASE_TIMEOUT
+        )
+        return self.acquired
+
+    def release(self) -> None:
+        """
+        自分が保持しているリースのみを削除する
+        pylibmc以外のキャッシュでは、確認と削除の間にリースが失効して他のワーカーが
+        取得した場合にそのリースを削除してしまうため、有効期限は生成とアップロードに
+        かかる最長の時間よりも十分に長くすること
+        """
+        if self.acquired:
+            delete_if_equal(
+                self.get_cache(),
+                self.key,
+                self.token,
+                settings.IMAGE_RENDER_LEASE_TIMEOUT,
+            )
+        self.acquired = False
+
+    def acquire_or_wait(self, lookup: Callable[[], str | None]) -> str | None:
+        """
+        リースを取得できた場合はNoneを返す
+        他のワーカーがリースを保持している場合は、lookup()が画像URLを返すまで
+        間隔を延ばしながら待ち、そのURLを返す
+        待機中にリースが失効した場合はリースを引き継いでNoneを返す
+        待機がタイムアウトした場合は、リース無しで生成させるためにNoneを返す
+        """
+        deadline = time.monotonic() + settings.IMAGE_RENDER_LEASE_WAIT_TIMEOUT
+        interval = settings.IMAGE_RENDER_LEASE_POLL_INTERVAL
+        waited = False
+        while not self.acquire():
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(interval)
+            interval = min(interval * 2, settings.IMAGE_RENDER_LEASE_POLL_MAX_INTERVAL)
+            waited = True
+
+            image_url = lookup()
+            if image_url is not None:
+                return image_url
+
+        if waited:
+            # 最後の確認の後に保持者が画像を登録してリースを解放した場合は、
+            # 引き継いだリースを解放して重複して生成しない
+            image_url = lookup()
+            if image_url is not None:
+                self.release()
+                return image_url
+        return None
+
+
+class RenderBudget:
+    """
+    プロセス内で同時に生成中の画像の画素数の合計を上限以下に保つ重み付きセマフォ
+    上限を超える場合は空きが出るまで待ち、timeout秒以内に空かなければ
+    RenderBudgetExceeded例外を発生させる
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_use = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, weight: int, timeout: float) -> int:
+        """
+        確保した重みを返す (上限を超える1件の要求は、他に生成中の画像が無ければ受け付ける)
+        """
+        weight = min(weight, self.capacity)
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self.waiting += 1
+            try:
+                while self.in_use + weight > self.capacity:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        metrics.render_budget_rejected.inc()
+                        raise RenderBudgetExceeded(
+                            retry_after=settings.IMAGE_RENDER_BUDGET_RETRY_AFTER
+                        )
+                    self._condition.wait(remaining)
+                self.in_use += weight
+            finally:
+                self.waiting -= 1
+        return weight
+
+    def release(self, weight: int) -> None:
+        with self._condition:
+            self.in_use -= weight
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, weight: int, timeout: float) -> Iterator[None]:
+        with timing.Stage("render_wait"):
+            acquired_weight = self.acquire(weight, timeout)
+        try:
+            yield
+        finally:
+            self.release(acquired_weight)
+
+    def snapshot(self) -> dict[str, int]:
+        with self._condition:
+            return {
+                "capacity": self.capacity,
+                "in_use": self.in_use,
+                "waiting": self.waiting,
+                "rejected": self.rejected,
+            }
 
 
 class ImageProcessingServiceAbstract(ABC):
@@ -23,17 +311,38 @@ class ImageProcessingServiceAbstract(ABC):
     def create_profile(cls, querydict: QueryDict) -> ImageProfileAbstract:
         raise NotImplementedError()
 
+    @classmethod
+    @abstractmethod
+    def create_canonical_profile(
+        cls, querydict: QueryDict
+    ) -> tuple[ImageProfileAbstract, str]:
+        raise NotImplementedError()
+
     @classmethod
     @abstractmethod
     def create_image(cls, profile: ImageProfileAbstract, base_dir: str) -> str:
         raise NotImplementedError()
 
+    @classmethod
+    @abstractmethod
+    def create_image_file(cls, profile: ImageProfileAbstract) -> IO[bytes]:
+        raise NotImplementedError()
+
+    @classmethod
+    @abstractmethod
+    def write_image(cls, profile: ImageProfileAbstract, fp: IO[bytes]) -> None:
+        raise NotImplementedError()
+
 
 class ImageProcessingService(ImageProcessingServiceAbstract):
     form_classes: list[Type[ImageProfileForm]] = [
         JPEGPlainProfileForm,
         PNGPlainProfileForm,
     ]
+    query_parsers: dict[Type[ImageProfileForm], ProfileQueryParser] = {}
+    render_backend: RenderBackendAbstract | None = None
+    # 同時に生成する画像の画素数の合計の上限 (大きな画像の同時生成によるメモリ不足を防ぐ)
+    render_budget = RenderBudget(capacity=settings.IMAGE_RENDER_BUDGET_PIXELS)
 
     @classmethod
     def route_querydict(cls, querydict: QueryDict) -> ImageProfileForm:
@@ -57,29 +366,145 @@ class ImageProcessingService(ImageProcessingServiceAbstract):
 
         raise QueryError({"profile_type": [error_message]})
 
+    @classmethod
+    def get_query_parser(cls, profile_type: str | None) -> ProfileQueryParser | None:
+        """
+        profile_typeに対応するフォームから生成したパーサーを返す
+        パーサーはフォームクラス毎に初回呼び出し時に生成して使い回す
+        """
+        for form_class in cls.form_classes:
+            if profile_type == form_class.get_profile_type():
+                parser = cls.query_parsers.get(form_class)
+                if parser is None:
+                    parser = ProfileQueryParser(form_class)
+                    cls.query_parsers[form_class] = parser
+                return parser
+        return None
+
     @classmethod
     def create_profile(cls, querydict: QueryDict) -> ImageProfileAbstract:
+        parser = cls.get_query_parser(querydict.get("profile_type", None))
+        if parser is not None:
+            return parser.parse(querydict)
+
+        # profile_typeが不正な場合のエラーはroute_querydict()で生成する
         profile_form = cls.route_querydict(querydict)
         if profile_form.is_valid():
             return profile_form.get_profile()
         else:
             raise QueryError(dict(profile_form.errors))
 
+    @classmethod
+    def create_canonical_profile(
+        cls, querydict: QueryDict
+    ) -> tuple[ImageProfileAbstract, str]:
+        """
+        プロファイルと、同じ画像を表す正規のクエリ文字列を返す
+        """
+        parser = cls.get_query_parser(querydict.get("profile_type", None))
+        if parser is not None:
+            return parser.parse_canonical(querydict)
+
+        profile_form = cls.route_querydict(querydict)
+        return profile_form.get_profile(), profile_form.get_query_string()
+
     @classmethod
     def create_image(cls, profile: ImageProfileAbstract, base_dir: str) -> str:
-        pil_image = profile.create_pil_image()
         if os.path.isdir(base_dir):
             tmp_image_path = os.path.join(base_dir, f"tmp.{profile.get_extension()}")
         else:
             raise FileNotFoundError(f"No such directory. base_dir: {base_dir}")
 
-        if profile.quality is None:
-            pil_image.save(tmp_image_path)
-        else:
-            pil_image.save(tmp_image_path, quality=profile.quality)
+        with open(tmp_image_path, "wb") as f:
+            profile.save_image(f)
 
         return tmp_image_path
 
+    @classmethod
+    def get_render_backend(cls) -> RenderBackendAbstract:
+        """
+        settings.IMAGE_RENDER_BACKENDで指定されたバックエンドを初回呼び出し時に生成する
+        """
+        if cls.render_backend is None:
+            backend_class = import_string(settings.IMAGE_RENDER_BACKEND["BACKEND"])
+            cls.render_backend = backend_class(
+                **settings.IMAGE_RENDER_BACKEND.get("OPTIONS", {})
+            )
+        return cls.render_backend
+
+    @classmethod
+    def create_image_file(cls, profile: ImageProfileAbstract) -> IO[bytes]:
+        """
+        画像をエンコードし、先頭にシーク済みのファイルオブジェクトを返す
+        エンコードはsettings.IMAGE_RENDER_BACKENDで指定されたバックエンドで行う
+        生成中の画素数の合計が上限を超える場合と、バックエンドのプロセスプールが
+        再試行しても使えない場合は、RenderBudgetExceeded例外が発生する
+        返されるファイルオブジェクトは呼び出し側でcloseする必要がある
+        """
+        timing.record(pixel_count=profile.pixel_count)
+        with cls.render_budget.reserve(
+            profile.pixel_count, settings.IMAGE_RENDER_BUDGET_TIMEOUT
+        ):
+            with timing.Stage("render"), cls.broken_pool_as_busy():
+                image_file = cls.get_render_backend().create_image_file(profile)
+
+        image_file.seek(0, os.SEEK_END)
+        timing.record(byte_size=image_file.tell())
+        image_file.seek(0)
+        return image_file
+
+    @classmethod
+    def write_image(cls, profile: ImageProfileAbstract, fp: IO[bytes]) -> None:
+        """
+        create_image_file()と同じ上限の下で、画像をエンコードしてfpに書き込む
+        エンコードはsettings.IMAGE_RENDER_BACKENDで指定されたバックエンドで行い、
+        プロセス内でエンコードする場合はエンコードしながら書き込む
+        """
+        timing.record(pixel_count=profile.pixel_count)
+        with cls.render_budget.reserve(
+            profile.pixel_count, settings.IMAGE_RENDER_BUDGET_TIMEOUT
+        ):
+            with timing.Stage("render"), cls.broken_pool_as_busy():
+                cls.get_render_backend().write_image(profile, fp)
+
+    @classmethod
+    @contextmanager
+    def broken_pool_as_busy(cls) -> Iterator[None]:
+        """
+        バックエンドのプロセスプールが再試行しても使えない場合は、503とするため
+        RenderBudgetExceeded例外に変換する
+        """
+        try:
+            yield
+        except BrokenProcessPool:
+            raise RenderBudgetExceeded(
+                retry_after=settings.IMAGE_RENDER_BUDGET_RETRY_AFTER
+            )
+
+
+def warm_up_worker() -> None:
+    """
+    レンダーバックエンド (プロセスプール) とS3のコネクションをリクエストの受付前に準備する
+    いずれもバックグラウンドで起動し、ワーカーの起動は待たせない
+    フォークした子プロセスは親プロセスのプールやコネクションを使わないため、
+    フォーク後の子プロセスでも呼び出す (impala/wsgi.py, impala/asgi.py)
+    """
+    ImageProcessingService.get_render_backend().warm_up_in_background()
+    storage_backends.warm_up_default_storage()
+
+
+def collect_render_budget_metrics() -> None:
+    """
+    生成中の画素数の合計等を、/api/metrics/ の出力前にメトリクスに反映する
+    """
+    snapshot = ImageProcessingService.render_budget.snapshot()
+    metrics.render_budget_capacity.set(snapshot["capacity"])
+    metrics.render_budget_in_use.set(snapshot["in_use"])
+    metrics.render_budget_waiting.set(snapshot["waiting"])
+
+
+metrics.registry.add_collector(collect_render_budget_metrics)
+
 
 class ImageModelServiceAbstract(ABC):
     @classmethod
@@ -87,28 +512,221 @@ class ImageModelServiceAbstract(ABC):
     def get_cache_image_url(cls, profile: ImageProfileAbstract) -> str | None:
         raise NotImplementedError()
 
+    @classmethod
+    async def aget_cache_image_url(cls, profile: ImageProfileAbstract) -> str | None:
+        return await sync_to_async(cls.get_cache_image_url)(profile)
+
     @classmethod
     @abstractmethod
     def upload_image(cls, image_path: str, profile: ImageProfileAbstract) -> str:
         raise NotImplementedError()
 
+    @classmethod
+    @abstractmethod
+    def upload_image_file(
+        cls, image_file: IO[bytes], profile: ImageProfileAbstract
+    ) -> str:
+        raise NotImplementedError()
+
+    @classmethod
+    def stream_upload_image(
+        cls, profile: ImageProfileAbstract, write_image: Callable[[IO[bytes]], None]
+    ) -> str:
+        """
+        write_image()が書き込んだ画像をアップロードしてURLを返す
+        エンコードと並行してアップロードできないストレージでは、書き込み後にアップロードする
+        """
+        with SpooledImageFile(max_size=settings.IMAGE_SPOOL_MAX_SIZE) as image_file:
+            write_image(image_file)
+            image_file.seek(0)
+            return cls.upload_image_file(image_file, profile)
+
 
 class ImageModelService(ImageModelServiceAbstract):
     model = models.Image
+    # 人気のあるシグニチャの画像URLをプロセス内に保持し、ネットワーク通信無しで返す
+    # 他プロセスでの削除は検知できないため、有効期限は短めに設定する
+    url_lru = LRUCache(
+        max_size=settings.IMAGE_URL_LRU_MAX_SIZE,
+        timeout=settings.IMAGE_URL_LRU_TIMEOUT,
+    )
+
+    @classmethod
+    def get_url_cache(cls):
+        return caches[settings.IMAGE_URL_CACHE_ALIAS]
 
     @classmethod
     def get_cache_image_url(cls, profile: ImageProfileAbstract) -> str | None:
-        queryset = cls.model.objects.filter(profile_signiture=profile.dump_signiture())
-        if queryset.exists():
-            return queryset.first().upload.url
-        else:
+        """
+        シグニチャに対応する画像URLを、プロセス内LRU → キャッシュ → データベースの順に探す
+        データベースは1回だけ参照し、見つかった結果を上位のキャッシュに書き込む
+        """
+        signiture = profile.dump_signiture()
+        image_url = cls.url_lru.get(signiture)
+        if image_url is not None:
+            timing.record(url_source="lru")
+            return image_url
+
+        cache_key = get_image_url_cache_key(signiture)
+        url_cache = cls.get_url_cache()
+
+        with timing.Stage("cache"):
+            image_url = url_cache.get(cache_key)
+        if image_url is not None:
+            timing.record(url_source="cache")
+            cls.url_lru.set(signiture, image_url)
+            return image_url
+
+        with timing.Stage("db"):
+            upload_name = (
+                cls.model.objects.filter(
+                    profile_signiture_digest=models.digest_signiture(signiture)
+                )
+                .values_list("upload", flat=True)
+                .first()
+            )
+        if upload_name is None:
+            timing.record(url_source="none")
             return None
 
+        timing.record(url_source="db")
+        image_url = cls.model._meta.get_field("upload").storage.url(upload_name)
+        url_cache.set(cache_key, image_url, settings.IMAGE_URL_CACHE_TIMEOUT)
+        cls.url_lru.set(signiture, image_url)
+        return image_url
+
+    @classmethod
+    async def aget_cache_image_url(cls, profile: ImageProfileAbstract) -> str | None:
+        """
+        get_cache_image_url()の非同期版
+        キャッシュとデータベースへの問い合わせをイベントループをブロックせずに行う
+        """
+        signiture = profile.dump_signiture()
+        image_url = cls.url_lru.get(signiture)
+        if image_url is not None:
+            timing.record(url_source="lru")
+            return image_url
+
+        cache_key = get_image_url_cache_key(signiture)
+        url_cache = cls.get_url_cache()
+
+        with timing.Stage("cache"):
+            image_url = await url_cache.aget(cache_key)
+        if image_url is not None:
+            timing.record(url_source="cache")
+            cls.url_lru.set(signiture, image_url)
+            return image_url
+
+        with timing.Stage("db"):
+            upload_name = (
+                await cls.model.objects.filter(
+                    profile_signiture_digest=models.digest_signiture(signiture)
+                )
+                .values_list("upload", flat=True)
+                .afirst()
+            )
+        if upload_name is None:
+            timing.record(url_source="none")
+            return None
+
+        timing.record(url_source="db")
+        image_url = cls.model._meta.get_field("upload").storage.url(upload_name)
+        await url_cache.aset(cache_key, image_url, settings.IMAGE_URL_CACHE_TIMEOUT)
+        cls.url_lru.set(signiture, image_url)
+        return image_url
+
     @classmethod
     def upload_image(cls, image_path: str, profile: ImageProfileAbstract) -> str:
         with open(image_path, "rb") as f:
-            upload_file = File(f, name=profile.upload_file_name)
+            return cls.upload_image_file(f, profile)
+
+    @classmethod
+    def upload_image_file(
+        cls, image_file: IO[bytes], profile: ImageProfileAbstract
+    ) -> str:
+        upload_file = File(image_file, name=profile.upload_file_name)
+        field = cls.model._meta.get_field("upload")
+        image = cls.model(
+            profile_signiture=profile.dump_signiture(), byte_size=upload_file.size
+        )
+        with timing.Stage("upload"):
+            image.upload = storage_backends.save_overwrite(
+                field.storage,
+                field.generate_filename(image, upload_file.name),
+                upload_file,
+            )
+            image.save(force_insert=True)
+        return cls.cache_uploaded_image_url(image)
+
+    @classmethod
+    def stream_upload_image(
+        cls, profile: ImageProfileAbstract, write_image: Callable[[IO[bytes]], None]
+    ) -> str:
+        """
+        S3の場合は、write_image()の書き込みと並行してマルチパートアップロードで送信する
+        settings.IMAGE_MULTIPART_UPLOADに送信するパートのサイズと並行数を指定する
+        """
+        field = cls.model._meta.get_field("upload")
+        storage = field.storage
+        if not isinstance(storage, S3Boto3Storage):
+            return super().stream_upload_image(profile, write_image)
+
+        signiture = profile.dump_signiture()
+        # シグニチャから決まる名前のため、既存のファイルの確認はせずに上書きする
+        name = field.generate_filename(
+            cls.model(profile_signiture=signiture), profile.upload_file_name
+        )
+        config = settings.IMAGE_MULTIPART_UPLOAD
+        writer = MultipartUploadWriter(
+            storage.connection.meta.client,
+            storage.bucket_name,
+            storage._normalize_name(clean_name(name)),
+            part_size=config["PART_SIZE"],
+            max_concurrency=config["MAX_CONCURRENCY"],
+            max_queued_parts=config["MAX_QUEUED_PARTS"],
+            extra_args=storage._get_write_parameters(name),
+        )
+        with writer:
+            write_image(writer)
+        timing.record(byte_size=writer.size)
+
+        with timing.Stage("upload"):
             image = cls.model.objects.create(
-                upload=upload_file, profile_signiture=profile.dump_signiture()
+                upload=name,
+                profile_signiture=signiture,
+                byte_size=writer.size,
             )
-            return image.upload.url
+        return cls.cache_uploaded_image_url(image)
+
+    @classmethod
+    def cache_uploaded_image_url(cls, image: models.Image) -> str:
+        image_url = image.upload.url
+        signiture = image.profile_signiture
+        cls.get_url_cache().set(
+            get_image_url_cache_key(signiture),
+            image_url,
+            settings.IMAGE_URL_CACHE_TIMEOUT,
+        )
+        cls.url_lru.set(signiture, image_url)
+        return image_url
+
+    @classmethod
+    def evict_cache_image_url(cls, signiture: str) -> None:
+        cls.url_lru.delete(signiture)
+        cls.get_url_cache().delete(get_image_url_cache_key(signiture))
+
+    @classmethod
+    def evict_cache_image_urls(cls, signitures: list[str]) -> None:
+        """
+        複数のシグニチャの画像URLを、キャッシュへの1回の通信でまとめて削除する
+        """
+        for signiture in signitures:
+            cls.url_lru.delete(signiture)
+        cls.get_url_cache().delete_many(
+            [get_image_url_cache_key(signiture) for signiture in signitures]
+        )
+
+
+@receiver(pre_delete, sender=models.Image)
+def evict_deleted_image_url(sender, **kwargs):
+    ImageModelService.evict_cache_image_url(kwargs["instance"].profile_signiture)
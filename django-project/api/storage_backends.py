@@ -0,0 +1,183 @@
+"""
+生成した画像の保存先のストレージ
+
+PooledS3Storageは、プロセス内の全スレッドで1つのbotocoreクライアント (スレッドセーフ) と
+そのコネクションプールを共有する。S3Boto3Storageはスレッド毎にセッションとクライアントを
+生成するため、新しいスレッドの最初のアップロードでエンドポイントの解決とTLSの
+ハンドシェイクが発生するが、共有したプールのコネクションを再利用することでこれを防ぐ。
+
+save_overwrite()は、シグニチャから決まる名前の画像を存在確認無しで上書き保存する。
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.config import Config
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import Storage, default_storage
+from storages.backends.s3boto3 import S3Boto3Storage
+from storages.utils import clean_name
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PooledS3Storage(S3Boto3Storage):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        options = settings.IMAGE_S3_POOL
+        self.max_pool_connections = options["MAX_POOL_CONNECTIONS"]
+        self.config = self.config.merge(
+            Config(
+                max_pool_connections=self.max_pool_connections,
+                tcp_keepalive=True,
+                connect_timeout=options["CONNECT_TIMEOUT"],
+                read_timeout=options["READ_TIMEOUT"],
+            )
+        )
+        self._client = None
+        self._client_pid: int | None = None
+        self._session = None
+        self._client_lock = threading.Lock()
+        self._in_use = 0
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        for key in ["_client", "_client_pid", "_session", "_client_lock"]:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._client = None
+        self._client_pid = None
+        self._session = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        """
+        プロセス内で共有するS3クライアント
+        フォーク後の子プロセスでは、親プロセスのコネクションを使わないよう生成し直す
+        """
+        if self._client is None or self._client_pid != os.getpid():
+            with self._client_lock:
+                if self._client is None or self._client_pid != os.getpid():
+                    self._session = self._create_session()
+                    self._client = self._session.client(
+                        "s3",
+                        region_name=self.region_name,
+                        use_ssl=self.use_ssl,
+                        endpoint_url=self.endpoint_url,
+                        config=self.config,
+                        verify=self.verify,
+                    )
+                    self._register_pool_metrics(self._client)
+                    self._client_pid = os.getpid()
+                    self._connections = threading.local()
+        return self._client
+
+    @property
+    def connection(self):
+        """
+        boto3のリソースはスレッドセーフではないためスレッド毎に生成し、
+        リソースが使うクライアントは共有のクライアントに置き換える
+        """
+        client = self.client
+        connection = getattr(self._connections, "connection", None)
+        if connection is None:
+            with self._client_lock:
+                connection = self._session.resource(
+                    "s3",
+                    region_name=self.region_name,
+                    use_ssl=self.use_ssl,
+                    endpoint_url=self.endpoint_url,
+                    config=self.config,
+                    verify=self.verify,
+                )
+            connection.meta.client = client
+            self._connections.connection = connection
+        return connection
+
+    @property
+    def bucket(self):
+        bucket = getattr(self._connections, "bucket", None)
+        if bucket is None:
+            bucket = self.connection.Bucket(self.bucket_name)
+            self._connections.bucket = bucket
+        return bucket
+
+    def _register_pool_metrics(self, client) -> None:
+        """
+        API呼び出しの開始・終了を数え、プールのコネクションの使用数をメトリクスに記録する
+        """
+        metrics.s3_pool_size.set(self.max_pool_connections)
+        self._in_use = 0
+
+        def before_call(**kwargs):
+            with self._client_lock:
+                if self._in_use >= self.max_pool_connections:
+                    metrics.s3_pool_saturated.inc()
+                self._in_use += 1
+            metrics.s3_pool_in_use.inc()
+
+        def after_call(**kwargs):
+            with self._client_lock:
+                self._in_use -= 1
+            metrics.s3_pool_in_use.dec()
+
+        client.meta.events.register("before-call.s3", before_call)
+        client.meta.events.register("after-call.s3", after_call)
+        client.meta.events.register("after-call-error.s3", after_call)
+
+    def warm_up(self, connections: int) -> None:
+        """
+        同時にHeadBucketを送信し、プールにconnections本のコネクションを開いておく
+        """
+        client = self.client
+
+        def head_bucket(_):
+            try:
+                client.head_bucket(Bucket=self.bucket_name)
+            except Exception:
+                logger.warning("Failed to warm up S3 connection.", exc_info=True)
+
+        connections = min(connections, self.max_pool_connections)
+        with ThreadPoolExecutor(max_workers=max(1, connections)) as executor:
+            list(executor.map(head_bucket, range(connections)))
+
+
+def save_overwrite(storage: Storage, name: str, content: File) -> str:
+    """
+    nameに既存のファイルがあっても別名とせずに上書きして保存し、保存したファイル名を返す
+    シグニチャから決まる名前 (models.get_upload_name) は同じ名前なら同じ内容となるため、
+    S3では保存前の存在確認 (HeadObject) を省略する
+    S3以外のストレージは既存のファイルがあると別名で保存するため、先に削除してから保存する
+    (DBへの登録に失敗して残ったファイル等)
+    """
+    if isinstance(storage, S3Boto3Storage):
+        return storage._save(clean_name(name), content)
+    if storage.exists(name):
+        storage.delete(name)
+    return storage.save(name, content)
+
+
+def warm_up_default_storage() -> None:
+    """
+    既定のストレージがPooledS3Storageの場合、ワーカーの起動時に
+    settings.IMAGE_S3_POOL["WARM_CONNECTIONS"]本のコネクションをバックグラウンドで開く
+    """
+    connections = settings.IMAGE_S3_POOL["WARM_CONNECTIONS"]
+    if not isinstance(default_storage, PooledS3Storage) or connections <= 0:
+        return
+    threading.Thread(
+        target=default_storage.warm_up,
+        args=(connections,),
+        name="impala-s3-warm-up",
+        daemon=True,
+    ).start()
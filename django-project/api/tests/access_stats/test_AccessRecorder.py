@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import datetime
+import time
+from unittest.mock import patch
+
+import pytest
+from django.utils import timezone
+
+from api import access_stats
+from api.access_stats import AccessRecorder
+from api.models import Image
+
+# Fixtures
+########################################################################################
+
+
+@pytest.fixture
+def recorder():
+    # バックグラウンドのスレッドは起動せず、flush()を直接呼び出して確認する
+    with patch.object(AccessRecorder, "_start_thread"):
+        yield AccessRecorder(flush_interval=60, max_pending=3)
+
+
+@pytest.fixture
+def images(db) -> list[Image]:
+    accessed_at = timezone.now() - datetime.timedelta(days=1)
+    return [
+        Image.objects.create(
+            upload=f"images/{i}.png",
+            profile_signiture=f"signiture_{i}",
+            last_accessed=accessed_at,
+        )
+        for i in range(3)
+    ]
+
+
+# Tests
+########################################################################################
+
+
+def test_record_without_queries(db, recorder, django_assert_num_queries):
+    with django_assert_num_queries(0):
+        recorder.record("signiture_0")
+        recorder.record("signiture_0")
+        recorder.record("signiture_1")
+
+    pending = recorder.pending()
+    assert pending["signiture_0"][0] == 2
+    assert pending["signiture_1"][0] == 1
+
+
+def test_record_starts_thread_once(recorder):
+    recorder.record("signiture_0")
+    recorder.record("signiture_1")
+
+    AccessRecorder._start_thread.assert_called_once()
+
+
+def test_record_max_pending_wakes_thread(recorder):
+    recorder.record("signiture_0")
+    recorder.record("signiture_1")
+    assert not recorder._wakeup.is_set()
+
+    recorder.record("signiture_2")
+    assert recorder._wakeup.is_set()
+
+
+def test_flush(recorder, images: list[Image]):
+    before = time.time()
+    recorder.record("signiture_0")
+    recorder.record("signiture_0")
+    recorder.record("signiture_1")
+    recorder.record("signiture_not_exists")
+
+    assert recorder.flush() == 2
+
+    images = list(Image.objects.order_by("id"))
+    assert [image.hit_count for image in images] == [2, 1, 0]
+    assert images[0].last_accessed.timestamp() >= before - 1
+    assert images[2].last_accessed < timezone.now() - datetime.timedelta(hours=1)
+    assert recorder.pending() == {}
+
+
+def test_flush_accumulates(recorder, images: list[Image]):
+    recorder.record("signiture_0")
+    recorder.flush()
+    recorder.record("signiture_0")
+    recorder.flush()
+
+    assert Image.objects.get(profile_signiture="signiture_0").hit_count == 2
+
+
+def test_flush_keeps_newer_last_accessed(recorder, images: list[Image]):
+    future = timezone.now() + datetime.timedelta(days=1)
+    Image.objects.filter(profile_signiture="signiture_0").update(last_accessed=future)
+
+    recorder.record("signiture_0")
+    recorder.flush()
+
+    assert Image.objects.get(profile_signiture="signiture_0").last_accessed == future
+
+
+def test_flush_batched(recorder, images: list[Image], django_assert_num_queries):
+    for image in images:
+        recorder.record(image.profile_signiture)
+
+    with patch("api.access_stats.FLUSH_BATCH_SIZE", 2):
+        with django_assert_num_queries(2):
+            assert recorder.flush() == 3
+
+
+def test_flush_failure_keeps_pending(recorder, images: list[Image]):
+    recorder.record("signiture_0")
+
+    with patch("api.access_stats.write_access_stats", side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            recorder.flush()
+    recorder.record("signiture_0")
+
+    assert recorder.pending()["signiture_0"][0] == 2
+    recorder.flush()
+    assert Image.objects.get(profile_signiture="signiture_0").hit_count == 2
+
+
+def test_record_access_disabled(settings):
+    settings.IMAGE_ACCESS_STATS_FLUSH_INTERVAL = None
+    with patch.object(access_stats.recorder, "record") as record:
+        access_stats.record_access("signiture_0")
+    record.assert_not_called()
+
+
+def test_record_access_enabled(settings):
+    settings.IMAGE_ACCESS_STATS_FLUSH_INTERVAL = 60
+    with patch.object(access_stats.recorder, "record") as record:
+        access_stats.record_access("signiture_0")
+    record.assert_called_once_with("signiture_0")
@@ -0,0 +1,79 @@
+import pytest
+
+from api.benchmarks import (
+    EXPECTED_QUERY_COUNTS,
+    benchmark_queries,
+    compare_results,
+    find_query_count_errors,
+    run_profile_benchmarks,
+    run_view_benchmarks,
+)
+
+# Tests
+########################################################################################
+
+# benchmark_queries()
+
+
+def test_benchmark_queries_matrix():
+    queries = benchmark_queries([16, 32])
+    assert len(queries) == 2 * 3 + 2
+    assert "jpeg_plain_16_q75" in queries
+    assert "png_plain_32" in queries
+
+
+# run_profile_benchmarks()
+
+
+def test_run_profile_benchmarks():
+    results = run_profile_benchmarks(sizes=[1], repeat=1, number=1)
+    assert set(results) == {
+        f"{benchmark_name}:{name}"
+        for benchmark_name in [
+            "create_profile",
+            "dump_signiture",
+            "create_pil_image",
+            "create_image",
+        ]
+        for name in benchmark_queries([1])
+    }
+    for result in results.values():
+        assert result["min"] > 0
+
+
+# run_view_benchmarks()
+
+
+@pytest.mark.django_db
+def test_run_view_benchmarks_query_counts():
+    results = run_view_benchmarks(repeat=1, number=1)
+    assert {name: result["queries"] for name, result in results.items()} == {
+        f"get_view:{path_name}": count
+        for path_name, count in EXPECTED_QUERY_COUNTS.items()
+    }
+    assert find_query_count_errors(results) == []
+
+
+# find_query_count_errors()
+
+
+def test_find_query_count_errors():
+    results = {
+        "get_view:hit_db": {"min": 1, "queries": 2, "expected_queries": 1},
+        "get_view:miss": {"min": 1, "queries": 3, "expected_queries": 3},
+        "create_profile:png_plain_16": {"min": 1},
+    }
+    assert find_query_count_errors(results) == [
+        "get_view:hit_db: 2 queries (expected 1)"
+    ]
+
+
+# compare_results()
+
+
+def test_compare_results():
+    baseline = {"a": {"min": 1.0}, "b": {"min": 1.0}, "c": {"min": 1.0}}
+    current = {"a": {"min": 1.1}, "b": {"min": 1.5}, "d": {"min": 9.0}}
+    regressions = compare_results(baseline, current, threshold=0.2)
+    assert [regression["name"] for regression in regressions] == ["b"]
+    assert regressions[0]["ratio"] == pytest.approx(1.5)
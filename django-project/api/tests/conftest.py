@@ -3,17 +3,20 @@ from urllib.parse import urljoin
 
 import pytest
 
-from api import models
-
 
 @pytest.fixture
 def image_url_prefix(settings) -> str:
-    upload_to = models.Image._meta.get_field("upload").upload_to
+    # 画像のURLは、この値とapi.models.get_upload_name()のファイル名を連結したもの
     if settings.SETTINGS_MODULE_NAME == "impala.settings.local":
-        base = settings.MEDIA_URL
-        return os.path.join(base, upload_to)
+        return settings.MEDIA_URL
     elif settings.SETTINGS_MODULE_NAME == "impala.settings.devcontainer":
-        url_path = os.path.join(settings.AWS_STORAGE_BUCKET_NAME, upload_to)
+        url_path = os.path.join(settings.AWS_STORAGE_BUCKET_NAME, "")
         return urljoin(settings.AWS_S3_ENDPOINT_URL, url_path)
     else:
         pytest.exit("settings_module_name is wrong.")
+
+
+@pytest.fixture(autouse=True)
+def disable_access_stats(settings):
+    # テスト用のDBの破棄後にバックグラウンドで書き込まないよう、利用の記録は無効にする
+    settings.IMAGE_ACCESS_STATS_FLUSH_INTERVAL = None
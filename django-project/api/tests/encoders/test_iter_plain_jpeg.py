@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import io
+import struct
+
+import PIL.Image
+import pytest
+
+from api.encoders import iter_plain_jpeg, jpeg_quant_table, rgb_to_ycbcr
+
+# Helper functions
+########################################################################################
+
+
+def read_segments(data: bytes) -> list[tuple[int, bytes]]:
+    """
+    JPEGのマーカーセグメントをSOSまで読み込み、最後にエントロピー符号化データを追加する
+    """
+    segments = []
+    pos = 2
+    while True:
+        marker = data[pos + 1]
+        (length,) = struct.unpack(">H", data[pos + 2 : pos + 4])
+        segments.append((marker, data[pos + 4 : pos + 2 + length]))
+        pos += 2 + length
+        if marker == 0xDA:
+            segments.append((-1, data[pos:]))
+            return segments
+
+
+def pillow_jpeg(size: tuple[int, int], color_rgb: tuple, quality: int) -> bytes:
+    image_file = io.BytesIO()
+    PIL.Image.new("RGB", size, color_rgb).save(
+        image_file, format="jpeg", quality=quality
+    )
+    return image_file.getvalue()
+
+
+# Tests
+########################################################################################
+
+
+def test_quant_table_quality_50_is_base_table():
+    base_table = tuple(range(1, 65))
+    assert jpeg_quant_table(base_table, 50) == base_table
+
+
+def test_quant_table_clamped():
+    assert jpeg_quant_table((255,), 0) == (255,)
+    assert jpeg_quant_table((1,), 100) == (1,)
+
+
+def test_rgb_to_ycbcr():
+    assert rgb_to_ycbcr(0, 0, 0) == (0, 128, 128)
+    assert rgb_to_ycbcr(255, 255, 255) == (255, 128, 128)
+
+
+@pytest.mark.parametrize("quality", [0, 1, 10, 49, 50, 75, 95])
+@pytest.mark.parametrize(
+    "color_rgb", [(0, 0, 0), (255, 255, 255), (190, 240, 203), (93, 56, 145)]
+)
+def test_same_pixels_as_pillow(quality: int, color_rgb: tuple):
+    size = (37, 50)
+    data = b"".join(iter_plain_jpeg(size[0], size[1], color_rgb, quality))
+
+    pil_image = PIL.Image.open(io.BytesIO(data))
+    expected_image = PIL.Image.open(io.BytesIO(pillow_jpeg(size, color_rgb, quality)))
+
+    assert pil_image.format == "JPEG"
+    assert pil_image.size == size
+    assert pil_image.tobytes() == expected_image.tobytes()
+
+
+@pytest.mark.parametrize("size", [(1, 1), (16, 16), (17, 1), (100, 33), (640, 480)])
+def test_same_tables_and_scan_as_pillow(size: tuple[int, int]):
+    color_rgb = (200, 10, 99)
+    segments = read_segments(b"".join(iter_plain_jpeg(*size, color_rgb, 75)))
+    expected_segments = read_segments(pillow_jpeg(size, color_rgb, 75))
+
+    def join(segments: list, marker: int) -> bytes:
+        return b"".join(data for m, data in segments if m == marker)
+
+    # DQT, SOF0, DHT, エントロピー符号化データ
+    for marker in [0xDB, 0xC0, 0xC4, -1]:
+        assert join(segments, marker) == join(expected_segments, marker)
+
+
+def test_max_size_chunks():
+    chunk_sizes = [
+        len(chunk) for chunk in iter_plain_jpeg(15360, 15360, (10, 20, 30), 75)
+    ]
+    assert max(chunk_sizes) <= 65536
+    assert sum(chunk_sizes) > 15360 * 15360 // 64
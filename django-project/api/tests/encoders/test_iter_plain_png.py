@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import io
+import struct
+import zlib
+
+import PIL.Image
+import pytest
+
+from api.encoders import adler32_zeros, iter_plain_png
+
+# Helper functions
+########################################################################################
+
+
+def read_chunks(data: bytes) -> list[tuple[bytes, bytes]]:
+    chunks = []
+    pos = 8
+    while pos < len(data):
+        (length,) = struct.unpack(">I", data[pos : pos + 4])
+        chunk_type = data[pos + 4 : pos + 8]
+        chunk_data = data[pos + 8 : pos + 8 + length]
+        (crc,) = struct.unpack(">I", data[pos + 8 + length : pos + 12 + length])
+        assert crc == zlib.crc32(chunk_type + chunk_data)
+        chunks.append((chunk_type, chunk_data))
+        pos += 12 + length
+    return chunks
+
+
+# Tests
+########################################################################################
+
+
+def test_adler32_zeros():
+    adler = zlib.adler32(b"impala")
+    assert adler32_zeros(adler, 100000) == zlib.adler32(bytes(100000), adler)
+
+
+@pytest.mark.parametrize(
+    "size",
+    [(1, 1), (3, 2), (48, 48), (1, 20000), (100, 700), (9000, 5), (8193, 7)],
+)
+def test_same_pixels_as_pillow(size: tuple[int, int]):
+    color_rgba = (12, 200, 77, 150)
+    data = b"".join(iter_plain_png(size[0], size[1], color_rgba))
+
+    pil_image = PIL.Image.open(io.BytesIO(data))
+    pil_image.load()
+    expected_image = PIL.Image.new("RGBA", size, color_rgba)
+
+    assert pil_image.format == "PNG"
+    assert pil_image.mode == "RGBA"
+    assert pil_image.size == size
+    assert pil_image.tobytes() == expected_image.tobytes()
+
+
+def test_chunk_structure():
+    data = b"".join(iter_plain_png(2000, 2000, (1, 2, 3, 4), chunk_size=1024))
+    chunks = read_chunks(data)
+
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    assert chunks[0][0] == b"IHDR"
+    assert chunks[-1] == (b"IEND", b"")
+    idat_chunks = [chunk_data for chunk_type, chunk_data in chunks[1:-1]]
+    assert all(chunk_type == b"IDAT" for chunk_type, _ in chunks[1:-1])
+    assert all(len(chunk_data) == 1024 for chunk_data in idat_chunks[:-1])
+
+    # zlibストリームのadler32チェックサムを含めて検証される
+    scanlines = zlib.decompress(b"".join(idat_chunks))
+    assert len(scanlines) == 2000 * (2000 * 4 + 1)
+
+
+def test_max_size_constant_memory():
+    chunk_sizes = [
+        len(chunk) for chunk in iter_plain_png(15360, 15360, (255, 255, 255, 255))
+    ]
+    assert max(chunk_sizes) <= 8192 + 12
@@ -0,0 +1,282 @@
+from __future__ import annotations
+
+import datetime
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+import pytest
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db.models.signals import pre_delete
+from django.utils import timezone
+from storages.backends.s3boto3 import S3Boto3Storage
+
+from api import eviction
+from api.models import Image
+from api.services import ImageModelService, get_image_url_cache_key
+
+# Fixtures
+########################################################################################
+
+
+@pytest.fixture(autouse=True)
+def media_root(settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.MEDIA_URL = "media/"
+    return tmp_path
+
+
+@pytest.fixture
+def images(db) -> list[Image]:
+    """
+    最終利用日時が1日ずつ古い、10バイトの画像5件 (先頭が最も古い)
+    """
+    now = timezone.now()
+    images = []
+    for i in range(5):
+        image = Image(profile_signiture=f"signiture_{i}", byte_size=10)
+        image.last_accessed = now - datetime.timedelta(days=5 - i)
+        image.upload.save(f"evict_{i}.png", ContentFile(b"0123456789"), save=False)
+        image.save()
+        images.append(image)
+    return images
+
+
+def remaining_signitures() -> list[str]:
+    return list(
+        Image.objects.order_by("id").values_list("profile_signiture", flat=True)
+    )
+
+
+# Tests
+########################################################################################
+
+
+def test_evict_older_than(images: list[Image]):
+    result = eviction.evict_images(
+        accessed_before=timezone.now() - datetime.timedelta(days=2, hours=12)
+    )
+
+    assert result["images"] == 3
+    assert result["bytes"] == 30
+    assert remaining_signitures() == ["signiture_3", "signiture_4"]
+    storage = images[0].upload.storage
+    assert not storage.exists(images[0].upload.name)
+    assert storage.exists(images[4].upload.name)
+
+
+def test_evict_max_bytes(images: list[Image]):
+    result = eviction.evict_images(max_bytes=25, batch_size=2)
+
+    assert result["images"] == 3
+    assert result["total_bytes"] == 50
+    assert remaining_signitures() == ["signiture_3", "signiture_4"]
+
+
+def test_evict_nothing(images: list[Image]):
+    result = eviction.evict_images(max_bytes=50)
+
+    assert result["images"] == 0
+    assert len(remaining_signitures()) == 5
+
+
+def test_evict_dry_run(images: list[Image]):
+    result = eviction.evict_images(max_bytes=0, dry_run=True)
+
+    assert result["images"] == 5
+    assert result["bytes"] == 50
+    assert len(remaining_signitures()) == 5
+
+
+def test_evict_without_pre_delete_signal(images: list[Image]):
+    receiver = MagicMock()
+    pre_delete.connect(receiver, sender=Image)
+    try:
+        eviction.evict_images(max_bytes=0)
+    finally:
+        pre_delete.disconnect(receiver, sender=Image)
+
+    receiver.assert_not_called()
+    assert remaining_signitures() == []
+
+
+def test_evict_url_caches(images: list[Image]):
+    ImageModelService.url_lru.set("signiture_0", "https://hoge")
+    ImageModelService.get_url_cache().set(
+        get_image_url_cache_key("signiture_0"), "https://hoge"
+    )
+
+    eviction.evict_images(max_bytes=40)
+
+    assert ImageModelService.url_lru.get("signiture_0") is None
+    assert (
+        ImageModelService.get_url_cache().get(get_image_url_cache_key("signiture_0"))
+        is None
+    )
+
+
+def test_evict_storage_failure_resumable(images: list[Image]):
+    failing_name = images[1].upload.name
+    original = eviction.delete_storage_files
+
+    def delete_storage_files(storage, names):
+        return original(storage, [n for n in names if n != failing_name]) + [
+            n for n in names if n == failing_name
+        ]
+
+    with patch("api.eviction.delete_storage_files", side_effect=delete_storage_files):
+        result = eviction.evict_images(max_bytes=0, batch_size=2, concurrency=2)
+
+    # 削除に失敗した画像は残し、後続のバッチの処理は続ける
+    assert result["images"] == 4
+    assert result["failed"] == 1
+    assert remaining_signitures() == ["signiture_1"]
+
+    # 再実行で残りを削除できる
+    result = eviction.evict_images(max_bytes=0)
+    assert result["images"] == 1
+    assert remaining_signitures() == []
+
+
+def test_evict_file_already_deleted(images: list[Image]):
+    images[0].upload.storage.delete(images[0].upload.name)
+
+    result = eviction.evict_images(max_bytes=0)
+
+    assert result["images"] == 5
+    assert result["failed"] == 0
+
+
+def test_delete_storage_files_s3_batches():
+    storage = MagicMock(spec=S3Boto3Storage)
+    storage.bucket_name = "bucket"
+    storage._normalize_name.side_effect = lambda name: f"prefix/{name}"
+    delete_objects = storage.bucket.meta.client.delete_objects
+    delete_objects.side_effect = [
+        {"Errors": [{"Key": "prefix/images/5.png"}]},
+        {},
+        {},
+    ]
+    names = [f"images/{i}.png" for i in range(2500)]
+
+    failed = eviction.delete_storage_files(storage, names)
+
+    assert failed == ["images/5.png"]
+    assert delete_objects.call_count == 3
+    sizes = [len(c.kwargs["Delete"]["Objects"]) for c in delete_objects.call_args_list]
+    assert sizes == [1000, 1000, 500]
+    first_call = delete_objects.call_args_list[0].kwargs
+    assert first_call["Bucket"] == "bucket"
+    assert first_call["Delete"]["Objects"][0] == {"Key": "prefix/images/0.png"}
+    assert first_call["Delete"]["Quiet"] is True
+
+
+def test_evict_redirect_cached(settings, images: list[Image]):
+    settings.API_REDIRECT_MAX_AGE = 60 * 60 * 84
+    result = eviction.evict_images(max_bytes=20, dry_run=True)
+
+    # 3.5日以内に利用された画像 (signiture_2) のリダイレクトはキャッシュされ得る
+    assert result["images"] == 3
+    assert result["redirect_cached"] == 1
+
+
+# Byte sizes
+
+
+def test_evict_unknown_sizes(images: list[Image]):
+    Image.objects.filter(id__in=[images[0].id, images[1].id]).update(byte_size=None)
+
+    result = eviction.evict_images(max_bytes=30, dry_run=True)
+
+    assert result["total_bytes"] == 30
+    assert result["unknown_sizes"] == 2
+    assert result["images"] == 0
+
+
+def test_backfill_byte_sizes(images: list[Image]):
+    Image.objects.update(byte_size=None)
+    images[0].upload.storage.delete(images[0].upload.name)
+
+    assert eviction.backfill_byte_sizes(batch_size=2) == 4
+    # ファイルが無い画像はサイズ不明のまま
+    assert eviction.count_unknown_sizes() == 1
+    assert eviction.get_total_bytes() == 40
+    assert eviction.backfill_byte_sizes() == 0
+
+
+def test_backfill_byte_sizes_s3(images: list[Image]):
+    Image.objects.update(byte_size=None)
+    storage = MagicMock(spec=S3Boto3Storage)
+    storage.bucket_name = "bucket"
+    storage._normalize_name.side_effect = lambda name: f"prefix/{name}"
+    paginator = storage.bucket.meta.client.get_paginator.return_value
+    paginator.paginate.return_value = [
+        {
+            "Contents": [
+                {"Key": f"prefix/{images[0].upload.name}", "Size": 3},
+                {"Key": "prefix/images/unknown.png", "Size": 100},
+            ]
+        },
+        {"Contents": [{"Key": f"prefix/{images[1].upload.name}", "Size": 4}]},
+        {},
+    ]
+    field = Image._meta.get_field("upload")
+
+    with patch.object(field, "storage", storage):
+        assert eviction.backfill_byte_sizes() == 2
+
+    paginator.paginate.assert_called_once_with(Bucket="bucket", Prefix="prefix/images/")
+    assert eviction.get_total_bytes() == 7
+    assert eviction.count_unknown_sizes() == 3
+
+
+# Command
+
+
+def test_command(settings, images: list[Image]):
+    settings.API_REDIRECT_MAX_AGE = 60 * 60
+    out = StringIO()
+    call_command("evict_images", "--older-than", "3.5", stdout=out)
+
+    assert "Deleted 2 images (20 bytes) of 50 bytes." in out.getvalue()
+    assert remaining_signitures() == ["signiture_2", "signiture_3", "signiture_4"]
+
+
+def test_command_requires_criteria(db):
+    with pytest.raises(CommandError):
+        call_command("evict_images")
+
+
+def test_command_older_than_redirect_max_age(settings, images: list[Image]):
+    """
+    リダイレクトのキャッシュ期間より短い--older-thanは、明示しない限り拒否する
+    """
+    settings.API_REDIRECT_MAX_AGE = 60 * 60 * 24 * 30
+    with pytest.raises(CommandError):
+        call_command("evict_images", "--older-than", "3.5")
+    assert len(remaining_signitures()) == 5
+
+    call_command(
+        "evict_images",
+        "--older-than",
+        "3.5",
+        "--allow-cached-redirects",
+        stdout=StringIO(),
+        stderr=StringIO(),
+    )
+    assert len(remaining_signitures()) == 3
+
+
+def test_command_backfill_sizes(settings, images: list[Image]):
+    Image.objects.update(byte_size=None)
+    out = StringIO()
+    err = StringIO()
+    call_command("evict_images", "--max-bytes", "30", stdout=out, stderr=err)
+    assert "5 images have unknown sizes" in err.getvalue()
+    assert len(remaining_signitures()) == 5
+
+    call_command(
+        "evict_images", "--max-bytes", "30", "--backfill-sizes", stdout=out, stderr=err
+    )
+    assert "Filled in the sizes of 5 images." in out.getvalue()
+    assert remaining_signitures() == ["signiture_2", "signiture_3", "signiture_4"]
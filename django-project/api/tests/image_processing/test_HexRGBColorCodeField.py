@@ -166,7 +166,11 @@ def test_HexRGBColorCodeField_clean_invalid(invalid_color_code):
         field.clean(invalid_color_code)
 
 
-def test_HexRGBColorCodeField_clean_original_cleaned_data():
+def test_HexRGBColorCodeField_clean_stateless():
+    """
+    フィールドはリクエスト間で共有されるため、入力値をインスタンスに保持しない
+    """
     field = HexRGBColorCodeField()
+    attributes = dict(vars(field))
     field.clean("324C96")
-    assert field.original_cleaned_data == "324C96"
+    assert vars(field) == attributes
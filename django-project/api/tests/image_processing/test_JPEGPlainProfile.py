@@ -1,3 +1,6 @@
+import io
+
+import PIL.Image
 import pytest
 
 from api.image_processing import ColorRGB, JPEGPlainProfile, JPEGPlainProfileForm
@@ -74,3 +77,26 @@ def test_dump_signiture(profile_dict):
     assert profile.dump_signiture() == '{"%s":{"width":512,"height":1024,"color_rgb":{"r":139,"g":86,"b":221},"quality":65}}' % (
         JPEGPlainProfileForm.get_profile_type(),
     )
+
+
+def test_save_image():
+    profile = JPEGPlainProfile(
+        width=100, height=50, color_rgb=ColorRGB(139, 86, 221), quality=80
+    )
+    image_file = io.BytesIO()
+    profile.save_image(image_file)
+    image_file.seek(0)
+
+    expected_file = io.BytesIO()
+    profile.create_pil_image().save(expected_file, format="jpeg", quality=80)
+    expected_file.seek(0)
+
+    pil_image = PIL.Image.open(image_file)
+    assert pil_image.format == "JPEG"
+    assert pil_image.size == (100, 50)
+    assert pil_image.tobytes() == PIL.Image.open(expected_file).tobytes()
+
+
+def test_pixel_count(profile_dict):
+    profile = JPEGPlainProfile(**profile_dict)
+    assert profile.pixel_count == 512 * 1024
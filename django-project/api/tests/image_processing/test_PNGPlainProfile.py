@@ -1,3 +1,6 @@
+import io
+
+import PIL.Image
 import pytest
 
 from api.image_processing import ColorRGB, PNGPlainProfile, PNGPlainProfileForm
@@ -74,3 +77,19 @@ def test_dump_signiture(profile_dict):
     assert profile.dump_signiture() == '{"%s":{"width":512,"height":1024,"color_rgb":{"r":139,"g":86,"b":221},"alpha":193}}' % (
         PNGPlainProfileForm.get_profile_type(),
     )
+
+
+def test_save_image(profile_dict):
+    profile = PNGPlainProfile(**profile_dict)
+    image_file = io.BytesIO()
+    profile.save_image(image_file)
+    image_file.seek(0)
+
+    pil_image = PIL.Image.open(image_file)
+    assert pil_image.format == "PNG"
+    assert pil_image.tobytes() == profile.create_pil_image().tobytes()
+
+
+def test_pixel_count(profile_dict):
+    profile = PNGPlainProfile(**profile_dict)
+    assert profile.pixel_count == 512 * 1024
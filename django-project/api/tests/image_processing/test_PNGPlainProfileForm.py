@@ -210,6 +210,16 @@ def test_get_query_string_valid(querydict_all_proper):
     )
 
 
+def test_get_query_string_normalized():
+    form = PNGPlainProfileForm(
+        QueryDict("alpha=50&color_rgb=%205ad%20&height=0256&width=512&profile_type=x")
+    )
+    assert (
+        form.get_query_string()
+        == "profile_type=png_plain&width=512&height=256&color_rgb=55AADD&alpha=50"
+    )
+
+
 def test_get_query_string_invalid(querydict_improper):
     form = PNGPlainProfileForm(querydict_improper)
     with pytest.raises(QueryError):
@@ -0,0 +1,87 @@
+import json
+
+import pytest
+from django.http import QueryDict
+
+from api.image_processing import (
+    JPEGPlainProfileForm,
+    PNGPlainProfileForm,
+    ProfileQueryParser,
+    QueryError,
+    get_color_rgb,
+)
+
+# Fixtures
+########################################################################################
+
+
+@pytest.fixture(params=[JPEGPlainProfileForm, PNGPlainProfileForm])
+def form_class(request):
+    return request.param
+
+
+# Tests
+########################################################################################
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "width=512&height=256&color_rgb=85CDFD&quality=63&alpha=193",
+        "width=12.0&height=%2016%20&color_rgb=%20abc%20&quality=0&alpha=0",
+        "width=1&height=15360&color_rgb=FFF&quality=95&alpha=255",
+    ],
+)
+def test_parse_valid_same_as_form(form_class, query):
+    querydict = QueryDict(query)
+    profile = ProfileQueryParser(form_class).parse(querydict)
+    form = form_class(querydict)
+    assert profile.dump_signiture() == form.get_profile().dump_signiture()
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "",
+        "width=hoge&height=0&color_rgb=zz&quality=96&alpha=256",
+        "width=&height=99999&color_rgb=%00&quality=1.5&alpha=-1",
+        "width=1e3&height=1&color_rgb=ffff&quality=&alpha=",
+    ],
+)
+def test_parse_invalid_same_errors_as_form(form_class, query):
+    querydict = QueryDict(query)
+    with pytest.raises(QueryError) as exc_info:
+        ProfileQueryParser(form_class).parse(querydict)
+    form = form_class(querydict)
+    assert not form.is_valid()
+    # ビューではJSONに変換して返すため、JSONでの表現が一致することを確認する
+    assert json.dumps(exc_info.value.messages) == json.dumps(dict(form.errors))
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "width=512&height=256&color_rgb=85CDFD&quality=63&alpha=193",
+        "alpha=0&quality=0&color_rgb=%20abc%20&height=%2016%20&width=12.0",
+    ],
+)
+def test_parse_canonical_same_as_form(form_class, query):
+    querydict = QueryDict(query)
+    profile, canonical_query = ProfileQueryParser(form_class).parse_canonical(querydict)
+    form = form_class(querydict)
+    assert profile.dump_signiture() == form.get_profile().dump_signiture()
+    assert canonical_query == form.get_query_string()
+
+
+def test_parse_canonical_invalid(form_class):
+    with pytest.raises(QueryError):
+        ProfileQueryParser(form_class).parse_canonical(QueryDict("width=hoge"))
+
+
+def test_parse_color_rgb_interned():
+    parser = ProfileQueryParser(PNGPlainProfileForm)
+    querydict = QueryDict("width=1&height=1&color_rgb=1A2B3C&alpha=255")
+    first = parser.parse(querydict)
+    second = parser.parse(querydict)
+    assert first.color_rgb is second.color_rgb
+    assert first.color_rgb is get_color_rgb("1A2B3C")
@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import io
+import os
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from api.image_processing import ColorRGB, PNGPlainProfile
+from api.local_tier import LocalDiskTier, get_local_tier
+from api.models import digest_signiture
+
+# Fixtures
+########################################################################################
+
+
+@pytest.fixture
+def tier(tmp_path) -> LocalDiskTier:
+    return LocalDiskTier(str(tmp_path), max_bytes=10)
+
+
+def create_profile(width: int) -> PNGPlainProfile:
+    return PNGPlainProfile(width=width, height=1, color_rgb=ColorRGB(1, 2, 3))
+
+
+# Tests
+########################################################################################
+
+
+def test_put_and_get(tier: LocalDiskTier):
+    profile = create_profile(1)
+    assert tier.get(profile) is None
+
+    relative_path = tier.put(profile, io.BytesIO(b"image"))
+
+    assert tier.get(profile) == relative_path
+    with open(tier.get_path(relative_path), "rb") as f:
+        assert f.read() == b"image"
+    assert tier.total_bytes == 5
+
+
+def test_content_addressed_path(tier: LocalDiskTier):
+    profile = create_profile(1)
+    digest = digest_signiture(profile.dump_signiture())
+
+    relative_path = tier.put(profile, io.BytesIO(b"image"))
+
+    assert relative_path == os.path.join(digest[:2], digest[2:4], f"{digest}.png")
+
+
+def test_put_leaves_no_temp_file(tier: LocalDiskTier):
+    tier.put(create_profile(1), io.BytesIO(b"image"))
+
+    assert [f for f in os.listdir(tier.root) if f.endswith(".tmp")] == []
+
+
+def test_put_reads_from_start(tier: LocalDiskTier):
+    image_file = io.BytesIO(b"image")
+    image_file.seek(0, os.SEEK_END)
+
+    relative_path = tier.put(create_profile(1), image_file)
+
+    assert os.path.getsize(tier.get_path(relative_path)) == 5
+
+
+def test_evict_least_recently_used(tier: LocalDiskTier):
+    first, second, third = create_profile(1), create_profile(2), create_profile(3)
+    tier.put(first, io.BytesIO(b"1111"))
+    tier.put(second, io.BytesIO(b"2222"))
+    # 最初の画像を利用したため、2番目の画像が最も古くなる
+    tier.get(first)
+
+    tier.put(third, io.BytesIO(b"3333"))
+
+    assert tier.get(first) is not None
+    assert tier.get(second) is None
+    assert tier.get(third) is not None
+    assert tier.total_bytes == 8
+
+
+def test_get_removed_by_other_process(tier: LocalDiskTier):
+    profile = create_profile(1)
+    relative_path = tier.put(profile, io.BytesIO(b"image"))
+    os.remove(tier.get_path(relative_path))
+
+    assert tier.get(profile) is None
+    assert tier.total_bytes == 0
+
+
+def test_rescan_counts_files_of_other_processes(tmp_path):
+    other = LocalDiskTier(str(tmp_path), max_bytes=10)
+    other.put(create_profile(1), io.BytesIO(b"11111111"))
+    other._rescan_thread.join()
+
+    tier = LocalDiskTier(str(tmp_path), max_bytes=10)
+    tier.put(create_profile(2), io.BytesIO(b"2222"))
+    tier._rescan_thread.join()
+
+    # 他のプロセスが保存した画像も合計サイズに含め、古いものから削除する
+    assert tier.get(create_profile(1)) is None
+    assert tier.get(create_profile(2)) is not None
+    assert tier.total_bytes == 4
+
+
+def test_rescan_drops_files_deleted_by_other_processes(tmp_path):
+    tier = LocalDiskTier(str(tmp_path), max_bytes=100)
+    tier.put(create_profile(1), io.BytesIO(b"11111111"))
+    tier.put(create_profile(2), io.BytesIO(b"2222"))
+    tier._rescan_thread.join()
+    relative_path = tier.get(create_profile(1))
+
+    # 他のプロセスが削除した画像は、このプロセスの索引にあっても合計サイズに含めない
+    os.unlink(os.path.join(str(tmp_path), relative_path))
+    tier.rescan()
+
+    assert tier.total_bytes == 4
+    assert tier.get(create_profile(2)) is not None
+
+
+def test_clear(tier: LocalDiskTier):
+    profile = create_profile(1)
+    tier.put(profile, io.BytesIO(b"image"))
+
+    tier.clear()
+
+    assert tier.get(profile) is None
+    assert tier.total_bytes == 0
+
+
+def test_get_local_tier(settings, tmp_path):
+    settings.IMAGE_LOCAL_TIER = None
+    assert get_local_tier() is None
+
+    settings.IMAGE_LOCAL_TIER = {"ROOT": str(tmp_path / "local"), "MAX_BYTES": 10}
+    tier = get_local_tier()
+    assert tier is not None
+    assert tier is get_local_tier()
+    assert os.path.isdir(tmp_path / "local")
+
+
+def test_rescan_does_not_block_get(tmp_path):
+    """
+    ディレクトリの走査中もロックを持たないため、ヒット時の処理は待たされない
+    """
+    tier = LocalDiskTier(str(tmp_path), max_bytes=100)
+    profile = create_profile(1)
+    tier.put(profile, io.BytesIO(b"image"))
+    tier._rescan_thread.join()
+
+    walking = threading.Event()
+    release = threading.Event()
+    walk = os.walk
+
+    def slow_walk(*args, **kwargs):
+        walking.set()
+        release.wait(5)
+        return walk(*args, **kwargs)
+
+    with patch("api.local_tier.os.walk", side_effect=slow_walk):
+        thread = threading.Thread(target=tier.rescan)
+        thread.start()
+        assert walking.wait(5)
+        assert tier.get(profile) is not None
+        # 走査中に保存した画像も、走査後の索引に残る
+        tier.put(create_profile(2), io.BytesIO(b"image"))
+        release.set()
+        thread.join()
+
+    assert tier.get(create_profile(2)) is not None
+    assert tier.total_bytes == 10
+
+
+def test_rescan_interval(tmp_path):
+    tier = LocalDiskTier(str(tmp_path), max_bytes=100, rescan_interval=300)
+    with patch.object(LocalDiskTier, "_start_rescan") as start_rescan:
+        tier.put(create_profile(1), io.BytesIO(b"image"))
+        tier.put(create_profile(2), io.BytesIO(b"image"))
+    start_rescan.assert_called_once()
@@ -0,0 +1,238 @@
+import json
+import os
+import subprocess
+import sys
+from unittest.mock import patch
+
+import pytest
+from django.urls import reverse
+
+from api.metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    MetricsRegistry,
+    get_pixel_bucket,
+    observe_request,
+    registry,
+)
+from api.services import ImageProcessingService, RenderBudget, RenderBudgetExceeded
+from api.timing import RequestTimer
+
+# Fixtures
+########################################################################################
+
+
+@pytest.fixture
+def test_registry():
+    test_registry = MetricsRegistry()
+    counter = test_registry.register(
+        Counter("test_total", "Test counter.", labelnames=("source",))
+    )
+    histogram = test_registry.register(
+        Histogram("test_seconds", "Test histogram.", [0.1, 1])
+    )
+    return test_registry, counter, histogram
+
+
+@pytest.fixture
+def reset_registry():
+    for metric in registry.metrics.values():
+        metric.reset()
+    yield
+    for metric in registry.metrics.values():
+        metric.reset()
+
+
+# Tests
+########################################################################################
+
+
+def test_render(settings, test_registry):
+    settings.API_METRICS_DIR = None
+    test_registry, counter, histogram = test_registry
+    counter.inc("lru")
+    counter.inc("lru")
+    counter.inc('d"b')
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(3)
+
+    lines = test_registry.render().splitlines()
+    assert "# TYPE test_total counter" in lines
+    assert 'test_total{source="lru"} 2' in lines
+    assert 'test_total{source="d\\"b"} 1' in lines
+    assert "# TYPE test_seconds histogram" in lines
+    assert 'test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{le="1"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 3' in lines
+    assert "test_seconds_sum 3.55" in lines
+    assert "test_seconds_count 3" in lines
+
+
+def test_gauge(settings):
+    settings.API_METRICS_DIR = None
+    test_registry = MetricsRegistry()
+    gauge = test_registry.register(Gauge("test_in_use", "Test gauge."))
+    gauge.set(4)
+    gauge.inc()
+    gauge.dec(amount=2)
+
+    lines = test_registry.render().splitlines()
+    assert "# TYPE test_in_use gauge" in lines
+    assert "test_in_use 3" in lines
+
+
+def test_collectors(settings):
+    """
+    出力の直前に登録した関数を呼び出し、現在値を反映する
+    """
+    settings.API_METRICS_DIR = None
+    test_registry = MetricsRegistry()
+    gauge = test_registry.register(Gauge("test_in_use", "Test gauge."))
+    current = {"value": 1}
+    test_registry.add_collector(lambda: gauge.set(current["value"]))
+
+    assert "test_in_use 1" in test_registry.render().splitlines()
+    current["value"] = 5
+    assert "test_in_use 5" in test_registry.render().splitlines()
+
+
+def test_collect_merges_processes(settings, tmp_path, test_registry):
+    """
+    他のプロセスが書き出したファイルの集計値も合算される
+    """
+    settings.API_METRICS_DIR = str(tmp_path)
+    test_registry, counter, histogram = test_registry
+    counter.inc("lru", amount=2)
+    histogram.observe(0.5)
+
+    other_process = {
+        "test_total": {json.dumps(["lru"]): 3, json.dumps(["db"]): 1},
+        "test_seconds": {json.dumps([]): {"counts": [1, 0, 0], "sum": 0.01}},
+    }
+    (tmp_path / f"metrics_{os.getppid()}_other.json").write_text(
+        json.dumps(other_process)
+    )
+
+    collected = test_registry.collect()
+    assert collected["test_total"] == {json.dumps(["lru"]): 5, json.dumps(["db"]): 1}
+    assert collected["test_seconds"][json.dumps([])]["counts"] == [1, 1, 0]
+    # 自プロセスの集計値もファイルに書き出される
+    assert test_registry.get_file_path(str(tmp_path)) in [
+        str(path) for path in tmp_path.glob("metrics_*.json")
+    ]
+
+
+def test_collect_dead_processes(settings, tmp_path):
+    """
+    終了したプロセスのファイルは、ゲージを合算せずカウンターのみを合算する
+    """
+    settings.API_METRICS_DIR = str(tmp_path)
+    test_registry = MetricsRegistry()
+    counter = test_registry.register(Counter("test_total", "Test counter."))
+    gauge = test_registry.register(Gauge("test_in_use", "Test gauge."))
+    counter.inc()
+    gauge.set(1)
+
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    values = {"test_total": {json.dumps([]): 2}, "test_in_use": {json.dumps([]): 4}}
+    for name in [
+        f"metrics_{process.pid}_dead.json",
+        f"metrics_{os.getppid()}_alive.json",
+        # 自プロセスと同じpidの以前のプロセスのファイル
+        f"metrics_{os.getpid()}_restarted.json",
+    ]:
+        (tmp_path / name).write_text(json.dumps(values))
+
+    collected = test_registry.collect()
+    assert collected["test_total"] == {json.dumps([]): 7}
+    assert collected["test_in_use"] == {json.dumps([]): 5}
+
+
+def test_check_fork_resets_values(monkeypatch, settings, test_registry):
+    settings.API_METRICS_DIR = None
+    test_registry, counter, histogram = test_registry
+    counter.inc("lru")
+    file_id = test_registry.file_id
+
+    monkeypatch.setattr("os.getpid", lambda: test_registry.pid + 1)
+    assert test_registry.snapshot()["test_total"] == {}
+    assert test_registry.file_id != file_id
+
+
+@pytest.mark.parametrize(
+    "pixel_count, bucket",
+    [
+        (0, "le_4096"),
+        (4096, "le_4096"),
+        (4097, "le_1048576"),
+        (4096**2 + 1, "gt_16777216"),
+    ],
+)
+def test_get_pixel_bucket(pixel_count, bucket):
+    assert get_pixel_bucket(pixel_count) == bucket
+
+
+def test_observe_request(settings, reset_registry):
+    settings.API_METRICS_DIR = None
+    timer = RequestTimer()
+    timer.add("render", 0.02)
+    timer.record(
+        outcome="miss",
+        profile_type="png_plain",
+        url_source="none",
+        pixel_count=100,
+        byte_size=2000,
+    )
+    observe_request(timer)
+
+    collected = registry.collect()
+    assert (
+        json.dumps(["miss", "png_plain"])
+        in collected["impala_request_duration_seconds"]
+    )
+    assert collected["impala_image_url_lookups_total"] == {json.dumps(["none"]): 1}
+    assert json.dumps(["le_4096"]) in collected["impala_render_duration_seconds"]
+    assert json.dumps(["png_plain"]) in collected["impala_encoded_size_bytes"]
+
+
+def test_metrics_view(client, settings, reset_registry):
+    """
+    DBへのアクセスを許可していないテストで取得できる (DBに問い合わせない)
+    """
+    settings.API_METRICS_DIR = None
+    registry.metrics["impala_ratelimited_requests_total"].inc()
+    res = client.get(reverse("api:metrics"))
+    assert res.status_code == 200
+    assert res["Content-Type"].startswith("text/plain; version=0.0.4")
+    assert "impala_ratelimited_requests_total 1" in res.content.decode()
+
+
+def test_metrics_view_render_budget(client, settings, reset_registry):
+    settings.API_METRICS_DIR = None
+    budget = RenderBudget(capacity=100)
+    budget.acquire(30, timeout=0)
+    with patch.object(ImageProcessingService, "render_budget", budget):
+        res = client.get(reverse("api:metrics"))
+    lines = res.content.decode().splitlines()
+    assert "impala_render_budget_capacity_pixels 100" in lines
+    assert "impala_render_budget_in_use_pixels 30" in lines
+    assert "impala_render_budget_waiting 0" in lines
+    assert "# TYPE impala_render_budget_rejected_total counter" in lines
+
+
+def test_render_budget_rejected(settings, reset_registry):
+    """
+    拒否した件数はプロセスの集計値を合算できるようカウンターに加算する
+    """
+    settings.API_METRICS_DIR = None
+    settings.IMAGE_RENDER_BUDGET_RETRY_AFTER = 1
+    budget = RenderBudget(capacity=100)
+    budget.acquire(60, timeout=0)
+    for _ in range(2):
+        with pytest.raises(RenderBudgetExceeded):
+            budget.acquire(50, timeout=0)
+
+    assert "impala_render_budget_rejected_total 2" in registry.render().splitlines()
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import pytest
+
+from api.models import Image, digest_signiture, get_upload_name
+
+# Tests
+########################################################################################
+
+
+def test_digest_signiture_fixed_length():
+    short = digest_signiture("a")
+    long = digest_signiture("a" * 10000)
+    assert len(short) == 32
+    assert len(long) == 32
+    assert short != long
+    assert digest_signiture("a") == short
+
+
+@pytest.mark.django_db
+def test_save_sets_profile_signiture_digest():
+    signiture = '{"profile_type": "png_plain", "width": 100}'
+    image = Image(upload="images/test.png", profile_signiture=signiture)
+    image.save()
+    assert image.profile_signiture_digest == digest_signiture(signiture)
+    assert Image.objects.filter(
+        profile_signiture_digest=digest_signiture(signiture)
+    ).exists()
+
+
+def test_get_upload_name():
+    signiture = '{"profile_type": "png_plain", "width": 100}'
+    digest = digest_signiture(signiture)
+    name = get_upload_name(signiture, "png")
+    assert name == f"images/{digest[:2]}/{digest[2:4]}/{digest}.png"
+    assert get_upload_name(signiture, "png") == name
+
+
+def test_upload_to():
+    """
+    ファイル名は拡張子のみを使い、シグニチャから決まる名前となる
+    """
+    signiture = '{"profile_type": "jpeg_plain", "width": 100}'
+    field = Image._meta.get_field("upload")
+    image = Image(profile_signiture=signiture)
+    name = field.generate_filename(image, "jpeg_plain_width_100.jpeg")
+    assert name == get_upload_name(signiture, "jpeg")
@@ -0,0 +1,270 @@
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+from django.test import RequestFactory
+
+from api.image_processing import ColorRGB, JPEGPlainProfile, PNGPlainProfile
+from api.ratelimit import (
+    RateLimiter,
+    RenderCostLimiter,
+    TokenBucketPrefilter,
+    consume,
+    get_rate_limiter,
+    get_render_cost,
+    get_render_cost_limiter,
+    parse_rate,
+    prefilter,
+)
+
+# Fixtures
+########################################################################################
+
+
+@pytest.fixture(autouse=True)
+def enable_ratelimit(settings):
+    settings.API_RATELIMIT_ENABLE = True
+    settings.API_RATELIMIT_IP_META_KEY = "REMOTE_ADDR"
+    yield
+    cache.clear()
+    prefilter.clear()
+
+
+class DelayedCache:
+    """
+    キャッシュへの通信の遅延を再現するため、各操作の前に待機するラッパー
+    """
+
+    def __init__(self, cache, delay: float):
+        self.cache = cache
+        self.delay = delay
+
+    def __getattr__(self, name):
+        method = getattr(self.cache, name)
+
+        def delayed(*args, **kwargs):
+            time.sleep(self.delay)
+            return method(*args, **kwargs)
+
+        return delayed
+
+
+def make_request(ip: str = "192.0.2.5"):
+    return RequestFactory().get("/api/get/", REMOTE_ADDR=ip)
+
+
+# Tests
+########################################################################################
+
+# parse_rate()
+
+
+@pytest.mark.parametrize(
+    "rate, expected",
+    [
+        ("50/s", (50, 1)),
+        ("500/m", (500, 60)),
+        ("10/5m", (10, 300)),
+        ("1/d", (1, 86400)),
+    ],
+)
+def test_parse_rate(rate, expected):
+    assert parse_rate(rate) == expected
+
+
+def test_parse_rate_invalid():
+    with pytest.raises(ValueError):
+        parse_rate("50/x")
+
+
+# TokenBucketPrefilter
+
+
+def test_prefilter_burst_and_refill():
+    bucket = TokenBucketPrefilter(rate=10, burst=3)
+    with patch("api.ratelimit.time.monotonic", return_value=100.0):
+        assert [bucket.allow("a") for _ in range(4)] == [True, True, True, False]
+        # 他のキーには影響しない
+        assert bucket.allow("b")
+    with patch("api.ratelimit.time.monotonic", return_value=100.15):
+        assert bucket.allow("a")
+        assert not bucket.allow("a")
+    with patch("api.ratelimit.time.monotonic", return_value=200.0):
+        # 最大トークン数までしか補充されない
+        assert [bucket.allow("a") for _ in range(4)] == [True, True, True, False]
+
+
+def test_prefilter_max_keys():
+    bucket = TokenBucketPrefilter(rate=0, burst=1, max_keys=2)
+    assert bucket.allow("a")
+    assert bucket.allow("b")
+    assert bucket.allow("c")
+    # 最も古いキー"a"は削除されているため、再び最大トークン数から始まる
+    assert bucket.allow("a")
+    assert not bucket.allow("c")
+
+
+# RateLimiter
+
+
+def test_is_limited_all_windows():
+    limiter = RateLimiter("test", ["3/s", "4/m"])
+    with patch("api.ratelimit.time.time", return_value=1000.5):
+        results = [limiter.is_limited(make_request()) for _ in range(4)]
+        assert results == [False, False, False, True]
+        assert not limiter.is_limited(make_request("192.0.2.6"))
+    with patch("api.ratelimit.time.time", return_value=1001.5):
+        # 秒の時間枠は切り替わったが、分の時間枠で制限される
+        assert not limiter.is_limited(make_request())
+        assert limiter.is_limited(make_request())
+
+
+def test_is_limited_prefilter_no_cache_access():
+    limiter = RateLimiter("test", ["1000/s"])
+    with patch.object(prefilter, "allow", return_value=False):
+        with patch.object(cache, "incr") as incr:
+            assert limiter.is_limited(make_request())
+    incr.assert_not_called()
+
+
+def test_is_limited_disabled(settings):
+    settings.API_RATELIMIT_ENABLE = False
+    limiter = RateLimiter("test", ["1/m"])
+    assert not limiter.is_limited(make_request())
+    assert not limiter.is_limited(make_request())
+
+
+# get_rate_limiter()
+
+
+def test_get_rate_limiter(settings):
+    settings.API_RATELIMITS = {"api:get": ["5/s"], "other": ["1/m"]}
+    limiter = get_rate_limiter("api:get")
+    assert limiter.limits == [(5, 1)]
+    assert get_rate_limiter("api:get") is limiter
+    assert get_rate_limiter("other").limits == [(1, 60)]
+    assert get_rate_limiter("unknown").limits == []
+
+
+# consume()
+
+
+def test_consume_cost():
+    windows = {"test:a": 100, "test:b": 1000}
+    assert consume(cache, windows, 60, 60) == set()
+    assert cache.get_many(list(windows)) == {"test:a": 60, "test:b": 60}
+    assert consume(cache, windows, 30, 60) == set()
+    # 1つの時間枠でも上限を超える場合は、どのカウンターにも加算しない
+    assert consume(cache, windows, 30, 60) == {"test:a"}
+    assert cache.get_many(list(windows)) == {"test:a": 90, "test:b": 90}
+
+
+def test_consume_cost_over_limit_once():
+    """
+    上限を超えるコストは、時間枠のカウンターが0の場合に1回だけ受け付ける
+    """
+    windows = {"test:a": 100}
+    assert consume(cache, windows, 500, 60) == set()
+    assert consume(cache, windows, 1, 60) == {"test:a"}
+
+
+def test_consume_cache_calls():
+    """
+    受け付ける場合はget_many()と時間枠毎の加算、上限に達している場合はget_many()のみ
+    """
+    windows = {"test:a": 2, "test:b": 1000}
+    cache.set("test:b", 5, 60)
+    with patch.object(
+        cache, "get_many", wraps=cache.get_many
+    ) as get_many, patch.object(cache, "add", wraps=cache.add) as add, patch.object(
+        cache, "incr", wraps=cache.incr
+    ) as incr:
+        assert consume(cache, windows, 1, 60) == set()
+        assert get_many.call_count == 1
+        # カウンターが無い時間枠はadd()、ある時間枠はincr()で加算する
+        add.assert_called_once_with("test:a", 1, 60)
+        incr.assert_called_once_with("test:b", 1)
+
+        assert consume(cache, windows, 1, 60) == set()
+        get_many.reset_mock()
+        add.reset_mock()
+        incr.reset_mock()
+        assert consume(cache, windows, 1, 60) == {"test:a"}
+        get_many.assert_called_once()
+        add.assert_not_called()
+        incr.assert_not_called()
+    assert cache.get_many(list(windows)) == {"test:a": 2, "test:b": 7}
+
+
+def test_consume_concurrent():
+    """
+    複数のワーカーが同時に加算しても、上限を超えて受け付けない
+    """
+    windows = {"test:a": 50, "test:b": 1000}
+    delayed_cache = DelayedCache(cache, delay=0.0005)
+    results = []
+
+    def run():
+        results.append(consume(delayed_cache, windows, 1, 60))
+
+    threads = [threading.Thread(target=run) for _ in range(200)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results.count(set()) == 50
+    assert results.count({"test:a"}) == 150
+    assert cache.get_many(list(windows)) == {"test:a": 50, "test:b": 50}
+
+
+# get_render_cost()
+
+
+def test_get_render_cost(settings):
+    settings.API_RENDER_COST_FORMAT_FACTORS = {"jpeg": 0.5, "png": 2.0}
+    jpeg = JPEGPlainProfile(width=10, height=3, color_rgb=ColorRGB(), quality=75)
+    png = PNGPlainProfile(width=10, height=3, color_rgb=ColorRGB(), alpha=255)
+    assert get_render_cost(jpeg) == 15
+    assert get_render_cost(png) == 60
+
+
+# RenderCostLimiter
+
+
+def test_render_cost_limiter_client():
+    limiter = RenderCostLimiter("test", ["250/m"], ["1000/m"])
+    profile = PNGPlainProfile(width=10, height=10, color_rgb=ColorRGB(), alpha=255)
+    assert limiter.charge(make_request(), profile) is None
+    assert limiter.charge(make_request(), profile) is None
+    assert limiter.charge(make_request(), profile) == "client"
+    # 他のクライアントはノード全体の上限まで生成できる
+    assert limiter.charge(make_request("192.0.2.6"), profile) is None
+
+
+def test_render_cost_limiter_node():
+    limiter = RenderCostLimiter("test", ["250/m"], ["300/m"])
+    profile = PNGPlainProfile(width=10, height=10, color_rgb=ColorRGB(), alpha=255)
+    assert limiter.charge(make_request("192.0.2.5"), profile) is None
+    assert limiter.charge(make_request("192.0.2.6"), profile) is None
+    assert limiter.charge(make_request("192.0.2.7"), profile) is None
+    assert limiter.charge(make_request("192.0.2.8"), profile) == "node"
+
+
+def test_render_cost_limiter_disabled(settings):
+    settings.API_RATELIMIT_ENABLE = False
+    limiter = RenderCostLimiter("test", ["1/m"], ["1/m"])
+    profile = PNGPlainProfile(width=10, height=10, color_rgb=ColorRGB(), alpha=255)
+    assert limiter.charge(make_request(), profile) is None
+    assert limiter.charge(make_request(), profile) is None
+
+
+def test_get_render_cost_limiter(settings):
+    settings.API_RENDER_QUOTAS = {"api:get": ["5/s"]}
+    settings.API_NODE_RENDER_QUOTAS = {"api:get": ["10/s"]}
+    limiter = get_render_cost_limiter("api:get")
+    assert limiter.client_limiter.limits == [(5, 1)]
+    assert limiter.node_limiter.limits == [(10, 1)]
+    assert get_render_cost_limiter("api:get") is limiter
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import io
 import json
 import time
 from unittest.mock import patch
@@ -12,6 +13,7 @@ from django.test import Client
 from django.urls import reverse
 
 from api.image_processing import ImageProfileAbstract
+from api.ratelimit import prefilter
 
 # テスト用のIPアドレス (RFC5737)
 # 192.0.2.0/24 (TEST-NET-1)
@@ -42,7 +44,7 @@ class ImageProfileStub(ImageProfileAbstract):
         raise NotImplementedError()
 
     def dump_signiture(self) -> str:
-        raise NotImplementedError()
+        return "image_profile_signiture"
 
 
 # Fixtures
@@ -57,20 +59,23 @@ def patch_services():
     with patch("api.views.GetView.image_processing_service", autospec=True) as ips:
         with patch("api.views.GetView.image_model_service", autospec=True) as ims:
             ips.create_profile.return_value = ImageProfileStub()
-            ips.create_image.return_value = "image_path"
+            ips.create_image_file.return_value = io.BytesIO(b"image")
             ims.get_cache_image_url.return_value = "https://example.com/cache_image_url"
-            ims.upload_image.return_value = "https://example.com/uploaded_image_url"
+            ims.upload_image_file.return_value = (
+                "https://example.com/uploaded_image_url"
+            )
             yield
 
 
 @pytest.fixture(autouse=True)
 def clear_cache():
     """
-    レート制限処理がキャッシュに依存しているため、
-    テスト関数毎にキャッシュを全て削除する。
+    レート制限処理がキャッシュとプロセス内のトークンバケットに依存しているため、
+    テスト関数毎にキャッシュとトークンバケットを全て削除する。
     """
     yield
     cache.clear()
+    prefilter.clear()
 
 
 @pytest.fixture
@@ -96,9 +101,10 @@ def test_ratelimit_not_exceed(client: Client, rate_per_second: int):
 
 def test_ratelimit_exceed(client: Client, rate_per_second: int):
     """
-    django-ratelimitによるレート制限が掛かるまでのリクエスト回数にブレがある。
+    レート制限は固定の時間枠で数えるため、リクエスト中に時間枠が切り替わると
+    制限が掛かるまでのリクエスト回数にブレがある。
     そのため、きっかり (レート制限 + 1) 回目に制限が掛かることの検証は出来ない。
-    原因が不明で対処できないため、レート制限回数の2倍の回数までに制限が掛かれば許容とする。
+    レート制限回数の2倍の回数までに制限が掛かれば許容とする。
     """
     for request_count in range(1, rate_per_second * 2 + 1):
         response = client.get(reverse("api:get"), HTTP_X_REAL_IP="192.0.2.5")
@@ -157,7 +163,7 @@ def test_ratelimit_per_minute_exceed(
     """
     1秒間のレート制限に掛からないリクエストレートで、
     1分以内にレート制限を越えるリクエストを行うとアクセス制限されることを確認する
-    尚、django-ratelimitによるレート制限が掛かるまでのリクエスト回数にはブレがあるため、
+    尚、時間枠の切り替わりにより、レート制限が掛かるまでのリクエスト回数にはブレがあるため、
     レート制限の2倍の回数までにアクセス制限が掛かればOKとする。
     """
     count = 1
@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import io
+
+import PIL.Image
+
+from api.image_processing import ColorRGB, JPEGPlainProfile, PNGPlainProfile
+from api.render_backends import InProcessRenderBackend, SpooledImageFile
+
+# Tests
+########################################################################################
+
+
+def test_create_image_file_jpeg():
+    profile = JPEGPlainProfile(
+        width=30, height=20, color_rgb=ColorRGB(93, 56, 145), quality=70
+    )
+    with InProcessRenderBackend().create_image_file(profile) as image_file:
+        assert isinstance(image_file, SpooledImageFile)
+        pil_image = PIL.Image.open(image_file)
+        assert pil_image.format == "JPEG"
+        assert pil_image.size == (30, 20)
+
+
+def test_create_image_file_png():
+    profile = PNGPlainProfile(
+        width=30, height=20, color_rgb=ColorRGB(93, 56, 145), alpha=100
+    )
+    with InProcessRenderBackend().create_image_file(profile) as image_file:
+        pil_image = PIL.Image.open(image_file)
+        assert pil_image.format == "PNG"
+        assert pil_image.getpixel((0, 0)) == (93, 56, 145, 100)
+
+
+def test_create_image_file_spooled(settings):
+    profile = PNGPlainProfile(width=30, height=20)
+
+    settings.IMAGE_SPOOL_MAX_SIZE = 1024 * 1024
+    with InProcessRenderBackend().create_image_file(profile) as image_file:
+        assert image_file._rolled is False
+
+    settings.IMAGE_SPOOL_MAX_SIZE = 16
+    with InProcessRenderBackend().create_image_file(profile) as image_file:
+        assert image_file._rolled is True
+        assert PIL.Image.open(image_file).format == "PNG"
+
+
+def test_write_image():
+    profile = PNGPlainProfile(
+        width=30, height=20, color_rgb=ColorRGB(93, 56, 145), alpha=100
+    )
+    fp = io.BytesIO()
+    InProcessRenderBackend().write_image(profile, fp)
+    fp.seek(0)
+    assert PIL.Image.open(fp).getpixel((0, 0)) == (93, 56, 145, 100)
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import io
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import MagicMock, patch
+
+import PIL.Image
+import pytest
+
+from api.image_processing import ColorRGB, JPEGPlainProfile, PNGPlainProfile
+from api.render_backends import (
+    ProcessPoolRenderBackend,
+    SpooledImageFile,
+    render_image_to_file,
+)
+
+# Fixtures
+########################################################################################
+
+
+@pytest.fixture(scope="module")
+def backend():
+    backend = ProcessPoolRenderBackend(pixel_threshold=100 * 100, max_workers=1)
+    yield backend
+    backend.shutdown()
+
+
+# Tests
+########################################################################################
+
+
+def test_render_image_to_file(tmp_path):
+    profile = PNGPlainProfile(width=10, height=10, color_rgb=ColorRGB(1, 2, 3))
+    image_path = render_image_to_file(profile, str(tmp_path))
+    try:
+        assert os.path.dirname(image_path) == str(tmp_path)
+        assert image_path.endswith(".png")
+        assert PIL.Image.open(image_path).getpixel((0, 0)) == (1, 2, 3, 255)
+    finally:
+        os.unlink(image_path)
+
+
+def test_small_image_in_process(backend: ProcessPoolRenderBackend):
+    profile = JPEGPlainProfile(width=99, height=100)
+    with backend.create_image_file(profile) as image_file:
+        assert isinstance(image_file, SpooledImageFile)
+        assert PIL.Image.open(image_file).format == "JPEG"
+
+
+def test_large_image_in_process_pool(backend: ProcessPoolRenderBackend):
+    profile = PNGPlainProfile(
+        width=100, height=100, color_rgb=ColorRGB(93, 56, 145), alpha=100
+    )
+    with backend.create_image_file(profile) as image_file:
+        assert not isinstance(image_file, SpooledImageFile)
+        assert image_file.tell() == 0
+        # 一時ファイルは削除済み
+        assert not os.path.exists(image_file.name)
+
+        pil_image = PIL.Image.open(image_file)
+        assert pil_image.format == "PNG"
+        assert pil_image.size == (100, 100)
+        assert pil_image.getpixel((99, 99)) == (93, 56, 145, 100)
+
+
+def test_write_image_small_in_process(backend: ProcessPoolRenderBackend):
+    profile = JPEGPlainProfile(width=99, height=100)
+    fp = io.BytesIO()
+    with patch.object(backend, "render_in_pool") as render_in_pool:
+        backend.write_image(profile, fp)
+    render_in_pool.assert_not_called()
+    fp.seek(0)
+    assert PIL.Image.open(fp).format == "JPEG"
+
+
+def test_write_image_large_in_process_pool(backend: ProcessPoolRenderBackend):
+    profile = PNGPlainProfile(
+        width=100, height=100, color_rgb=ColorRGB(93, 56, 145), alpha=100
+    )
+    fp = io.BytesIO()
+    with patch.object(
+        backend, "render_in_pool", wraps=backend.render_in_pool
+    ) as render_in_pool:
+        backend.write_image(profile, fp)
+    render_in_pool.assert_called_once_with(profile)
+    fp.seek(0)
+    pil_image = PIL.Image.open(fp)
+    assert pil_image.format == "PNG"
+    assert pil_image.getpixel((99, 99)) == (93, 56, 145, 100)
+
+
+def test_recover_from_killed_workers(backend: ProcessPoolRenderBackend):
+    """
+    ワーカープロセスが強制終了された場合も、プールを作り直して生成できる
+    """
+    profile = PNGPlainProfile(width=100, height=100, color_rgb=ColorRGB(1, 2, 3))
+    backend.warm_up()
+    executor = backend.get_executor()
+    for process in list(executor._processes.values()):
+        process.kill()
+        process.join()
+
+    with backend.create_image_file(profile) as image_file:
+        assert PIL.Image.open(image_file).format == "PNG"
+    assert backend.get_executor() is not executor
+    with backend.create_image_file(profile) as image_file:
+        assert PIL.Image.open(image_file).format == "PNG"
+
+
+def test_broken_after_retry():
+    backend = ProcessPoolRenderBackend(pixel_threshold=1, max_workers=1, prefork=False)
+    broken = MagicMock()
+    broken.submit.side_effect = BrokenProcessPool()
+    with patch.object(backend, "get_executor", return_value=broken):
+        with pytest.raises(BrokenProcessPool):
+            backend.create_image_file(PNGPlainProfile(width=10, height=10))
+    # 1回だけ再試行する
+    assert broken.submit.call_count == 2
+    broken.shutdown.assert_called_with(wait=False)
+
+
+def test_prefork_in_background():
+    """
+    ワーカープロセスの起動を待たずに返す
+    """
+    started = threading.Event()
+    release = threading.Event()
+
+    def warm_up(self):
+        started.set()
+        release.wait(5)
+
+    with patch.object(ProcessPoolRenderBackend, "warm_up", warm_up):
+        ProcessPoolRenderBackend(max_workers=1).warm_up_in_background()
+        assert started.wait(5)
+        release.set()
+
+
+def test_prefork_disabled():
+    backend = ProcessPoolRenderBackend(max_workers=1, prefork=False)
+    with patch.object(ProcessPoolRenderBackend, "warm_up") as warm_up:
+        backend.warm_up_in_background()
+    warm_up.assert_not_called()
+    assert backend._executor is None
+
+
+def test_pool_recreated_after_fork(monkeypatch):
+    """
+    フォークした子プロセスでは、親プロセスのプールを使わずに作り直す
+    """
+    backend = ProcessPoolRenderBackend(max_workers=1, prefork=False)
+    with patch("api.render_backends.ProcessPoolExecutor") as executor_class:
+        executor = backend.get_executor()
+        monkeypatch.setattr("os.getpid", lambda: backend._pid + 1)
+        executor_class.return_value = MagicMock()
+        assert backend.get_executor() is not executor
+    assert executor_class.call_count == 2
@@ -1,15 +1,17 @@
 from __future__ import annotations
 
+import io
 import os
 from tempfile import TemporaryDirectory
 from unittest.mock import PropertyMock, patch
 
 import PIL.Image
 import pytest
+from asgiref.sync import async_to_sync
 from django.core.files import File
 
 from api.image_processing import ImageProfileAbstract
-from api.models import Image
+from api.models import Image, get_upload_name
 from api.services import ImageModelService
 
 # Stubs
@@ -116,5 +118,110 @@ def test_upload_image(image_url_prefix, temp_image_path):
         ):
             result = ImageModelService.upload_image(temp_image_path, profile)
 
-    expected_url = image_url_prefix + "upload_image_file_name.jpeg"
+    expected_url = image_url_prefix + get_upload_name("image_profile_signiture", "jpeg")
     assert result == expected_url
+
+
+def test_upload_image_file(image_url_prefix):
+    image_file = io.BytesIO()
+    PIL.Image.new("RGB", (10, 10), (10, 10, 10)).save(image_file, format="jpeg")
+    image_file.seek(0)
+
+    with patch.object(
+        ImageProfileStub,
+        "upload_file_name",
+        new_callable=PropertyMock(return_value="upload_image_file_name.jpeg"),
+    ):
+        profile = ImageProfileStub()
+        with patch.object(
+            profile, "dump_signiture", return_value="image_profile_signiture"
+        ):
+            result = ImageModelService.upload_image_file(image_file, profile)
+
+    expected_url = image_url_prefix + get_upload_name("image_profile_signiture", "jpeg")
+    assert result == expected_url
+    image = Image.objects.get(profile_signiture="image_profile_signiture")
+    assert image.byte_size == len(image_file.getvalue())
+
+
+def test_get_cache_image_url_single_query(existing_images, django_assert_num_queries):
+    profile = ImageProfileStub()
+    with patch.object(
+        profile, "dump_signiture", return_value=existing_images[0].profile_signiture
+    ):
+        with django_assert_num_queries(1):
+            result = ImageModelService.get_cache_image_url(profile=profile)
+    assert result == existing_images[0].upload.url
+
+
+def test_get_cache_image_url_cached(existing_images, django_assert_num_queries):
+    profile = ImageProfileStub()
+    with patch.object(
+        profile, "dump_signiture", return_value=existing_images[0].profile_signiture
+    ):
+        ImageModelService.get_cache_image_url(profile=profile)
+        with django_assert_num_queries(0):
+            result = ImageModelService.get_cache_image_url(profile=profile)
+    assert result == existing_images[0].upload.url
+
+
+def test_upload_image_file_write_through(temp_image_path, django_assert_num_queries):
+    with patch.object(
+        ImageProfileStub,
+        "upload_file_name",
+        new_callable=PropertyMock(return_value="upload_image_file_name.jpeg"),
+    ):
+        profile = ImageProfileStub()
+        with patch.object(
+            profile, "dump_signiture", return_value="image_profile_signiture"
+        ):
+            with open(temp_image_path, "rb") as f:
+                uploaded_url = ImageModelService.upload_image_file(f, profile)
+            with django_assert_num_queries(0):
+                result = ImageModelService.get_cache_image_url(profile=profile)
+    assert result == uploaded_url
+
+
+def test_delete_evicts_cache_image_url(existing_images):
+    profile = ImageProfileStub()
+    with patch.object(
+        profile, "dump_signiture", return_value=existing_images[0].profile_signiture
+    ):
+        ImageModelService.get_cache_image_url(profile=profile)
+        existing_images[0].delete()
+        result = ImageModelService.get_cache_image_url(profile=profile)
+    assert result is None
+
+
+def test_get_cache_image_url_lru(existing_images):
+    profile = ImageProfileStub()
+    with patch.object(
+        profile, "dump_signiture", return_value=existing_images[0].profile_signiture
+    ):
+        ImageModelService.get_cache_image_url(profile=profile)
+        with patch.object(ImageModelService, "get_url_cache") as get_url_cache:
+            result = ImageModelService.get_cache_image_url(profile=profile)
+            get_url_cache.assert_not_called()
+    assert result == existing_images[0].upload.url
+
+
+def test_aget_cache_image_url(existing_images):
+    profile = ImageProfileStub()
+    with patch.object(
+        profile, "dump_signiture", return_value=existing_images[1].profile_signiture
+    ):
+        result = async_to_sync(ImageModelService.aget_cache_image_url)(profile)
+        cached_result = ImageModelService.url_lru.get(
+            existing_images[1].profile_signiture
+        )
+    assert result == existing_images[1].upload.url
+    assert cached_result == existing_images[1].upload.url
+
+
+def test_aget_cache_image_url_not_exists(existing_images):
+    profile = ImageProfileStub()
+    with patch.object(
+        profile, "dump_signiture", return_value="new_image_profile_signiture"
+    ):
+        result = async_to_sync(ImageModelService.aget_cache_image_url)(profile)
+    assert result is None
@@ -2,9 +2,12 @@ from __future__ import annotations
 
 import os
 from tempfile import TemporaryDirectory
+from unittest.mock import MagicMock, patch
 
 import pytest
+from storages.backends.s3boto3 import S3Boto3Storage
 
+from api import models
 from api.image_processing import (
     ColorRGB,
     ImageProfileAbstract,
@@ -12,7 +15,7 @@ from api.image_processing import (
     PNGPlainProfile,
 )
 from api.models import Image
-from api.services import ImageModelService
+from api.services import ImageModelService, ImageProcessingService
 
 # Fixtures
 ########################################################################################
@@ -42,11 +45,17 @@ def sample_profile(request):
     return request.param
 
 
+def get_upload_name(profile: ImageProfileAbstract) -> str:
+    return models.get_upload_name(profile.dump_signiture(), profile.get_extension())
+
+
 # Tests
 ########################################################################################
 
 
-def test_get_cache_image_url_exists(image_url_prefix, sample_profile: ImageProfileAbstract):
+def test_get_cache_image_url_exists(
+    image_url_prefix, sample_profile: ImageProfileAbstract
+):
     with TemporaryDirectory() as temp_dir:
         pil_image = sample_profile.create_pil_image()
         temp_image_path = os.path.join(
@@ -56,7 +65,7 @@ def test_get_cache_image_url_exists(image_url_prefix, sample_profile: ImageProfi
 
         ImageModelService.upload_image(temp_image_path, sample_profile)
 
-    expected_url = image_url_prefix + sample_profile.upload_file_name
+    expected_url = image_url_prefix + get_upload_name(sample_profile)
 
     result = ImageModelService.get_cache_image_url(profile=sample_profile)
 
@@ -78,5 +87,60 @@ def test_upload_image(image_url_prefix, settings, sample_profile: ImageProfileAb
 
         result = ImageModelService.upload_image(temp_image_path, sample_profile)
 
-    expected_url = image_url_prefix + sample_profile.upload_file_name
+    expected_url = image_url_prefix + get_upload_name(sample_profile)
+    assert result == expected_url
+
+
+def test_upload_image_file(image_url_prefix, sample_profile: ImageProfileAbstract):
+    with ImageProcessingService.create_image_file(sample_profile) as image_file:
+        result = ImageModelService.upload_image_file(image_file, sample_profile)
+
+    expected_url = image_url_prefix + get_upload_name(sample_profile)
     assert result == expected_url
+    assert ImageModelService.get_cache_image_url(profile=sample_profile) == expected_url
+
+
+def test_stream_upload_image(image_url_prefix, sample_profile: ImageProfileAbstract):
+    result = ImageModelService.stream_upload_image(
+        sample_profile, sample_profile.save_image
+    )
+
+    expected_url = image_url_prefix + get_upload_name(sample_profile)
+    assert result == expected_url
+    image = Image.objects.get(profile_signiture=sample_profile.dump_signiture())
+    assert image.byte_size == image.upload.size
+
+
+def test_stream_upload_image_s3(settings, sample_profile: ImageProfileAbstract):
+    settings.IMAGE_MULTIPART_UPLOAD = {
+        "PART_SIZE": 8 * 1024 * 1024,
+        "MAX_CONCURRENCY": 2,
+        "MAX_QUEUED_PARTS": 1,
+    }
+    storage = MagicMock(spec=S3Boto3Storage)
+    storage.bucket_name = "bucket"
+    storage.generate_filename.side_effect = lambda name: name
+    storage._normalize_name.side_effect = lambda name: f"prefix/{name}"
+    storage._get_write_parameters.return_value = {"ContentType": "image/png"}
+    storage.url.return_value = "https://bucket/image"
+    client = storage.connection.meta.client
+    field = Image._meta.get_field("upload")
+
+    with patch.object(field, "storage", storage):
+        result = ImageModelService.stream_upload_image(
+            sample_profile, sample_profile.save_image
+        )
+
+    name = get_upload_name(sample_profile)
+    assert result == "https://bucket/image"
+    # 保存前の存在確認をしない
+    storage.get_available_name.assert_not_called()
+    storage.exists.assert_not_called()
+    client.put_object.assert_called_once()
+    put_kwargs = client.put_object.call_args.kwargs
+    assert put_kwargs["Bucket"] == "bucket"
+    assert put_kwargs["Key"] == f"prefix/{name}"
+    assert put_kwargs["ContentType"] == "image/png"
+    image = Image.objects.get(profile_signiture=sample_profile.dump_signiture())
+    assert image.upload.name == name
+    assert image.byte_size == len(put_kwargs["Body"])
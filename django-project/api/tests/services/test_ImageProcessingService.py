@@ -1,8 +1,10 @@
 from __future__ import annotations
 
+import io
 import os
+from concurrent.futures.process import BrokenProcessPool
 from tempfile import TemporaryDirectory
-from unittest.mock import patch
+from unittest.mock import MagicMock, PropertyMock, patch
 
 import PIL.Image
 import pytest
@@ -10,7 +12,12 @@ from django import forms
 from django.http import QueryDict
 
 from api.image_processing import ImageProfileAbstract, ImageProfileForm, QueryError
-from api.services import ImageProcessingService
+from api.services import (
+    ImageProcessingService,
+    RenderBudget,
+    RenderBudgetExceeded,
+    warm_up_worker,
+)
 
 # Stubs
 ########################################################################################
@@ -155,3 +162,98 @@ def test_create_image_base_dir_not_exist():
     expected_error_message = "No such directory. base_dir: /path/to/fake/dir"
     with pytest.raises(FileNotFoundError, match=expected_error_message):
         ImageProcessingService.create_image(ImageProfileStub(quality=75), fake_dir)
+
+
+# ImageProcessingService.create_image_file()
+
+
+def test_create_image_file_quality_None():
+    with ImageProcessingService.create_image_file(
+        ImageProfileStub(quality=None)
+    ) as image_file:
+        assert image_file.tell() == 0
+        pil_image = PIL.Image.open(image_file)
+        assert pil_image.format == "JPEG"
+        assert pil_image.size == (512, 512)
+
+
+def test_create_image_file_quality_75():
+    with ImageProcessingService.create_image_file(
+        ImageProfileStub(quality=75)
+    ) as image_file:
+        pil_image = PIL.Image.open(image_file)
+        assert pil_image.format == "JPEG"
+
+
+def test_create_image_file_in_memory(settings):
+    settings.IMAGE_SPOOL_MAX_SIZE = 1024 * 1024
+    with ImageProcessingService.create_image_file(
+        ImageProfileStub(quality=75)
+    ) as image_file:
+        assert image_file._rolled is False
+
+
+def test_create_image_file_rollover(settings):
+    settings.IMAGE_SPOOL_MAX_SIZE = 16
+    with ImageProcessingService.create_image_file(
+        ImageProfileStub(quality=75)
+    ) as image_file:
+        assert image_file._rolled is True
+        pil_image = PIL.Image.open(image_file)
+        assert pil_image.format == "JPEG"
+
+
+def test_create_image_file_render_budget_exceeded(settings):
+    settings.IMAGE_RENDER_BUDGET_TIMEOUT = 0
+    profile = ImageProfileStub(quality=75)
+    with patch.object(ImageProfileStub, "pixel_count", new_callable=PropertyMock) as pc:
+        pc.return_value = 10
+        with patch.object(
+            ImageProcessingService, "render_budget", RenderBudget(capacity=15)
+        ) as budget:
+            budget.acquire(10, timeout=0)
+            with pytest.raises(RenderBudgetExceeded):
+                ImageProcessingService.create_image_file(profile)
+            budget.release(10)
+
+            with ImageProcessingService.create_image_file(profile) as image_file:
+                assert PIL.Image.open(image_file).format == "JPEG"
+            assert budget.snapshot()["in_use"] == 0
+
+
+def test_create_image_file_broken_process_pool(settings):
+    """
+    レンダーバックエンドのプロセスプールが使えない場合は、503とするため
+    RenderBudgetExceeded例外に変換する
+    """
+    settings.IMAGE_RENDER_BUDGET_RETRY_AFTER = 3
+    backend = MagicMock()
+    backend.create_image_file.side_effect = BrokenProcessPool()
+    with patch.object(ImageProcessingService, "render_backend", backend):
+        with pytest.raises(RenderBudgetExceeded) as exc_info:
+            ImageProcessingService.create_image_file(ImageProfileStub(quality=75))
+    assert exc_info.value.retry_after == 3
+    assert ImageProcessingService.render_budget.snapshot()["in_use"] == 0
+
+
+def test_write_image_broken_process_pool(settings):
+    settings.IMAGE_RENDER_BUDGET_RETRY_AFTER = 3
+    backend = MagicMock()
+    backend.write_image.side_effect = BrokenProcessPool()
+    with patch.object(ImageProcessingService, "render_backend", backend):
+        with pytest.raises(RenderBudgetExceeded) as exc_info:
+            ImageProcessingService.write_image(
+                ImageProfileStub(quality=75), io.BytesIO()
+            )
+    assert exc_info.value.retry_after == 3
+    assert ImageProcessingService.render_budget.snapshot()["in_use"] == 0
+
+
+def test_warm_up_worker():
+    backend = MagicMock()
+    with patch.object(ImageProcessingService, "render_backend", backend), patch(
+        "api.storage_backends.warm_up_default_storage"
+    ) as warm_up_default_storage:
+        warm_up_worker()
+    backend.warm_up_in_background.assert_called_once_with()
+    warm_up_default_storage.assert_called_once_with()
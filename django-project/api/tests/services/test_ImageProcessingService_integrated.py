@@ -1,8 +1,10 @@
 from __future__ import annotations
 
+import io
 import os
 from tempfile import TemporaryDirectory
 
+import PIL.Image
 import pytest
 from django.http import QueryDict
 
@@ -90,6 +92,36 @@ def test_create_profile_query_invalid(invalid_query):
         ImageProcessingService.create_profile(QueryDict(invalid_query["query"]))
 
 
+# ImageProcessingService.create_canonical_profile()
+
+
+def test_create_canonical_profile_canonical_query(valid_query):
+    profile, canonical_query = ImageProcessingService.create_canonical_profile(
+        QueryDict(valid_query["query"])
+    )
+    assert isinstance(profile, valid_query["profile_class"])
+    assert canonical_query == valid_query["query"]
+
+
+def test_create_canonical_profile_normalized():
+    _, canonical_query = ImageProcessingService.create_canonical_profile(
+        QueryDict(
+            "color_rgb=%20f94%20&alpha=200&width=0320&profile_type=png_plain&height=960&v=1"
+        )
+    )
+    assert (
+        canonical_query
+        == "profile_type=png_plain&width=320&height=960&color_rgb=FF9944&alpha=200"
+    )
+
+
+def test_create_canonical_profile_query_invalid(invalid_query):
+    with pytest.raises(QueryError):
+        ImageProcessingService.create_canonical_profile(
+            QueryDict(invalid_query["query"])
+        )
+
+
 # ImageProcessingService.route_querydict()
 
 
@@ -155,3 +187,41 @@ def test_create_image_base_dir_not_exist():
 
     with pytest.raises(FileNotFoundError, match=expected_error_message):
         ImageProcessingService.create_image(sample_profile, fake_dir)
+
+
+# ImageProcessingService.create_image_file()
+
+
+def test_create_image_file(valid_query):
+    profile = ImageProcessingService.create_profile(QueryDict(valid_query["query"]))
+    with ImageProcessingService.create_image_file(profile) as image_file:
+        pil_image = PIL.Image.open(image_file)
+        assert pil_image.format == profile.get_extension().upper()
+        assert pil_image.size == (profile.width, profile.height)
+
+
+# ImageProcessingService.write_image()
+
+
+def test_write_image(valid_query):
+    profile = ImageProcessingService.create_profile(QueryDict(valid_query["query"]))
+    image_file = io.BytesIO()
+    ImageProcessingService.write_image(profile, image_file)
+
+    with ImageProcessingService.create_image_file(profile) as expected:
+        assert image_file.getvalue() == expected.read()
+
+
+# ImageProcessingService.get_query_parser()
+
+
+def test_get_query_parser_reused(valid_query):
+    profile_type = valid_query["profile_form_class"].get_profile_type()
+    parser = ImageProcessingService.get_query_parser(profile_type)
+    assert parser is not None
+    assert ImageProcessingService.get_query_parser(profile_type) is parser
+
+
+def test_get_query_parser_unknown_profile_type():
+    assert ImageProcessingService.get_query_parser("hogehoge") is None
+    assert ImageProcessingService.get_query_parser(None) is None
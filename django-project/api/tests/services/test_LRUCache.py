@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import threading
+from unittest.mock import patch
+
+from api.services import LRUCache
+
+# Tests
+########################################################################################
+
+
+def test_get_set():
+    lru = LRUCache(max_size=2, timeout=60)
+    lru.set("a", "url_a")
+    assert lru.get("a") == "url_a"
+    assert lru.get("b") is None
+    assert lru.stats() == {"size": 1, "hits": 1, "misses": 1}
+
+
+def test_evict_least_recently_used():
+    lru = LRUCache(max_size=2, timeout=60)
+    lru.set("a", "url_a")
+    lru.set("b", "url_b")
+    lru.get("a")
+    lru.set("c", "url_c")
+
+    assert lru.get("a") == "url_a"
+    assert lru.get("b") is None
+    assert lru.get("c") == "url_c"
+
+
+def test_expired():
+    lru = LRUCache(max_size=2, timeout=10)
+    with patch("api.services.time.monotonic", return_value=100.0):
+        lru.set("a", "url_a")
+    with patch("api.services.time.monotonic", return_value=109.0):
+        assert lru.get("a") == "url_a"
+    with patch("api.services.time.monotonic", return_value=110.0):
+        assert lru.get("a") is None
+    assert lru.stats()["size"] == 0
+
+
+def test_delete():
+    lru = LRUCache(max_size=2, timeout=60)
+    lru.set("a", "url_a")
+    lru.delete("a")
+    lru.delete("not_exists")
+    assert lru.get("a") is None
+
+
+def test_max_size_zero():
+    lru = LRUCache(max_size=0, timeout=60)
+    lru.set("a", "url_a")
+    assert lru.get("a") is None
+
+
+def test_threads():
+    lru = LRUCache(max_size=100, timeout=60)
+
+    def worker(n: int):
+        for i in range(1000):
+            key = f"{n}_{i % 150}"
+            lru.set(key, key)
+            lru.get(key)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = lru.stats()
+    assert stats["size"] == 100
+    assert stats["hits"] + stats["misses"] == 8000
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+
+from api.services import RenderBudget, RenderBudgetExceeded
+
+# Tests
+########################################################################################
+
+
+def test_acquire_release():
+    budget = RenderBudget(capacity=100)
+    assert budget.acquire(60, timeout=0) == 60
+    assert budget.snapshot()["in_use"] == 60
+
+    budget.release(60)
+    assert budget.snapshot()["in_use"] == 0
+
+
+def test_acquire_over_capacity_alone():
+    budget = RenderBudget(capacity=100)
+    assert budget.acquire(1000, timeout=0) == 100
+    budget.release(100)
+
+
+def test_exceeded(settings):
+    settings.IMAGE_RENDER_BUDGET_RETRY_AFTER = 3
+    budget = RenderBudget(capacity=100)
+    budget.acquire(60, timeout=0)
+
+    with pytest.raises(RenderBudgetExceeded) as exc_info:
+        budget.acquire(50, timeout=0.01)
+
+    assert exc_info.value.retry_after == 3
+    assert budget.snapshot() == {
+        "capacity": 100,
+        "in_use": 60,
+        "waiting": 0,
+        "rejected": 1,
+    }
+
+
+def test_wait_for_release():
+    budget = RenderBudget(capacity=100)
+    budget.acquire(60, timeout=0)
+
+    def release_later():
+        time.sleep(0.1)
+        budget.release(60)
+
+    thread = threading.Thread(target=release_later)
+    thread.start()
+    with budget.reserve(50, timeout=5):
+        assert budget.snapshot()["in_use"] == 50
+    thread.join()
+
+    assert budget.snapshot()["in_use"] == 0
+
+
+def test_reserve_released_on_error():
+    budget = RenderBudget(capacity=100)
+    with pytest.raises(ValueError):
+        with budget.reserve(50, timeout=0):
+            raise ValueError()
+    assert budget.snapshot()["in_use"] == 0
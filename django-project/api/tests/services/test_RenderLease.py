@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+from unittest.mock import MagicMock, Mock
+
+import pytest
+from django.core.cache import cache
+from django.core.cache.backends.memcached import PyLibMCCache
+
+from api.services import RenderLease, delete_if_equal
+
+# Fixtures
+########################################################################################
+
+
+@pytest.fixture(autouse=True)
+def lease_settings(settings):
+    settings.IMAGE_RENDER_LEASE_TIMEOUT = 60
+    settings.IMAGE_RENDER_LEASE_WAIT_TIMEOUT = 1
+    settings.IMAGE_RENDER_LEASE_POLL_INTERVAL = 0.01
+    settings.IMAGE_RENDER_LEASE_POLL_MAX_INTERVAL = 0.02
+    yield
+    cache.clear()
+
+
+# Tests
+########################################################################################
+
+
+def test_acquire_release():
+    lease = RenderLease("signiture")
+    other_lease = RenderLease("signiture")
+
+    assert lease.acquire() is True
+    assert other_lease.acquire() is False
+
+    lease.release()
+    assert other_lease.acquire() is True
+    other_lease.release()
+
+
+def test_release_not_owner():
+    lease = RenderLease("signiture")
+    other_lease = RenderLease("signiture")
+    lease.acquire()
+
+    other_lease.release()
+    assert cache.get(lease.key) == lease.token
+
+
+@pytest.fixture
+def pylibmc_cache():
+    pylibmc_cache = PyLibMCCache(
+        "127.0.0.1:11211", {"OPTIONS": {"behaviors": {"cas": True}}}
+    )
+    client = MagicMock()
+    client.behaviors = {"cas": True}
+    pylibmc_cache.__dict__["_cache"] = client
+    return pylibmc_cache
+
+
+def test_delete_if_equal_cas(pylibmc_cache):
+    client = pylibmc_cache._cache
+    key = pylibmc_cache.make_and_validate_key("lease")
+    client.gets.return_value = ("token", 10)
+    client.cas.return_value = True
+
+    assert delete_if_equal(pylibmc_cache, "lease", "token", 60) is True
+    client.gets.assert_called_once_with(key)
+    client.cas.assert_called_once_with(key, "", 10, 60)
+    client.delete.assert_called_once_with(key)
+    client.get.assert_not_called()
+
+
+def test_delete_if_equal_cas_taken_over(pylibmc_cache):
+    """
+    確認から置き換えまでの間に他のワーカーがリースを取得した場合は削除しない
+    """
+    client = pylibmc_cache._cache
+    client.gets.return_value = ("token", 10)
+    client.cas.return_value = False
+
+    assert delete_if_equal(pylibmc_cache, "lease", "token", 60) is False
+    client.delete.assert_not_called()
+
+
+def test_delete_if_equal_cas_other_value(pylibmc_cache):
+    client = pylibmc_cache._cache
+    client.gets.return_value = ("other", 10)
+
+    assert delete_if_equal(pylibmc_cache, "lease", "token", 60) is False
+    client.cas.assert_not_called()
+    client.delete.assert_not_called()
+
+
+def test_different_signiture():
+    assert RenderLease("signiture_1").acquire() is True
+    assert RenderLease("signiture_2").acquire() is True
+
+
+def test_acquire_or_wait_acquired():
+    lookup = Mock(return_value="http://example.com/image.jpeg")
+    lease = RenderLease("signiture")
+
+    assert lease.acquire_or_wait(lookup) is None
+    assert lease.acquired is True
+    lookup.assert_not_called()
+
+
+def test_acquire_or_wait_url_created():
+    RenderLease("signiture").acquire()
+    lookup = Mock(side_effect=[None, None, "http://example.com/image.jpeg"])
+    lease = RenderLease("signiture")
+
+    assert lease.acquire_or_wait(lookup) == "http://example.com/image.jpeg"
+    assert lease.acquired is False
+    assert lookup.call_count == 3
+
+
+def test_acquire_or_wait_take_over():
+    holder = RenderLease("signiture")
+    holder.acquire()
+
+    def lookup():
+        # リースの保持者が異常終了し、リースが失効した状況
+        cache.delete(holder.key)
+        return None
+
+    lease = RenderLease("signiture")
+    assert lease.acquire_or_wait(lookup) is None
+    assert lease.acquired is True
+
+
+def test_acquire_or_wait_released_after_lookup():
+    """
+    最後の確認の後に保持者が画像を登録してリースを解放した場合は、生成せずにURLを返す
+    """
+    holder = RenderLease("signiture")
+    holder.acquire()
+    lookups = []
+
+    def lookup():
+        lookups.append(None)
+        if len(lookups) == 1:
+            # 確認の直後に、保持者が画像を登録してリースを解放した状況
+            holder.release()
+            return None
+        return "http://example.com/image.jpeg"
+
+    lease = RenderLease("signiture")
+    assert lease.acquire_or_wait(lookup) == "http://example.com/image.jpeg"
+    assert lease.acquired is False
+    assert cache.get(lease.key) is None
+
+
+def test_acquire_or_wait_timeout(settings):
+    settings.IMAGE_RENDER_LEASE_WAIT_TIMEOUT = 0.05
+    RenderLease("signiture").acquire()
+    lease = RenderLease("signiture")
+
+    assert lease.acquire_or_wait(Mock(return_value=None)) is None
+    assert lease.acquired is False
@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+
+from api.services import SingleFlight
+
+# Tests
+########################################################################################
+
+
+def test_do_returns_result():
+    single_flight = SingleFlight()
+    assert single_flight.do("key", lambda x: x * 2, 21) == 42
+    assert single_flight.in_flight() == 0
+
+
+def test_do_coalesced():
+    single_flight = SingleFlight()
+    call_count = 0
+    results = []
+
+    def slow_func():
+        nonlocal call_count
+        call_count += 1
+        time.sleep(0.2)
+        return "result"
+
+    def worker():
+        results.append(single_flight.do("key", slow_func))
+
+    threads = [threading.Thread(target=worker) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert call_count == 1
+    assert results == ["result"] * 10
+    assert single_flight.in_flight() == 0
+
+
+def test_do_different_keys_not_coalesced():
+    single_flight = SingleFlight()
+    assert single_flight.do("key_1", lambda: 1) == 1
+    assert single_flight.do("key_2", lambda: 2) == 2
+
+
+def test_do_error_shared():
+    single_flight = SingleFlight()
+    errors = []
+
+    def slow_error():
+        time.sleep(0.2)
+        raise ValueError("error")
+
+    def worker():
+        try:
+            single_flight.do("key", slow_error)
+        except ValueError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=worker) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 5
+    assert single_flight.in_flight() == 0
+
+    # 失敗した後は再度実行できる
+    with pytest.raises(ValueError):
+        single_flight.do("key", slow_error)
@@ -0,0 +1,193 @@
+import threading
+from unittest import mock
+
+import pytest
+from botocore.exceptions import EndpointConnectionError
+from botocore.stub import Stubber
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+
+from api import metrics
+from api.storage_backends import (
+    PooledS3Storage,
+    save_overwrite,
+    warm_up_default_storage,
+)
+
+# Fixtures
+########################################################################################
+
+
+@pytest.fixture
+def storage(settings):
+    settings.API_METRICS_DIR = None
+    settings.IMAGE_S3_POOL = {
+        "MAX_POOL_CONNECTIONS": 2,
+        "WARM_CONNECTIONS": 2,
+        "CONNECT_TIMEOUT": 1,
+        "READ_TIMEOUT": 1,
+    }
+    for metric in [
+        metrics.s3_pool_size,
+        metrics.s3_pool_in_use,
+        metrics.s3_pool_saturated,
+    ]:
+        metric.reset()
+    return PooledS3Storage(
+        bucket_name="test-bucket",
+        access_key="test",
+        secret_key="test",
+        region_name="us-east-1",
+        endpoint_url="http://localhost:1",
+    )
+
+
+def get_value(metric):
+    return metric.values.get((), 0)
+
+
+# Tests
+########################################################################################
+
+
+def test_pool_config(storage):
+    config = storage.client.meta.config
+    assert config.max_pool_connections == 2
+    assert config.tcp_keepalive is True
+    assert config.connect_timeout == 1
+    assert get_value(metrics.s3_pool_size) == 2
+
+
+def test_client_shared_across_threads(storage):
+    """
+    スレッド毎のリソースは共有のクライアントを使う
+    """
+    client = storage.client
+    results = {}
+
+    def run():
+        results["client"] = storage.client
+        results["connection"] = storage.connection
+        results["bucket"] = storage.bucket
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+
+    assert results["client"] is client
+    assert results["connection"] is not storage.connection
+    assert results["connection"].meta.client is client
+    assert results["bucket"].meta.client is client
+    assert storage.connection.meta.client is client
+    assert storage.bucket is storage.bucket
+
+
+def test_client_recreated_after_fork(monkeypatch, storage):
+    client = storage.client
+    connection = storage.connection
+    pid = storage._client_pid
+
+    monkeypatch.setattr("os.getpid", lambda: pid + 1)
+    assert storage.client is not client
+    assert storage.connection is not connection
+    assert storage.connection.meta.client is storage.client
+
+
+def test_pool_metrics(storage):
+    in_use = []
+
+    def make_request(*args, **kwargs):
+        in_use.append(get_value(metrics.s3_pool_in_use))
+        if len(in_use) == 2:
+            raise EndpointConnectionError(endpoint_url=storage.endpoint_url)
+        return mock.Mock(status_code=200), {}
+
+    with mock.patch.object(
+        storage.client._endpoint, "make_request", side_effect=make_request
+    ):
+        storage.client.head_bucket(Bucket="test-bucket")
+        with pytest.raises(EndpointConnectionError):
+            storage.client.head_bucket(Bucket="test-bucket")
+
+    # 呼び出し中は使用数に含め、終了時 (エラーを含む) に戻す
+    assert in_use == [1, 1]
+    assert get_value(metrics.s3_pool_in_use) == 0
+    assert get_value(metrics.s3_pool_saturated) == 0
+
+
+def test_pool_metrics_saturated(storage):
+    storage.client
+    storage._in_use = storage.max_pool_connections
+    with mock.patch.object(
+        storage.client._endpoint,
+        "make_request",
+        return_value=(mock.Mock(status_code=200), {}),
+    ):
+        storage.client.head_bucket(Bucket="test-bucket")
+
+    assert get_value(metrics.s3_pool_saturated) == 1
+
+
+def test_warm_up(storage):
+    with Stubber(storage.client) as stubber:
+        stubber.add_response("head_bucket", {}, {"Bucket": "test-bucket"})
+        stubber.add_client_error("head_bucket", http_status_code=403)
+        # 失敗してもエラーとしない
+        storage.warm_up(5)
+        stubber.assert_no_pending_responses()
+
+
+def test_warm_up_default_storage(settings, storage):
+    with mock.patch("api.storage_backends.default_storage", storage), mock.patch.object(
+        PooledS3Storage, "warm_up"
+    ) as warm_up:
+        warm_up_default_storage()
+        # バックグラウンドのスレッドで実行される
+        for thread in threading.enumerate():
+            if thread.name == "impala-s3-warm-up":
+                thread.join()
+    warm_up.assert_called_once_with(2)
+
+
+def test_warm_up_default_storage_other_storage(settings):
+    with mock.patch.object(PooledS3Storage, "warm_up") as warm_up:
+        warm_up_default_storage()
+    warm_up.assert_not_called()
+
+
+def test_save_overwrite(storage):
+    """
+    既存のファイルを確認 (HeadObject) せずに、同じ名前で上書きする
+    """
+    content = ContentFile(b"image", name="image.png")
+    with mock.patch.object(storage, "exists") as exists, mock.patch.object(
+        storage, "_save", side_effect=lambda name, content: name
+    ) as save:
+        name = save_overwrite(storage, "images/ab/cd/abcd.png", content)
+    assert name == "images/ab/cd/abcd.png"
+    save.assert_called_once_with("images/ab/cd/abcd.png", content)
+    exists.assert_not_called()
+
+
+def test_save_overwrite_other_storage(tmp_path):
+    storage = FileSystemStorage(location=str(tmp_path))
+    name = save_overwrite(
+        storage, "images/ab/cd/abcd.png", ContentFile(b"image", name="image.png")
+    )
+    assert name == "images/ab/cd/abcd.png"
+    assert (tmp_path / name).read_bytes() == b"image"
+
+
+def test_save_overwrite_other_storage_existing(tmp_path):
+    """
+    既存のファイルがあっても別名とせず、同じ名前で上書きする
+    """
+    storage = FileSystemStorage(location=str(tmp_path))
+    storage.save("images/ab/cd/abcd.png", ContentFile(b"orphan", name="image.png"))
+
+    name = save_overwrite(
+        storage, "images/ab/cd/abcd.png", ContentFile(b"image", name="image.png")
+    )
+    assert name == "images/ab/cd/abcd.png"
+    assert (tmp_path / name).read_bytes() == b"image"
+    assert [path.name for path in (tmp_path / "images/ab/cd").iterdir()] == ["abcd.png"]
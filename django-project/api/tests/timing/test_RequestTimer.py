@@ -0,0 +1,95 @@
+import asyncio
+import json
+import logging
+
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from api.timing import RequestTimer, Stage, current_timer, record
+
+# Tests
+########################################################################################
+
+
+def test_stage_without_timer():
+    with Stage("noop"):
+        pass
+    record(outcome="hit")
+    assert current_timer.get() is None
+
+
+def test_stage_accumulates():
+    timer = RequestTimer()
+    with timer.activate():
+        with Stage("db"):
+            pass
+        with Stage("db"):
+            pass
+        with Stage("render"):
+            pass
+        record(outcome="miss", pixel_count=16)
+    assert current_timer.get() is None
+    assert list(timer.stages) == ["db", "render"]
+    assert timer.attributes == {"outcome": "miss", "pixel_count": 16}
+
+
+def test_stage_in_other_task_context():
+    """
+    コンテキストを引き継いだタスク内での計測も、同じタイマーに記録される
+    """
+    timer = RequestTimer()
+
+    async def measure():
+        with Stage("cache"):
+            await asyncio.sleep(0)
+
+    async def main():
+        with timer.activate():
+            await asyncio.create_task(measure())
+
+    asyncio.run(main())
+    assert "cache" in timer.stages
+
+
+def test_server_timing():
+    timer = RequestTimer()
+    timer.add("db", 0.0015)
+    timer.record(outcome="hit")
+    metrics = timer.server_timing().split(", ")
+    assert metrics[0] == "db;dur=1.500"
+    assert metrics[1].startswith("total;dur=")
+    assert metrics[2] == 'outcome;desc="hit"'
+
+
+def test_finish_not_slow(settings, caplog):
+    settings.API_SLOW_REQUEST_THRESHOLD = 60
+    timer = RequestTimer()
+    response = HttpResponse()
+    with caplog.at_level(logging.WARNING, logger="api.timing"):
+        timer.finish(RequestFactory().get("/api/get/"), response)
+    assert "Server-Timing" in response
+    assert caplog.records == []
+
+
+def test_finish_slow(settings, caplog):
+    settings.API_SLOW_REQUEST_THRESHOLD = 0
+    timer = RequestTimer()
+    timer.add("render", 0.25)
+    timer.record(outcome="miss", byte_size=100)
+    response = HttpResponse(status=302)
+    with caplog.at_level(logging.WARNING, logger="api.timing"):
+        timer.finish(RequestFactory().get("/api/get/?width=1"), response)
+
+    log = json.loads(caplog.records[0].getMessage())
+    assert log["event"] == "slow_request"
+    assert log["query"] == "width=1"
+    assert log["status"] == 302
+    assert log["stages_ms"] == {"render": 250.0}
+    assert log["byte_size"] == 100
+
+
+def test_finish_server_timing_disabled(settings):
+    settings.API_SERVER_TIMING = False
+    response = HttpResponse()
+    RequestTimer().finish(RequestFactory().get("/api/get/"), response)
+    assert "Server-Timing" not in response
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from api.uploads import MultipartUploadWriter
+
+# Stubs
+########################################################################################
+
+
+class S3ClientStub:
+    def __init__(self, fail_part: int | None = None):
+        self.fail_part = fail_part
+        self.calls: list[tuple[str, dict]] = []
+        self.parts: dict[int, bytes] = {}
+        self.active = 0
+        self.max_active = 0
+        self.release = threading.Event()
+        self.release.set()
+        self.lock = threading.Lock()
+
+    def put_object(self, **kwargs):
+        self.calls.append(("put_object", kwargs))
+
+    def create_multipart_upload(self, **kwargs):
+        self.calls.append(("create_multipart_upload", kwargs))
+        return {"UploadId": "upload_id"}
+
+    def upload_part(self, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            self.release.wait()
+            time.sleep(0.001)
+            if kwargs["PartNumber"] == self.fail_part:
+                raise RuntimeError("upload_part failed")
+            self.parts[kwargs["PartNumber"]] = kwargs["Body"]
+            return {"ETag": f"etag_{kwargs['PartNumber']}"}
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def complete_multipart_upload(self, **kwargs):
+        self.calls.append(("complete_multipart_upload", kwargs))
+
+    def abort_multipart_upload(self, **kwargs):
+        self.calls.append(("abort_multipart_upload", kwargs))
+
+    def call_names(self) -> list[str]:
+        return [name for name, _ in self.calls]
+
+
+# Fixtures
+########################################################################################
+
+
+@pytest.fixture(autouse=True)
+def small_min_part_size():
+    # テストでは5MiBのパートを扱わないよう、最小サイズを小さくする
+    with patch("api.uploads.MIN_PART_SIZE", 1):
+        yield
+
+
+def create_writer(client: S3ClientStub, **kwargs) -> MultipartUploadWriter:
+    options = {"part_size": 4, "max_concurrency": 2, "max_queued_parts": 1}
+    options.update(kwargs)
+    return MultipartUploadWriter(
+        client,
+        "bucket",
+        "images/key.png",
+        extra_args={"ContentType": "image/png"},
+        **options,
+    )
+
+
+# Tests
+########################################################################################
+
+
+def test_small_output_single_put():
+    client = S3ClientStub()
+    with create_writer(client) as writer:
+        writer.write(b"abc")
+
+    assert client.call_names() == ["put_object"]
+    assert client.calls[0][1] == {
+        "Bucket": "bucket",
+        "Key": "images/key.png",
+        "Body": b"abc",
+        "ContentType": "image/png",
+    }
+    assert writer.size == 3
+
+
+def test_multipart_upload():
+    client = S3ClientStub()
+    with create_writer(client) as writer:
+        for chunk in [b"ab", b"cdefghij", b"k"]:
+            writer.write(chunk)
+
+    assert client.call_names() == [
+        "create_multipart_upload",
+        "complete_multipart_upload",
+    ]
+    assert client.calls[0][1]["ContentType"] == "image/png"
+    assert client.parts == {1: b"abcd", 2: b"efgh", 3: b"ijk"}
+    complete = client.calls[1][1]
+    assert complete["UploadId"] == "upload_id"
+    assert complete["MultipartUpload"]["Parts"] == [
+        {"ETag": "etag_1", "PartNumber": 1},
+        {"ETag": "etag_2", "PartNumber": 2},
+        {"ETag": "etag_3", "PartNumber": 3},
+    ]
+    assert writer.size == 11
+
+
+def test_parts_uploaded_while_writing():
+    client = S3ClientStub()
+    with create_writer(client) as writer:
+        writer.write(b"abcd")
+        # エンコードの完了を待たずに最初のパートを送信する
+        for _ in range(100):
+            if 1 in client.parts:
+                break
+            time.sleep(0.01)
+        assert client.parts == {1: b"abcd"}
+
+
+def test_bounded_parts_in_flight():
+    client = S3ClientStub()
+    client.release.clear()
+    writer = create_writer(client, max_concurrency=2, max_queued_parts=1)
+
+    thread = threading.Thread(target=lambda: writer.write(b"x" * 40))
+    thread.start()
+    time.sleep(0.1)
+    # 送信中と送信待ちのパートが上限に達したため、write()は待っている
+    assert thread.is_alive()
+    assert len(writer._futures) == 3
+
+    client.release.set()
+    thread.join(timeout=5)
+    writer.finish()
+    assert len(client.parts) == 10
+    assert client.max_active <= 2
+
+
+def test_abort_on_error():
+    client = S3ClientStub()
+    with pytest.raises(ValueError):
+        with create_writer(client) as writer:
+            writer.write(b"abcdefgh")
+            raise ValueError()
+
+    assert client.call_names() == [
+        "create_multipart_upload",
+        "abort_multipart_upload",
+    ]
+
+
+def test_abort_on_part_failure():
+    client = S3ClientStub(fail_part=2)
+    with pytest.raises(RuntimeError):
+        with create_writer(client) as writer:
+            writer.write(b"abcdefghijkl")
+
+    assert "complete_multipart_upload" not in client.call_names()
+    assert client.call_names()[-1] == "abort_multipart_upload"
+
+
+def test_no_put_on_error_before_first_part():
+    client = S3ClientStub()
+    with pytest.raises(ValueError):
+        with create_writer(client) as writer:
+            writer.write(b"ab")
+            raise ValueError()
+
+    assert client.calls == []
+
+
+def test_part_size_too_small():
+    with patch("api.uploads.MIN_PART_SIZE", 5):
+        with pytest.raises(ValueError):
+            create_writer(S3ClientStub(), part_size=4)
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import json
+from unittest.mock import patch
+
+import PIL.Image
+import pytest
+from asgiref.sync import async_to_sync
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory
+from django.urls import reverse
+
+from api.image_processing import ImageProfileAbstract, QueryError
+from api.views import AsyncGetView
+
+# Stubs
+########################################################################################
+
+
+class ImageProfileStub(ImageProfileAbstract):
+    def create_pil_image(self) -> PIL.Image.Image:
+        raise NotImplementedError()
+
+    @property
+    def quality(self) -> int | None:
+        raise NotImplementedError()
+
+    @property
+    def upload_file_name(self) -> str:
+        raise NotImplementedError()
+
+    @classmethod
+    def get_extension(cls) -> str:
+        raise NotImplementedError()
+
+    def dump_signiture(self) -> str:
+        return "image_profile_signiture"
+
+
+# Fixtures
+########################################################################################
+
+
+@pytest.fixture(scope="session")
+def view_url() -> str:
+    return reverse("api:get")
+
+
+@pytest.fixture(scope="function")
+def patch_services():
+    with patch("api.views.GetView.image_processing_service", autospec=True) as ips:
+        with patch("api.views.GetView.image_model_service", autospec=True) as ims:
+            ips.create_profile.return_value = ImageProfileStub()
+            ips.create_image_file.return_value = io.BytesIO(b"image")
+            ims.upload_image_file.return_value = "http://example.com/uploaded.jpeg"
+            yield {"image_processing": ips, "image_model": ims}
+
+
+@pytest.fixture(scope="function")
+def get(view_url: str):
+    def get(query: str = ""):
+        request = AsyncRequestFactory().get(f"{view_url}?{query}")
+        return async_to_sync(AsyncGetView.as_view())(request)
+
+    return get
+
+
+# Tests
+########################################################################################
+
+
+def test_view_is_async():
+    assert AsyncGetView.view_is_async is True
+
+
+def test_cache_exists(get, patch_services: dict):
+    patch_services[
+        "image_model"
+    ].aget_cache_image_url.return_value = "http://example.com/cache.jpeg"
+
+    res = get()
+
+    patch_services["image_model"].aget_cache_image_url.assert_called()
+    patch_services["image_model"].get_cache_image_url.assert_not_called()
+    patch_services["image_processing"].create_image_file.assert_not_called()
+    assert res.status_code == 302
+    assert res.url == "http://example.com/cache.jpeg"
+
+
+def test_cache_None(get, patch_services: dict):
+    patch_services["image_model"].aget_cache_image_url.return_value = None
+    patch_services["image_model"].get_cache_image_url.return_value = None
+
+    res = get()
+
+    patch_services["image_processing"].create_image_file.assert_called()
+    patch_services["image_model"].upload_image_file.assert_called()
+    assert res.status_code == 302
+    assert res.url == "http://example.com/uploaded.jpeg"
+
+
+def test_create_profile_QueryError(get, patch_services: dict):
+    error_messages = {"field_1": ["error_message_1"]}
+    patch_services["image_processing"].create_profile.side_effect = QueryError(
+        error_messages
+    )
+
+    res = get()
+
+    patch_services["image_model"].aget_cache_image_url.assert_not_called()
+    assert res.status_code == 400
+    assert res.content == json.dumps(error_messages).encode("utf-8")
+
+
+def test_not_modified(view_url: str, patch_services: dict):
+    etag = AsyncGetView().get_etag(ImageProfileStub())
+    request = AsyncRequestFactory().get(view_url)
+    request.META["HTTP_IF_NONE_MATCH"] = etag
+
+    res = async_to_sync(AsyncGetView.as_view())(request)
+
+    patch_services["image_model"].aget_cache_image_url.assert_not_called()
+    assert res.status_code == 304
+    assert res["ETag"] == etag
+
+
+def test_precondition_failed(view_url: str, patch_services: dict):
+    request = AsyncRequestFactory().get(view_url)
+    request.META["HTTP_IF_MATCH"] = '"nope"'
+
+    res = async_to_sync(AsyncGetView.as_view())(request)
+
+    patch_services["image_model"].aget_cache_image_url.assert_not_called()
+    assert res.status_code == 412
+    assert not res.has_header("Cache-Control")
+
+
+def test_head(view_url: str, patch_services: dict):
+    patch_services[
+        "image_model"
+    ].aget_cache_image_url.return_value = "http://example.com/cache.jpeg"
+    request = AsyncRequestFactory().head(view_url)
+
+    res = async_to_sync(AsyncGetView.as_view())(request)
+
+    assert res.status_code == 302
+    assert "immutable" in res["Cache-Control"]
+
+
+def test_canonical_redirect(settings, get, patch_services: dict):
+    settings.API_CANONICAL_REDIRECT = True
+    patch_services["image_processing"].create_canonical_profile.return_value = (
+        ImageProfileStub(),
+        "profile_type=hoge&width=1",
+    )
+
+    res = get("width=1&profile_type=hoge")
+
+    patch_services["image_model"].aget_cache_image_url.assert_not_called()
+    assert res.status_code == 301
+    assert res.url.endswith("?profile_type=hoge&width=1")
+
+
+def test_local_tier_off_event_loop(get, patch_services: dict):
+    """
+    ローカルディスクの確認 (stat, open) はイベントループのスレッドでは行わない
+    """
+    loop_running = []
+
+    def get_local_image_response(self, profile, etag):
+        try:
+            asyncio.get_running_loop()
+            loop_running.append(True)
+        except RuntimeError:
+            loop_running.append(False)
+        return HttpResponse(b"local", content_type="image/png")
+
+    with patch.object(
+        AsyncGetView, "get_local_image_response", get_local_image_response
+    ):
+        res = get()
+
+    assert loop_running == [False]
+    assert res.content == b"local"
+    patch_services["image_model"].aget_cache_image_url.assert_not_called()
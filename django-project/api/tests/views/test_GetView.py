@@ -1,13 +1,21 @@
 from __future__ import annotations
 
+import io
 import json
+import threading
+import time
 from unittest.mock import patch
 
 import PIL.Image
 import pytest
+from django.core.cache import cache
+from django.db import IntegrityError
 from django.urls import reverse
 
 from api.image_processing import ImageProfileAbstract, QueryError
+from api.models import digest_signiture
+from api.services import RenderBudgetExceeded, RenderLease
+from api.views import GetView
 
 # Stubs
 ########################################################################################
@@ -30,7 +38,7 @@ class ImageProfileStub(ImageProfileAbstract):
         raise NotImplementedError()
 
     def dump_signiture(self) -> str:
-        raise NotImplementedError()
+        return "image_profile_signiture"
 
 
 # Fixtures
@@ -55,20 +63,22 @@ def patch_services():
 
 def test_cache_exists(client, view_url: str, patch_services: dict):
     patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
-    patch_services["image_processing"].create_image.return_value = "/path/to/image.jpeg"
+    patch_services["image_processing"].create_image_file.return_value = io.BytesIO(
+        b"image"
+    )
     patch_services[
         "image_model"
     ].get_cache_image_url.return_value = "http://example.com/cache.jpeg"
     patch_services[
         "image_model"
-    ].upload_image.return_value = "http://example.com/uploaded.jpeg"
+    ].upload_image_file.return_value = "http://example.com/uploaded.jpeg"
 
     res = client.get(view_url)
 
     patch_services["image_processing"].create_profile.assert_called()
-    patch_services["image_processing"].create_image.assert_not_called()
+    patch_services["image_processing"].create_image_file.assert_not_called()
     patch_services["image_model"].get_cache_image_url.assert_called()
-    patch_services["image_model"].upload_image.assert_not_called()
+    patch_services["image_model"].upload_image_file.assert_not_called()
 
     assert res.status_code == 302
     assert res.url == "http://example.com/cache.jpeg"
@@ -76,18 +86,20 @@ def test_cache_exists(client, view_url: str, patch_services: dict):
 
 def test_cache_None(client, view_url: str, patch_services: dict):
     patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
-    patch_services["image_processing"].create_image.return_value = "/path/to/image.jpeg"
+    patch_services["image_processing"].create_image_file.return_value = io.BytesIO(
+        b"image"
+    )
     patch_services["image_model"].get_cache_image_url.return_value = None
     patch_services[
         "image_model"
-    ].upload_image.return_value = "http://example.com/uploaded.jpeg"
+    ].upload_image_file.return_value = "http://example.com/uploaded.jpeg"
 
     res = client.get(view_url)
 
     patch_services["image_processing"].create_profile.assert_called()
-    patch_services["image_processing"].create_image.assert_called()
+    patch_services["image_processing"].create_image_file.assert_called()
     patch_services["image_model"].get_cache_image_url.assert_called()
-    patch_services["image_model"].upload_image.assert_called()
+    patch_services["image_model"].upload_image_file.assert_called()
 
     assert res.status_code == 302
     assert res.url == "http://example.com/uploaded.jpeg"
@@ -95,13 +107,15 @@ def test_cache_None(client, view_url: str, patch_services: dict):
 
 def test_create_profile_QueryError(client, view_url: str, patch_services: dict):
     patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
-    patch_services["image_processing"].create_image.return_value = "/path/to/image.jpeg"
+    patch_services["image_processing"].create_image_file.return_value = io.BytesIO(
+        b"image"
+    )
     patch_services[
         "image_model"
     ].get_cache_image_url.return_value = "http://example.com/cache.jpeg"
     patch_services[
         "image_model"
-    ].upload_image.return_value = "http://example.com/uploaded.jpeg"
+    ].upload_image_file.return_value = "http://example.com/uploaded.jpeg"
 
     error_messages = {"field_1": ["error_message_1"], "field_2": ["error_message_2"]}
     query_error = QueryError(error_messages)
@@ -110,9 +124,9 @@ def test_create_profile_QueryError(client, view_url: str, patch_services: dict):
     res = client.get(view_url)
 
     patch_services["image_processing"].create_profile.assert_called()
-    patch_services["image_processing"].create_image.assert_not_called()
+    patch_services["image_processing"].create_image_file.assert_not_called()
     patch_services["image_model"].get_cache_image_url.assert_not_called()
-    patch_services["image_model"].upload_image.assert_not_called()
+    patch_services["image_model"].upload_image_file.assert_not_called()
 
     assert res.status_code == 400
     assert res.content == json.dumps(error_messages).encode("utf-8")
@@ -121,13 +135,379 @@ def test_create_profile_QueryError(client, view_url: str, patch_services: dict):
 def test_create_profile_other_Exception(client, view_url: str, patch_services: dict):
     patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
     patch_services["image_processing"].create_profile.side_effect = Exception
-    patch_services["image_processing"].create_image.return_value = "/path/to/image.jpeg"
+    patch_services["image_processing"].create_image_file.return_value = io.BytesIO(
+        b"image"
+    )
     patch_services[
         "image_model"
     ].get_cache_image_url.return_value = "http://example.com/cache.jpeg"
     patch_services[
         "image_model"
-    ].upload_image.return_value = "http://example.com/uploaded.jpeg"
+    ].upload_image_file.return_value = "http://example.com/uploaded.jpeg"
 
     with pytest.raises(Exception):
         client.get(view_url)
+
+
+def test_cache_created_while_waiting(client, view_url: str, patch_services: dict):
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services["image_model"].get_cache_image_url.side_effect = [
+        None,
+        "http://example.com/created.jpeg",
+    ]
+
+    res = client.get(view_url)
+
+    patch_services["image_processing"].create_image_file.assert_not_called()
+    patch_services["image_model"].upload_image_file.assert_not_called()
+    assert res.status_code == 302
+    assert res.url == "http://example.com/created.jpeg"
+
+
+def test_upload_IntegrityError(client, view_url: str, patch_services: dict):
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services["image_processing"].create_image_file.return_value = io.BytesIO(
+        b"image"
+    )
+    patch_services["image_model"].get_cache_image_url.side_effect = [
+        None,
+        None,
+        "http://example.com/other_process.jpeg",
+    ]
+    patch_services["image_model"].upload_image_file.side_effect = IntegrityError
+
+    res = client.get(view_url)
+
+    assert res.status_code == 302
+    assert res.url == "http://example.com/other_process.jpeg"
+
+
+def test_create_image_url_coalesced(patch_services: dict):
+    def create_image_file(profile):
+        time.sleep(0.2)
+        return io.BytesIO(b"image")
+
+    patch_services["image_processing"].create_image_file.side_effect = create_image_file
+    patch_services["image_model"].get_cache_image_url.return_value = None
+    patch_services[
+        "image_model"
+    ].upload_image_file.return_value = "http://example.com/uploaded.jpeg"
+
+    results = []
+
+    def request():
+        results.append(GetView().create_image_url(ImageProfileStub()))
+
+    threads = [threading.Thread(target=request) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["http://example.com/uploaded.jpeg"] * 10
+    assert patch_services["image_processing"].create_image_file.call_count == 1
+    assert patch_services["image_model"].upload_image_file.call_count == 1
+
+
+def test_lease_held_by_other_worker(
+    settings, client, view_url: str, patch_services: dict
+):
+    settings.IMAGE_RENDER_LEASE_POLL_INTERVAL = 0.01
+    other_worker_lease = RenderLease(ImageProfileStub().dump_signiture())
+    other_worker_lease.acquire()
+
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services["image_model"].get_cache_image_url.side_effect = [
+        None,
+        None,
+        None,
+        "http://example.com/other_worker.jpeg",
+    ]
+
+    try:
+        res = client.get(view_url)
+    finally:
+        other_worker_lease.release()
+
+    patch_services["image_processing"].create_image_file.assert_not_called()
+    patch_services["image_model"].upload_image_file.assert_not_called()
+    assert res.status_code == 302
+    assert res.url == "http://example.com/other_worker.jpeg"
+
+
+def test_lease_released(client, view_url: str, patch_services: dict):
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services["image_processing"].create_image_file.return_value = io.BytesIO(
+        b"image"
+    )
+    patch_services["image_model"].get_cache_image_url.return_value = None
+    patch_services[
+        "image_model"
+    ].upload_image_file.return_value = "http://example.com/uploaded.jpeg"
+
+    client.get(view_url)
+
+    lease = RenderLease(ImageProfileStub().dump_signiture())
+    assert cache.get(lease.key) is None
+
+
+def test_render_budget_exceeded(client, view_url: str, patch_services: dict):
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services[
+        "image_processing"
+    ].create_image_file.side_effect = RenderBudgetExceeded(retry_after=2)
+    patch_services["image_model"].get_cache_image_url.return_value = None
+
+    res = client.get(view_url)
+
+    patch_services["image_model"].upload_image_file.assert_not_called()
+    assert res.status_code == 503
+    assert res["Retry-After"] == "2"
+    assert json.loads(res.content) == {"error": "busy"}
+
+
+def test_ratelimited(rf):
+    request = rf.get("/api/get/")
+    with patch.object(GetView, "check_ratelimit", return_value=True):
+        res = GetView.as_view()(request)
+    assert res.status_code == 429
+    assert json.loads(res.content) == {"error": "ratelimited"}
+
+
+@pytest.mark.parametrize(
+    "exceeded, status_code, content",
+    [("client", 429, {"error": "ratelimited"}), ("node", 503, {"error": "busy"})],
+)
+def test_render_cost_exceeded(
+    client, view_url: str, patch_services: dict, exceeded, status_code, content
+):
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services["image_model"].get_cache_image_url.return_value = None
+
+    with patch.object(GetView, "charge_render_cost", return_value=exceeded):
+        res = client.get(view_url)
+
+    patch_services["image_processing"].create_image_file.assert_not_called()
+    assert res.status_code == status_code
+    assert json.loads(res.content) == content
+
+
+def test_render_cost_not_charged_on_hit(client, view_url: str, patch_services: dict):
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services["image_model"].get_cache_image_url.return_value = "https://hoge"
+
+    with patch.object(GetView, "charge_render_cost") as charge_render_cost:
+        res = client.get(view_url)
+
+    charge_render_cost.assert_not_called()
+    assert res.status_code == 302
+
+
+def test_cache_headers(client, view_url: str, patch_services: dict):
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services["image_model"].get_cache_image_url.return_value = "https://hoge"
+
+    res = client.get(view_url)
+
+    assert res.status_code == 302
+    assert res["ETag"] == f'"{digest_signiture("image_profile_signiture")}"'
+    assert res["Cache-Control"] == "public, max-age=31536000, immutable"
+
+
+@pytest.mark.parametrize("if_none_match", ["etag", "*", 'W/"other", etag'])
+def test_not_modified(client, view_url: str, patch_services: dict, if_none_match):
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    etag = f'"{digest_signiture("image_profile_signiture")}"'
+
+    res = client.get(view_url, HTTP_IF_NONE_MATCH=if_none_match.replace("etag", etag))
+
+    patch_services["image_model"].get_cache_image_url.assert_not_called()
+    patch_services["image_processing"].create_image_file.assert_not_called()
+    assert res.status_code == 304
+    assert res["ETag"] == etag
+    assert "immutable" in res["Cache-Control"]
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [
+        {"HTTP_IF_MATCH": '"nope"'},
+        {"HTTP_IF_MATCH": "W/etag"},
+        {"HTTP_IF_MATCH": '"nope"', "HTTP_IF_NONE_MATCH": "etag"},
+    ],
+)
+def test_precondition_failed(client, view_url: str, patch_services: dict, headers):
+    """
+    If-Matchの条件を満たさない場合は412を返し、失敗をキャッシュさせない
+    """
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    etag = f'"{digest_signiture("image_profile_signiture")}"'
+    headers = {key: value.replace("etag", etag) for key, value in headers.items()}
+
+    with patch("api.views.access_stats.record_access") as record_access:
+        res = client.get(view_url, **headers)
+
+    patch_services["image_model"].get_cache_image_url.assert_not_called()
+    record_access.assert_not_called()
+    assert res.status_code == 412
+    assert not res.has_header("Cache-Control")
+    assert not res.has_header("ETag")
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [
+        {"HTTP_IF_MATCH": "etag"},
+        {"HTTP_IF_MATCH": "*"},
+        {"HTTP_IF_UNMODIFIED_SINCE": "Thu, 01 Jan 1970 00:00:00 GMT"},
+    ],
+)
+def test_precondition_passed(client, view_url: str, patch_services: dict, headers):
+    """
+    If-Matchが一致する場合と、If-Unmodified-Since (画像に更新日時が無いため無視する) は
+    通常通りに応答する
+    """
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services["image_model"].get_cache_image_url.return_value = "https://hoge"
+    etag = f'"{digest_signiture("image_profile_signiture")}"'
+    headers = {key: value.replace("etag", etag) for key, value in headers.items()}
+
+    res = client.get(view_url, **headers)
+
+    assert res.status_code == 302
+
+
+def test_modified(client, view_url: str, patch_services: dict):
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services["image_model"].get_cache_image_url.return_value = "https://hoge"
+
+    res = client.get(view_url, HTTP_IF_NONE_MATCH='"other"')
+
+    patch_services["image_model"].get_cache_image_url.assert_called()
+    assert res.status_code == 302
+
+
+def test_head(client, view_url: str, patch_services: dict):
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services["image_model"].get_cache_image_url.return_value = "https://hoge"
+
+    res = client.head(view_url)
+
+    assert res.status_code == 302
+    assert res.url == "https://hoge"
+    assert res.content == b""
+
+
+@pytest.mark.parametrize("status_code", [301, 308])
+def test_redirect_status(settings, client, view_url, patch_services, status_code):
+    settings.API_REDIRECT_STATUS = status_code
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services["image_model"].get_cache_image_url.return_value = "https://hoge"
+
+    res = client.get(view_url)
+
+    assert res.status_code == status_code
+    assert res.url == "https://hoge"
+
+
+def test_canonical_redirect(settings, client, view_url, patch_services):
+    settings.API_CANONICAL_REDIRECT = True
+    patch_services["image_processing"].create_canonical_profile.return_value = (
+        ImageProfileStub(),
+        "profile_type=hoge&width=1",
+    )
+
+    res = client.get(f"{view_url}?width=1&profile_type=hoge")
+
+    patch_services["image_model"].get_cache_image_url.assert_not_called()
+    assert res.status_code == 301
+    assert res.url == f"{view_url}?profile_type=hoge&width=1"
+    assert "immutable" in res["Cache-Control"]
+    assert "ETag" not in res
+
+
+def test_canonical_query_not_redirected(settings, client, view_url, patch_services):
+    settings.API_CANONICAL_REDIRECT = True
+    patch_services["image_processing"].create_canonical_profile.return_value = (
+        ImageProfileStub(),
+        "profile_type=hoge&width=1",
+    )
+    patch_services["image_model"].get_cache_image_url.return_value = "https://hoge"
+
+    res = client.get(f"{view_url}?profile_type=hoge&width=1")
+
+    assert res.status_code == 302
+    assert res.url == "https://hoge"
+
+
+def test_canonical_redirect_disabled(settings, client, view_url, patch_services):
+    settings.API_CANONICAL_REDIRECT = False
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services["image_model"].get_cache_image_url.return_value = "https://hoge"
+
+    res = client.get(f"{view_url}?width=1&profile_type=hoge")
+
+    patch_services["image_processing"].create_canonical_profile.assert_not_called()
+    assert res.status_code == 302
+
+
+def test_access_recorded_on_hit(settings, client, view_url, patch_services):
+    settings.IMAGE_ACCESS_STATS_FLUSH_INTERVAL = 60
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services["image_model"].get_cache_image_url.return_value = None
+    patch_services["image_processing"].create_image_file.return_value = io.BytesIO(
+        b"image"
+    )
+    patch_services["image_model"].upload_image_file.return_value = "https://hoge"
+
+    with patch("api.access_stats.recorder.record") as record:
+        client.get(view_url)
+        record.assert_not_called()
+        patch_services["image_model"].get_cache_image_url.return_value = "https://a"
+        client.get(view_url)
+
+    record.assert_called_once_with("image_profile_signiture")
+
+
+def test_multipart_upload(settings, client, view_url, patch_services):
+    settings.IMAGE_MULTIPART_UPLOAD = {
+        "PART_SIZE": 8 * 1024 * 1024,
+        "MAX_CONCURRENCY": 4,
+        "MAX_QUEUED_PARTS": 2,
+    }
+    profile = ImageProfileStub()
+    patch_services["image_processing"].create_profile.return_value = profile
+    patch_services["image_model"].get_cache_image_url.return_value = None
+    stream_upload_image = patch_services["image_model"].stream_upload_image
+    stream_upload_image.return_value = "https://hoge"
+
+    res = client.get(view_url)
+
+    assert res.status_code == 302
+    assert res.url == "https://hoge"
+    patch_services["image_processing"].create_image_file.assert_not_called()
+    write_image = stream_upload_image.call_args.args[1]
+    write_image("fp")
+    patch_services["image_processing"].write_image.assert_called_once_with(
+        profile, "fp"
+    )
+
+
+def test_multipart_upload_IntegrityError(settings, client, view_url, patch_services):
+    settings.IMAGE_MULTIPART_UPLOAD = {
+        "PART_SIZE": 8 * 1024 * 1024,
+        "MAX_CONCURRENCY": 4,
+        "MAX_QUEUED_PARTS": 2,
+    }
+    patch_services["image_processing"].create_profile.return_value = ImageProfileStub()
+    patch_services["image_model"].get_cache_image_url.side_effect = [
+        None,
+        None,
+        "https://registered",
+    ]
+    patch_services["image_model"].stream_upload_image.side_effect = IntegrityError()
+
+    res = client.get(view_url)
+
+    assert res.status_code == 302
+    assert res.url == "https://registered"
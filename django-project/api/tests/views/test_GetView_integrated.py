@@ -1,12 +1,19 @@
 from __future__ import annotations
 
+import io
+import json
 import os
+from unittest.mock import patch
 
+import PIL.Image
 import pytest
 from django.urls import reverse
 
 from api.image_processing import ColorRGB, JPEGPlainProfile, PNGPlainProfile
-from api.models import Image
+from api.local_tier import get_local_tier
+from api.models import Image, get_upload_name
+from api.render_backends import ProcessPoolRenderBackend
+from api.services import ImageProcessingService
 
 # Fixtures
 ########################################################################################
@@ -45,7 +52,10 @@ def view_url() -> str:
 )
 def valid_request_data(image_url_prefix, request):
     data = request.param.copy()
-    data["expected_image_url"] = image_url_prefix + data["profile"].upload_file_name
+    profile = data["profile"]
+    data["expected_image_url"] = image_url_prefix + get_upload_name(
+        profile.dump_signiture(), profile.get_extension()
+    )
     return data
 
 
@@ -91,3 +101,123 @@ def test_create_profile_QueryError(capsys, client, view_url: str, invalid_query)
         # エラーコンテンツの確認
         print()
         print(res.content.decode("utf-8"))
+
+
+def test_server_timing_miss_and_hit(client, view_url: str, valid_request_data: dict):
+    url = f"{view_url}?{valid_request_data['query']}"
+    miss_res = client.get(url)
+    hit_res = client.get(url)
+
+    miss_metrics = [m.split(";")[0] for m in miss_res["Server-Timing"].split(", ")]
+    for name in ["ratelimit", "parse", "db", "render", "encode", "upload", "total"]:
+        assert name in miss_metrics
+    assert 'outcome;desc="miss"' in miss_res["Server-Timing"]
+    assert 'outcome;desc="hit"' in hit_res["Server-Timing"]
+
+
+def test_slow_request_log(caplog, settings, client, view_url: str):
+    settings.API_SLOW_REQUEST_THRESHOLD = 0
+    url = f"{view_url}?profile_type=png_plain&width=3&height=4&color_rgb=fff&alpha=1"
+    with caplog.at_level("WARNING", logger="api.timing"):
+        client.get(url)
+
+    log = json.loads(caplog.records[-1].getMessage())
+    assert log["event"] == "slow_request"
+    assert log["outcome"] == "miss"
+    assert log["pixel_count"] == 12
+    assert log["byte_size"] > 0
+    assert "render" in log["stages_ms"]
+
+
+@pytest.fixture
+def local_tier_settings(settings, tmp_path):
+    settings.IMAGE_LOCAL_TIER = {
+        "ROOT": str(tmp_path),
+        "MAX_BYTES": 1024 * 1024,
+        "SERVE": "file",
+        "ACCEL_PREFIX": "/_impala_local/",
+    }
+    return settings.IMAGE_LOCAL_TIER
+
+
+def test_local_tier_file(client, view_url, valid_request_data, local_tier_settings):
+    url = f"{view_url}?{valid_request_data['query']}"
+    miss_res = client.get(url)
+    hit_res = client.get(url)
+
+    assert miss_res.status_code == 302
+    assert hit_res.status_code == 200
+    extension = valid_request_data["profile"].get_extension()
+    assert hit_res["Content-Type"] == f"image/{extension}"
+    assert hit_res["ETag"] == miss_res["ETag"]
+    assert "immutable" in hit_res["Cache-Control"]
+    assert 'outcome;desc="hit"' in hit_res["Server-Timing"]
+    image = PIL.Image.open(io.BytesIO(b"".join(hit_res.streaming_content)))
+    assert image.size == (10, 10)
+
+
+@pytest.mark.parametrize("serve", ["x-accel-redirect", "x-sendfile"])
+def test_local_tier_offload(
+    client, view_url, valid_request_data, local_tier_settings, serve
+):
+    local_tier_settings["SERVE"] = serve
+    url = f"{view_url}?{valid_request_data['query']}"
+    client.get(url)
+    res = client.get(url)
+
+    assert res.status_code == 200
+    assert res.content == b""
+    relative_path = get_local_tier().get(valid_request_data["profile"])
+    if serve == "x-accel-redirect":
+        assert res["X-Accel-Redirect"] == "/_impala_local/" + relative_path
+    else:
+        assert res["X-Sendfile"] == os.path.join(
+            local_tier_settings["ROOT"], relative_path
+        )
+
+
+def test_local_tier_fallback(client, view_url, valid_request_data, local_tier_settings):
+    url = f"{view_url}?{valid_request_data['query']}"
+    client.get(url)
+    get_local_tier().clear()
+
+    res = client.get(url)
+
+    assert res.status_code == 302
+    assert res.url == valid_request_data["expected_image_url"]
+
+
+def test_multipart_upload_with_process_pool(
+    settings, client, view_url: str, valid_request_data: dict
+):
+    """
+    マルチパートアップロードとプロセスプールのバックエンドを併用した場合も、
+    大きな画像はプロセスプールでエンコードする
+    """
+    settings.IMAGE_MULTIPART_UPLOAD = {
+        "PART_SIZE": 8 * 1024 * 1024,
+        "MAX_CONCURRENCY": 4,
+        "MAX_QUEUED_PARTS": 2,
+    }
+    backend = ProcessPoolRenderBackend(pixel_threshold=1, max_workers=1, prefork=False)
+    try:
+        with patch.object(
+            ImageProcessingService, "render_backend", backend
+        ), patch.object(
+            backend, "render_in_pool", wraps=backend.render_in_pool
+        ) as render_in_pool:
+            res = client.get(f"{view_url}?{valid_request_data['query']}")
+    finally:
+        backend.shutdown()
+
+    assert res.status_code == 302
+    assert res.url == valid_request_data["expected_image_url"]
+    render_in_pool.assert_called_once()
+    rendered_profile = render_in_pool.call_args.args[0]
+    assert (
+        rendered_profile.dump_signiture()
+        == valid_request_data["profile"].dump_signiture()
+    )
+    image = Image.objects.get()
+    assert image.byte_size == image.upload.size
+    assert PIL.Image.open(image.upload).size == (10, 10)
@@ -0,0 +1,129 @@
+"""
+リクエスト内の処理段階毎の所要時間の計測
+
+ビューでRequestTimerを有効にすると、同じコンテキスト内のStage()の所要時間と
+record()で記録した属性がそのタイマーに集計される。
+タイマーが無効なコンテキスト (管理コマンド等) では、Stage()やrecord()は何もしない。
+"""
+from __future__ import annotations
+
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator
+
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+
+logger = logging.getLogger(__name__)
+
+current_timer: ContextVar[RequestTimer | None] = ContextVar(
+    "api_request_timer", default=None
+)
+
+
+class RequestTimer:
+    """
+    1リクエストの処理段階毎の所要時間と、キャッシュのヒット等の属性を保持する
+    同じ名前の段階を複数回計測した場合は所要時間を合計する
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.total: float | None = None
+        self.stages: dict[str, float] = {}
+        self.attributes: dict[str, Any] = {}
+
+    @contextmanager
+    def activate(self) -> Iterator[RequestTimer]:
+        token = current_timer.set(self)
+        try:
+            yield self
+        finally:
+            current_timer.reset(token)
+
+    def add(self, name: str, duration: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + duration
+
+    def record(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def stop(self) -> float:
+        if self.total is None:
+            self.total = time.perf_counter() - self.started_at
+        return self.total
+
+    def server_timing(self) -> str:
+        """
+        Server-Timingヘッダーの値 (所要時間はミリ秒) を返す
+        """
+        metrics = [
+            f"{name};dur={duration * 1000:.3f}"
+            for name, duration in self.stages.items()
+        ]
+        metrics.append(f"total;dur={self.stop() * 1000:.3f}")
+        if "outcome" in self.attributes:
+            metrics.append(f'outcome;desc="{self.attributes["outcome"]}"')
+        return ", ".join(metrics)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "total_ms": round(self.stop() * 1000, 3),
+            "stages_ms": {
+                name: round(duration * 1000, 3)
+                for name, duration in self.stages.items()
+            },
+            **self.attributes,
+        }
+
+    def finish(self, request: HttpRequest, response: HttpResponse) -> None:
+        """
+        計測を終了し、レスポンスにServer-Timingヘッダーを付与する
+        所要時間がsettings.API_SLOW_REQUEST_THRESHOLD秒以上の場合は構造化ログを出力する
+        """
+        total = self.stop()
+        if settings.API_SERVER_TIMING:
+            response["Server-Timing"] = self.server_timing()
+
+        threshold = settings.API_SLOW_REQUEST_THRESHOLD
+        if threshold is not None and total >= threshold:
+            log = {
+                "event": "slow_request",
+                "path": request.path,
+                "query": request.META.get("QUERY_STRING", ""),
+                "status": response.status_code,
+                **self.to_dict(),
+            }
+            logger.warning(json.dumps(log, ensure_ascii=False, default=str))
+
+
+class Stage:
+    """
+    現在のタイマーに、withブロックの所要時間を指定した名前の段階として記録する
+    ホットパスで使うため、ジェネレーターベースのコンテキストマネージャーは使わない
+    """
+
+    __slots__ = ("name", "timer", "started_at")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.timer = current_timer.get()
+        if self.timer is not None:
+            self.started_at = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        if self.timer is not None:
+            self.timer.add(self.name, time.perf_counter() - self.started_at)
+
+
+def record(**attributes: Any) -> None:
+    """
+    現在のタイマーに属性 (画素数やエンコード後のサイズ等) を記録する
+    """
+    timer = current_timer.get()
+    if timer is not None:
+        timer.record(**attributes)
@@ -0,0 +1,156 @@
+"""
+エンコードと並行して行うS3へのアップロード
+
+MultipartUploadWriterはファイルオブジェクトとしてエンコーダーの出力を受け取り、
+part_sizeに達したパートから順にマルチパートアップロードで送信する。
+送信待ちと送信中のパートの数は上限を設けており、アップロードが追いつかない場合は
+エンコーダー側のwrite()が待つため、メモリ使用量は part_size × (並行数 + 待機数) までとなる。
+出力全体がpart_size未満の場合は、マルチパートアップロードは使わず1回のPutObjectで送信する。
+"""
+from __future__ import annotations
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+# S3のマルチパートアップロードの、最後以外のパートの最小サイズ
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class MultipartUploadWriter:
+    def __init__(
+        self,
+        client,
+        bucket: str,
+        key: str,
+        part_size: int = 8 * 1024 * 1024,
+        max_concurrency: int = 4,
+        max_queued_parts: int = 2,
+        extra_args: dict[str, Any] | None = None,
+    ):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes.")
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.extra_args = extra_args or {}
+        self.size = 0
+        self.upload_id: str | None = None
+        self._buffer = bytearray()
+        self._futures: list[Future] = []
+        self._executor: ThreadPoolExecutor | None = None
+        self._slots = threading.BoundedSemaphore(max_concurrency + max_queued_parts)
+
+    def __enter__(self) -> MultipartUploadWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.finish()
+        else:
+            self.abort()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[: self.part_size])
+            del self._buffer[: self.part_size]
+            self._submit_part(part)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def finish(self) -> None:
+        """
+        残りのデータを送信してアップロードを完了する
+        """
+        try:
+            if self.upload_id is None:
+                self.client.put_object(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    Body=bytes(self._buffer),
+                    **self.extra_args,
+                )
+                return
+
+            if self._buffer:
+                self._submit_part(bytes(self._buffer))
+                self._buffer = bytearray()
+            parts = [
+                {"ETag": future.result(), "PartNumber": number}
+                for number, future in enumerate(self._futures, start=1)
+            ]
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self._shutdown()
+
+    def abort(self) -> None:
+        """
+        送信待ちのパートを取り消し、開始済みのマルチパートアップロードを中止する
+        """
+        for future in self._futures:
+            future.cancel()
+        self._shutdown()
+        if self.upload_id is not None:
+            upload_id, self.upload_id = self.upload_id, None
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=upload_id
+            )
+
+    def _submit_part(self, body: bytes) -> None:
+        if self.upload_id is None:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.extra_args
+            )
+            self.upload_id = response["UploadId"]
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrency, thread_name_prefix="impala-upload"
+            )
+
+        # 失敗したパートがあれば、以降のエンコードを待たずに中止する
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+        self._slots.acquire()
+        part_number = len(self._futures) + 1
+        try:
+            future = self._executor.submit(self._upload_part, part_number, body)
+        except BaseException:
+            self._slots.release()
+            raise
+        self._futures.append(future)
+
+    def _upload_part(self, part_number: int, body: bytes) -> str:
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=part_number,
+                Body=body,
+            )
+            return response["ETag"]
+        finally:
+            self._slots.release()
+
+    def _shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
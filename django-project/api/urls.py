@@ -1,7 +1,13 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
 app_name = "api"
 
-urlpatterns = [path("get/", views.GetView.as_view(), name="get")]
+get_view = views.AsyncGetView if settings.API_ASYNC_VIEW else views.GetView
+
+urlpatterns = [
+    path("get/", get_view.as_view(), name="get"),
+    path("metrics/", views.MetricsView.as_view(), name="metrics"),
+]
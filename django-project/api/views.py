@@ -1,20 +1,50 @@
+import asyncio
+import contextvars
 import json
-from tempfile import TemporaryDirectory
-from typing import Type
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import IO, Optional, Tuple, Type, Union
 
-from django.http import HttpRequest, HttpResponseBadRequest, JsonResponse
-from django.shortcuts import redirect
-from django.utils.decorators import method_decorator
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections
+from django.http import (
+    FileResponse,
+    HttpRequest,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseNotModified,
+    HttpResponsePermanentRedirect,
+    HttpResponseRedirect,
+    JsonResponse,
+)
+from django.http.response import HttpResponseBase
+from django.utils.cache import parse_etags
+from django.utils.http import quote_etag
 from django.views.generic.base import View
-from django_ratelimit.decorators import ratelimit
 
-from .image_processing import QueryError
+from . import access_stats, local_tier, metrics, timing
+from .image_processing import ImageProfileAbstract, QueryError
+from .models import digest_signiture
+from .ratelimit import (
+    Ratelimited,
+    get_rate_limiter,
+    get_render_cost_limiter,
+)
 from .services import (
     ImageModelService,
     ImageModelServiceAbstract,
     ImageProcessingService,
     ImageProcessingServiceAbstract,
+    RenderBudgetExceeded,
+    RenderLease,
+    SingleFlight,
 )
+from .timing import RequestTimer
+
+logger = logging.getLogger(__name__)
 
 
 # Create your views here.
@@ -22,33 +52,377 @@ def ratelimited_error(request, exception):
     return JsonResponse({"error": "ratelimited"}, status=429)
 
 
+def render_budget_exceeded_error(request, exception: RenderBudgetExceeded):
+    response = JsonResponse({"error": "busy"}, status=503)
+    response["Retry-After"] = str(exception.retry_after)
+    return response
+
+
 class GetView(View):
-    http_method_names = ["get"]
+    # HEADはView.setup()によりGETと同じ処理となる
+    http_method_names = ["get", "head"]
     image_processing_service: Type[
         ImageProcessingServiceAbstract
     ] = ImageProcessingService
     image_model_service: Type[ImageModelServiceAbstract] = ImageModelService
+    # 同じシグニチャの画像の生成を同時に要求された場合に、生成とアップロードを1回にまとめる
+    render_flight = SingleFlight()
+
+    # レート制限の設定 (settings.API_RATELIMITS) のルート名
+    ratelimit_route = "api:get"
 
-    @method_decorator(ratelimit(key="ip", rate="50/s", method="GET"))
-    @method_decorator(ratelimit(key="ip", rate="500/m", method="GET"))
     def get(self, request: HttpRequest):
+        timer = RequestTimer()
+        with timer.activate():
+            response = self.get_image_response(request)
+        timer.finish(request, response)
+        metrics.observe_request(timer)
+        return response
+
+    def get_image_response(self, request: HttpRequest):
+        prepared = self.prepare_image_response(request)
+        if isinstance(prepared, HttpResponseBase):
+            return prepared
+        profile, etag = prepared
+
+        cache_url = self.image_model_service.get_cache_image_url(profile)
+        if cache_url is not None:
+            return self.cache_hit_response(profile, cache_url, etag)
+
+        timing.record(outcome="miss")
+        with timing.Stage("ratelimit"):
+            exceeded = self.charge_render_cost(request, profile)
+        if exceeded is not None:
+            return self.render_cost_exceeded_error(request, exceeded)
+
+        try:
+            image_url = self.create_image_url(profile)
+        except RenderBudgetExceeded as exception:
+            return self.busy_error(request, exception)
+        return self.image_redirect(image_url, etag)
+
+    def prepare_image_response(
+        self, request: HttpRequest
+    ) -> Union[HttpResponseBase, Tuple[ImageProfileAbstract, str]]:
+        """
+        GetViewとAsyncGetViewで共通の、画像URLのキャッシュを確認する前までの処理
+        レート制限・クエリの解析・正規のURLへのリダイレクト・304・ローカルディスクの
+        いずれかで応答できる場合はそのレスポンスを、できない場合は (プロファイル, ETag) を返す
+        """
+        with timing.Stage("ratelimit"):
+            limited = self.check_ratelimit(request)
+        if limited:
+            timing.record(outcome="ratelimited")
+            metrics.ratelimited_requests.inc()
+            return ratelimited_error(request, Ratelimited())
+
         try:
-            profile = self.image_processing_service.create_profile(request.GET)
+            with timing.Stage("parse"):
+                profile, canonical_query = self.parse_profile(request)
         except QueryError as query_error:
+            timing.record(outcome="invalid")
             messages = json.dumps(query_error.messages, ensure_ascii=False)
             return HttpResponseBadRequest(messages, content_type="application/json")
         except Exception:
             # 500 Internal Error
             raise
+        timing.record(profile_type=request.GET.get("profile_type", ""))
+
+        if canonical_query is not None and canonical_query != request.META.get(
+            "QUERY_STRING", ""
+        ):
+            timing.record(outcome="canonical_redirect")
+            return self.canonical_redirect(request, canonical_query)
+
+        # 画像はシグニチャで一意に決まるため、DBやストレージを参照せずに304を返せる
+        etag = self.get_etag(profile)
+        if not self.if_match_passes(request, etag):
+            # 失敗のレスポンスはキャッシュさせない
+            timing.record(outcome="precondition_failed")
+            return HttpResponse(status=412)
+        if self.is_not_modified(request, etag):
+            timing.record(outcome="not_modified")
+            access_stats.record_access(profile.dump_signiture())
+            return self.set_cache_headers(HttpResponseNotModified(), etag)
+
+        local_response = self.get_local_image_response(profile, etag)
+        if local_response is not None:
+            timing.record(outcome="hit")
+            access_stats.record_access(profile.dump_signiture())
+            return local_response
+
+        return profile, etag
+
+    def cache_hit_response(
+        self, profile: ImageProfileAbstract, cache_url: str, etag: str
+    ) -> HttpResponse:
+        timing.record(outcome="hit")
+        access_stats.record_access(profile.dump_signiture())
+        return self.image_redirect(cache_url, etag)
+
+    def busy_error(self, request: HttpRequest, exception: RenderBudgetExceeded):
+        timing.record(outcome="busy")
+        return render_budget_exceeded_error(request, exception)
+
+    def parse_profile(
+        self, request: HttpRequest
+    ) -> Tuple[ImageProfileAbstract, Optional[str]]:
+        """
+        クエリからプロファイルを生成する
+        settings.API_CANONICAL_REDIRECTが有効な場合は、正規のクエリ文字列も返す
+        """
+        if settings.API_CANONICAL_REDIRECT:
+            return self.image_processing_service.create_canonical_profile(request.GET)
+        return self.image_processing_service.create_profile(request.GET), None
+
+    def canonical_redirect(self, request: HttpRequest, canonical_query: str):
+        """
+        同じ画像を表すURLを正規のURLにまとめ、CDNのキャッシュのヒット率を上げる
+        クエリと正規のURLの対応は変わらないため、リダイレクトも長期間キャッシュさせる
+        """
+        response = HttpResponsePermanentRedirect(f"{request.path}?{canonical_query}")
+        response[
+            "Cache-Control"
+        ] = f"public, max-age={settings.API_REDIRECT_MAX_AGE}, immutable"
+        return response
+
+    def get_etag(self, profile: ImageProfileAbstract) -> str:
+        return quote_etag(digest_signiture(profile.dump_signiture()))
+
+    def if_match_passes(self, request: HttpRequest, etag: str) -> bool:
+        """
+        If-Matchの条件を満たすかどうか (強い比較)
+        画像は変更されず更新日時を持たないため、If-Unmodified-Sinceは無視する (RFC 9110)
+        """
+        etags = parse_etags(request.META.get("HTTP_IF_MATCH", ""))
+        return not etags or "*" in etags or etag in etags
+
+    def is_not_modified(self, request: HttpRequest, etag: str) -> bool:
+        """
+        If-None-Matchが画像のETagと一致するかどうか (弱い比較)
+        """
+        etags = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+        return "*" in etags or etag in [
+            tag[2:] if tag.startswith("W/") else tag for tag in etags
+        ]
+
+    def set_cache_headers(self, response: HttpResponse, etag: str) -> HttpResponse:
+        """
+        シグニチャに対応する画像のURLは変わらないため、長期間キャッシュさせる
+        """
+        response["ETag"] = etag
+        response[
+            "Cache-Control"
+        ] = f"public, max-age={settings.API_REDIRECT_MAX_AGE}, immutable"
+        return response
+
+    def image_redirect(self, image_url: str, etag: str) -> HttpResponse:
+        response = HttpResponseRedirect(image_url)
+        response.status_code = settings.API_REDIRECT_STATUS
+        return self.set_cache_headers(response, etag)
+
+    def get_local_image_response(
+        self, profile: ImageProfileAbstract, etag: str
+    ) -> Optional[HttpResponse]:
+        """
+        ローカルディスクに保存された画像があれば、settings.IMAGE_LOCAL_TIERの"SERVE"の
+        方法で画像そのものを返すレスポンスを返す (無ければNone)
+        """
+        tier = local_tier.get_local_tier()
+        if tier is None:
+            return None
+        with timing.Stage("local"):
+            relative_path = tier.get(profile)
+        if relative_path is None:
+            return None
+
+        config = settings.IMAGE_LOCAL_TIER
+        serve = config.get("SERVE", "file")
+        content_type = f"image/{profile.get_extension()}"
+        if serve == "x-accel-redirect":
+            response = HttpResponse(content_type=content_type)
+            response["X-Accel-Redirect"] = config["ACCEL_PREFIX"] + relative_path
+        elif serve == "x-sendfile":
+            response = HttpResponse(content_type=content_type)
+            response["X-Sendfile"] = os.path.abspath(tier.get_path(relative_path))
+        else:
+            try:
+                image_file = open(tier.get_path(relative_path), "rb")
+            except FileNotFoundError:
+                # 確認後に他のプロセスが削除した
+                return None
+            response = FileResponse(image_file, content_type=content_type)
+        timing.record(url_source="local")
+        return self.set_cache_headers(response, etag)
 
+    def store_local_image(
+        self, image_file: IO[bytes], profile: ImageProfileAbstract
+    ) -> None:
+        tier = local_tier.get_local_tier()
+        if tier is None:
+            return
+        try:
+            tier.put(profile, image_file)
+        except OSError:
+            # ディスクの容量不足等の場合も、アップロード済みの画像のURLは返せる
+            logger.warning("Failed to store image on local disk.", exc_info=True)
+
+    def check_ratelimit(self, request: HttpRequest) -> bool:
+        return get_rate_limiter(self.ratelimit_route).is_limited(request)
+
+    def charge_render_cost(
+        self, request: HttpRequest, profile: ImageProfileAbstract
+    ) -> Optional[str]:
+        """
+        画像の生成コストをクライアントとノードの上限に加算する
+        上限を超える場合は、超えた上限 ("client"または"node") を返す
+        """
+        return get_render_cost_limiter(self.ratelimit_route).charge(request, profile)
+
+    def render_cost_exceeded_error(self, request: HttpRequest, exceeded: str):
+        """
+        クライアントの上限を超えた場合は429、ノード全体の上限を超えた場合は503を返す
+        """
+        if exceeded == "client":
+            timing.record(outcome="ratelimited")
+            metrics.ratelimited_requests.inc()
+            return ratelimited_error(request, Ratelimited())
+        return self.busy_error(
+            request,
+            RenderBudgetExceeded(retry_after=settings.IMAGE_RENDER_BUDGET_RETRY_AFTER),
+        )
+
+    def create_image_url(self, profile: ImageProfileAbstract) -> str:
+        """
+        キャッシュに無い画像を生成・アップロードしてURLを返す
+        同じシグニチャの画像を生成中のリクエストがあれば、その結果を待って同じURLを返す
+        """
+        return self.render_flight.do(
+            profile.dump_signiture(), self.render_and_upload, profile
+        )
+
+    def render_and_upload(self, profile: ImageProfileAbstract) -> str:
+        # 生成の順番を待つ間に、他のリクエストが同じ画像を登録している場合がある
         cache_url = self.image_model_service.get_cache_image_url(profile)
+        if cache_url is not None:
+            return cache_url
 
+        # 他のワーカーが同じ画像を生成中であれば、その画像が登録されるまで待つ
+        lease = RenderLease(profile.dump_signiture())
+        with timing.Stage("lease"):
+            cache_url = lease.acquire_or_wait(
+                lambda: self.image_model_service.get_cache_image_url(profile)
+            )
         if cache_url is not None:
-            return redirect(cache_url)
+            return cache_url
+
+        try:
+            return self.upload_new_image(profile)
+        finally:
+            lease.release()
+
+    def upload_new_image(self, profile: ImageProfileAbstract) -> str:
+        if settings.IMAGE_MULTIPART_UPLOAD is not None and (
+            local_tier.get_local_tier() is None
+        ):
+            upload = self.stream_new_image
         else:
-            with TemporaryDirectory() as temp_dir_name:
-                image_path = self.image_processing_service.create_image(
-                    profile, temp_dir_name
-                )
-                image_url = self.image_model_service.upload_image(image_path, profile)
-            return redirect(image_url)
+            upload = self.render_new_image
+
+        try:
+            return upload(profile)
+        except IntegrityError:
+            # 他のプロセスが同じシグニチャの画像を先に登録した
+            cache_url = self.image_model_service.get_cache_image_url(profile)
+            if cache_url is None:
+                raise
+            return cache_url
+
+    def render_new_image(self, profile: ImageProfileAbstract) -> str:
+        with self.image_processing_service.create_image_file(profile) as image_file:
+            image_url = self.image_model_service.upload_image_file(image_file, profile)
+            # 以降のリクエストはローカルディスクから返す
+            self.store_local_image(image_file, profile)
+            return image_url
+
+    def stream_new_image(self, profile: ImageProfileAbstract) -> str:
+        """
+        エンコードしながらアップロードし、大きな画像の生成と送信の時間を重ねる
+        (プロセスプールでエンコードする画像は、エンコード後に一時ファイルから送信する)
+        """
+        return self.image_model_service.stream_upload_image(
+            profile, partial(self.image_processing_service.write_image, profile)
+        )
+
+
+class AsyncGetView(GetView):
+    """
+    ASGI用のGetView
+    キャッシュの確認は非同期に行い、キャッシュに無い画像の生成・アップロードは
+    上限付きのスレッドプールで実行するため、生成中もイベントループはブロックされない
+    """
+
+    render_executor = ThreadPoolExecutor(
+        max_workers=settings.IMAGE_RENDER_THREADS, thread_name_prefix="impala-render"
+    )
+
+    async def get(self, request: HttpRequest):
+        timer = RequestTimer()
+        with timer.activate():
+            response = await self.aget_image_response(request)
+        timer.finish(request, response)
+        metrics.observe_request(timer)
+        return response
+
+    async def aget_image_response(self, request: HttpRequest):
+        # レート制限の確認やローカルディスクの読み込みでイベントループをブロックしない
+        prepared = await sync_to_async(self.prepare_image_response)(request)
+        if isinstance(prepared, HttpResponseBase):
+            return prepared
+        profile, etag = prepared
+
+        cache_url = await self.image_model_service.aget_cache_image_url(profile)
+        if cache_url is not None:
+            return self.cache_hit_response(profile, cache_url, etag)
+
+        timing.record(outcome="miss")
+        with timing.Stage("ratelimit"):
+            exceeded = await sync_to_async(self.charge_render_cost)(request, profile)
+        if exceeded is not None:
+            return self.render_cost_exceeded_error(request, exceeded)
+
+        loop = asyncio.get_running_loop()
+        # 生成段階の所要時間を同じタイマーに記録するため、コンテキストを引き継いで実行する
+        context = contextvars.copy_context()
+        try:
+            image_url = await loop.run_in_executor(
+                self.render_executor,
+                context.run,
+                self.create_image_url_in_thread,
+                profile,
+            )
+        except RenderBudgetExceeded as exception:
+            return self.busy_error(request, exception)
+        return self.image_redirect(image_url, etag)
+
+    def create_image_url_in_thread(self, profile: ImageProfileAbstract) -> str:
+        try:
+            return self.create_image_url(profile)
+        finally:
+            # スレッドプールのスレッドではリクエスト終了時の接続の後始末が行われないため
+            close_old_connections()
+
+
+class MetricsView(View):
+    """
+    メトリクスをPrometheusのテキスト形式で返す
+    DBには問い合わせないため、DBの障害時も取得できる
+    """
+
+    http_method_names = ["get"]
+
+    def get(self, request: HttpRequest):
+        return HttpResponse(
+            metrics.registry.render(),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
@@ -118,3 +118,136 @@ STATIC_URL = "static/"
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+
+# Image processing
+
+# 生成した画像をメモリ上に保持する最大バイト数 (超えた場合は一時ファイルに書き出す)
+IMAGE_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# 画像URLキャッシュに利用するキャッシュのエイリアスと有効期限 (秒)
+IMAGE_URL_CACHE_ALIAS = "default"
+IMAGE_URL_CACHE_TIMEOUT = 60 * 60 * 24
+
+# プロセス内で保持する画像URLの最大件数と有効期限 (秒)
+IMAGE_URL_LRU_MAX_SIZE = 1024
+IMAGE_URL_LRU_TIMEOUT = 60
+
+# 画像生成のリースの有効期限と、他のワーカーの生成完了を待つ最大時間・確認間隔 (秒)
+# 有効期限は画像の生成とアップロードにかかる最長の時間よりも十分に長くすること
+# (PyLibMCCacheでは、OPTIONSに{"behaviors": {"cas": True}}を指定するとリースの解放がアトミックになる)
+IMAGE_RENDER_LEASE_TIMEOUT = 60
+IMAGE_RENDER_LEASE_WAIT_TIMEOUT = 30
+IMAGE_RENDER_LEASE_POLL_INTERVAL = 0.05
+IMAGE_RENDER_LEASE_POLL_MAX_INTERVAL = 1.0
+
+# ASGIで動作させる場合に/api/get/を非同期ビューで処理するかどうかと、
+# 非同期ビューで画像の生成・アップロードを行うスレッド数
+API_ASYNC_VIEW = False
+IMAGE_RENDER_THREADS = 4
+
+# 画像のエンコードを行うバックエンド
+# 大きな画像をプロセスプールでエンコードする場合は以下のように設定する
+# IMAGE_RENDER_BACKEND = {
+#     "BACKEND": "api.render_backends.ProcessPoolRenderBackend",
+#     "OPTIONS": {"pixel_threshold": 4096 * 4096, "max_workers": 2},
+# }
+IMAGE_RENDER_BACKEND = {
+    "BACKEND": "api.render_backends.InProcessRenderBackend",
+    "OPTIONS": {},
+}
+
+# プロセス内で同時に生成する画像の画素数の合計の上限と、空きを待つ最大時間 (秒)
+# 待っても空かない場合は503を返し、Retry-Afterヘッダーで再試行までの秒数を伝える
+IMAGE_RENDER_BUDGET_PIXELS = 15360 * 15360 * 2
+IMAGE_RENDER_BUDGET_TIMEOUT = 5
+IMAGE_RENDER_BUDGET_RETRY_AFTER = 1
+
+# /api/get/ のレスポンスに処理段階毎の所要時間をServer-Timingヘッダーで付与するか
+API_SERVER_TIMING = True
+
+# /api/get/ の所要時間がこの秒数以上の場合、処理段階毎の所要時間を構造化ログに出力する
+# (Noneの場合は出力しない)
+API_SLOW_REQUEST_THRESHOLD = 1.0
+
+# 各ワーカープロセスのメトリクスを書き出すディレクトリ (gunicorn等の複数ワーカーで集計する場合)
+# Noneの場合は /api/metrics/ を処理したプロセスのメトリクスのみを返す
+API_METRICS_DIR = None
+# メトリクスをディレクトリに書き出す最短の間隔 (秒)
+API_METRICS_FLUSH_INTERVAL = 1.0
+
+# レート制限
+API_RATELIMIT_ENABLE = True
+API_RATELIMIT_CACHE_ALIAS = "default"
+# クライアントのIPアドレスを取得するrequest.METAのキー
+API_RATELIMIT_IP_META_KEY = "REMOTE_ADDR"
+# ルート毎のレート ("回数/期間"、期間はs, m, h, d。"100/5m"のように倍数も指定できる)
+API_RATELIMITS = {
+    "api:get": ["50/s", "500/m"],
+}
+# キャッシュに問い合わせる前の、プロセス内のIPアドレス毎のトークンバケット
+# (RATE: 1秒あたりに補充するトークン数, BURST: 最大トークン数)
+API_RATELIMIT_PREFILTER = {"RATE": 100, "BURST": 100}
+
+# キャッシュに無い画像を生成する際の、生成コスト (画素数 × 形式毎の係数) によるレート制限
+# (キャッシュにある画像へのリクエストはコストを消費しない)
+API_RENDER_COST_FORMAT_FACTORS = {"jpeg": 1.0, "png": 1.0}
+# ルート毎の、IPアドレス毎の生成コストの上限 (15360x15360の画像は約2.4億)
+API_RENDER_QUOTAS = {
+    "api:get": ["1000000000/m", "10000000000/h"],
+}
+# ルート毎の、ノード (ホスト) 全体の生成コストの上限
+API_NODE_RENDER_QUOTAS = {
+    "api:get": ["10000000000/m"],
+}
+
+# /api/get/ が返す画像へのリダイレクトのステータスコード (302, 301, 308のいずれか)
+API_REDIRECT_STATUS = 302
+# /api/get/ のリダイレクト及び304レスポンスをキャッシュさせる秒数
+API_REDIRECT_MAX_AGE = 60 * 60 * 24 * 365
+
+# Trueの場合、/api/get/ へのクエリが正規の形 (パラメータの順序が固定、カラーコードは大文字6桁)
+# でなければ、DBの参照や画像の生成の前に正規のURLへ301でリダイレクトする
+API_CANONICAL_REDIRECT = False
+
+# 生成した画像をローカルディスクにも保存し、ヒット時はストレージへリダイレクトせずに直接返す
+# (Noneで無効。ディスクに無い画像は従来通りストレージのURLへリダイレクトする)
+# ROOT: 保存先のディレクトリ, MAX_BYTES: 合計サイズの上限 (超えた分は利用の古い順に削除)
+# SERVE: "x-accel-redirect" (nginx), "x-sendfile" (Apache等), "file" (Djangoが直接返す)
+# ACCEL_PREFIX: X-Accel-Redirectで指定する、ROOTに対応するnginxのinternalなlocation
+# IMAGE_LOCAL_TIER = {
+#     "ROOT": "/var/cache/impala",
+#     "MAX_BYTES": 10 * 1024**3,
+#     "SERVE": "x-accel-redirect",
+#     "ACCEL_PREFIX": "/_impala_local/",
+# }
+IMAGE_LOCAL_TIER = None
+
+# 画像の利用回数と最終利用日時をプロセス内で集計し、DBに書き込む間隔 (秒) (Noneで記録しない)
+# 集計中のシグニチャの数がIMAGE_ACCESS_STATS_MAX_PENDINGに達した場合は間隔を待たずに書き込む
+IMAGE_ACCESS_STATS_FLUSH_INTERVAL = 60
+IMAGE_ACCESS_STATS_MAX_PENDING = 10000
+
+# S3に保存する場合に、画像のエンコードと並行してマルチパートアップロードで送信する設定
+# (Noneで無効。ローカルディスクの保存領域 (IMAGE_LOCAL_TIER) を使う場合は無効となる)
+# PART_SIZE: パートのサイズ (5MiB以上), MAX_CONCURRENCY: 並行して送信するパートの数,
+# MAX_QUEUED_PARTS: 送信を待つパートの数 (超えた場合はエンコードを待たせる)
+# 出力がPART_SIZE未満の画像は1回のPutObjectで送信する
+# IMAGE_RENDER_BACKENDのプロセスプールでエンコードする画像は、エンコード後に送信する
+# IMAGE_MULTIPART_UPLOAD = {
+#     "PART_SIZE": 8 * 1024 * 1024,
+#     "MAX_CONCURRENCY": 4,
+#     "MAX_QUEUED_PARTS": 2,
+# }
+IMAGE_MULTIPART_UPLOAD = None
+
+# ストレージにapi.storage_backends.PooledS3Storageを使う場合の、共有するS3クライアントの設定
+# MAX_POOL_CONNECTIONS: コネクションプールのサイズ (ワーカーのスレッド数以上を推奨)
+# WARM_CONNECTIONS: ワーカーの起動時に開いておくコネクションの数 (0で開かない)
+# CONNECT_TIMEOUT, READ_TIMEOUT: 接続と読み込みのタイムアウト (秒)
+IMAGE_S3_POOL = {
+    "MAX_POOL_CONNECTIONS": 32,
+    "WARM_CONNECTIONS": 4,
+    "CONNECT_TIMEOUT": 5,
+    "READ_TIMEOUT": 30,
+}
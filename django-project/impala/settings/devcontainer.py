@@ -12,11 +12,10 @@ ALLOWED_HOSTS = []
 
 MIDDLEWARE += [
     "impala.middlewares.add_x_real_ip",  # 開発環境用
-    "django_ratelimit.middleware.RatelimitMiddleware",
 ]
 
 # Amazon S3 File Storage
-DEFAULT_FILE_STORAGE = "storages.backends.s3boto3.S3Boto3Storage"
+DEFAULT_FILE_STORAGE = "api.storage_backends.PooledS3Storage"
 AWS_STORAGE_BUCKET_NAME = "impala-localstack-public-bucket"  # localstack
 AWS_S3_ENDPOINT_URL = "https://localhost.localstack.cloud:4566"  # localstack
 AWS_QUERYSTRING_AUTH = False
@@ -38,11 +37,18 @@ CACHES = {
     "default": {
         "BACKEND": "django.core.cache.backends.memcached.PyLibMCCache",
         "LOCATION": os.environ["MEMCACHED_LOCATION"],
+        # 画像生成のリースをgets/casで解放する
+        "OPTIONS": {"behaviors": {"cas": True}},
     }
 }
 
-# Django Ratelimit
-# https://github.com/jsocol/django-ratelimit
-RATELIMIT_ENABLE = True
-RATELIMIT_VIEW = "api.views.ratelimited_error"
-RATELIMIT_IP_META_KEY = "HTTP_X_REAL_IP"  # HTTPヘッダーはX-Real-Ip
+# レート制限
+API_RATELIMIT_ENABLE = True
+API_RATELIMIT_IP_META_KEY = "HTTP_X_REAL_IP"  # HTTPヘッダーはX-Real-Ip
+
+# 大きな画像はエンコードと並行してマルチパートアップロードで送信する
+IMAGE_MULTIPART_UPLOAD = {
+    "PART_SIZE": 8 * 1024 * 1024,
+    "MAX_CONCURRENCY": 4,
+    "MAX_QUEUED_PARTS": 2,
+}
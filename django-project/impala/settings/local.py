@@ -18,6 +18,5 @@ DATABASES = {
 MEDIA_ROOT = BASE_DIR / "media/"
 MEDIA_URL = "media/"
 
-# Django Ratelimit
-# https://github.com/jsocol/django-ratelimit
-RATELIMIT_ENABLE = False
+# レート制限
+API_RATELIMIT_ENABLE = False
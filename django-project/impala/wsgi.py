@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "impala.settings.production")
 
 application = get_wsgi_application()
+
+# レンダーバックエンド (プロセスプール) とS3のコネクションをリクエストの受付前に準備する
+# gunicornの--preload等でこのモジュールを読み込んだプロセスからワーカーをフォークする場合は、
+# 親プロセスのプールやコネクションを引き継がず、各ワーカーで改めて準備する
+from api.services import warm_up_worker  # noqa: E402
+
+warm_up_worker()
+os.register_at_fork(after_in_child=warm_up_worker)